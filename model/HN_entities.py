@@ -1,6 +1,7 @@
 import entities
 
 from chroma_db import EmbeddingsNotFoundError
+from sqlite_db import UniqueDBItemNotFound
 
 class HNUserLoadError(Exception):
     def __init__(self, message):
@@ -18,10 +19,10 @@ class HNUser(entities.User):
         "users",
         entities.AttClassModel([
             entities.SqliteAttModel("username", False, False, "str", "TEXT"),
-            entities.SqliteAttModel("about", True, True, "str", "TEXT"),
+            entities.SqliteAttModel("about", True, True, "str", "TEXT", full_text=True),
             entities.SqliteAttModel("karma", False, True, "int", "INTEGER"),
             entities.SqliteAttModel("created", False, True, "int", "INTEGER"),
-            entities.SqliteAttModel("user_class", False, False, "str", "TEXT"),
+            entities.SqliteAttModel("user_class", False, False, "str", "TEXT", index=True),
             entities.SqliteAttModel("post_ids", False, False, "dict", "TEXT"),
             entities.SqliteAttModel("comment_ids", False, False, "dict", "TEXT"),
             entities.SqliteAttModel("favorite_post_ids", False, False, "dict", "TEXT")
@@ -34,36 +35,36 @@ class HNUser(entities.User):
         entities.AttClassModel([])
     )
 
-    def load_submission_history(sub_type, base, derived, generated):
-        submission_types = {
-            "posts": {
-                "id_list": "post_ids",
-                "init_func": HNPost
-            },
-            "comments": {
-                "id_list": "comment_ids",
-                "init_func": HNComment
-            },
-            "favorite_posts": {
-                "id_list": "favorite_post_ids",
-                "init_func": HNPost
-            }
-        }
-        id_list = self.base.get_value(submission_types[sub_type]["id_list"])
+    """
+        Get the submission objects in this user's history of a given type, latest first,
+        with one join against the user_submissions table.
+        Optionally only those from before a given time, and at most limit of them.
+    """
+    def load_submission_history(self, sub_type, before=None, limit=None):
+        init_func = get_submission_types()[sub_type]["init_func"]
+
+        sqlite_rows = self.sqlite.get_user_submissions(self.id, sub_type, init_func.model.table_name, init_func.model.id_att, before=before, limit=limit)
+
         submission_list = []
-        for id_val in id_list:
-            try:
-                submission = submission_types[sub_type]['init_func'](id_val, self.sqlite, self.chroma)
-                submission_list.append(submission)
-            except Exception as e:
-                    self._print(f"Error in retrieving {sub_type} {id_val} in submission history of {self}.")
-                    if skip_submission_errors:
-                        self._print("Skipping...")
-                        continue
-                    else:
-                        raise e
+        for sqlite_row in sqlite_rows:
+            submission = init_func(sqlite_row[init_func.model.id_att], self.sqlite, self.chroma, verbose=self.verbose)
+            submission.fill_from_sqlite_row(sqlite_row)
+            submission_list.append(submission)
+
         return submission_list
 
+    """
+        Posts and comments are in a user's history by author, so they're picked up however they're stored,
+        while favorites only come from the user's own list.
+    """
+    @classmethod
+    def get_submission_histories(cls):
+        return [
+            entities.SubmissionHistoryModel("posts", HNPost.model, author_att="by", time_att=HNSubmission.time_att),
+            entities.SubmissionHistoryModel("comments", HNComment.model, author_att="by", time_att=HNSubmission.time_att),
+            entities.SubmissionHistoryModel("favorite_posts", HNPost.model, id_list_att="favorite_post_ids", time_att=HNSubmission.time_att)
+        ]
+
     """
 
     def pupdate_in_chroma(self, embed_sub_his=False):
@@ -140,6 +141,12 @@ class HNSubmissionLoader(entities.DerivedLoader):
 
 class HNSubmission(entities.Submission):
 
+    time_att = "time"
+    submission_kind = None
+
+    def get_time(self):
+        return self.base.get_value(self.time_att)
+
     """
     def pupdate_in_chroma(self, embed_author=False):
         super().pupdate_in_chroma()
@@ -195,6 +202,8 @@ class HNSubmission(entities.Submission):
 
 class HNPost(HNSubmission, entities.Root):
 
+    submission_kind = "posts"
+
     model = entities.EntityModel(
         "id",
         "posts",
@@ -203,8 +212,8 @@ class HNPost(HNSubmission, entities.Root):
             entities.SqliteAttModel("id", False, False, "int", "INTEGER"),
             entities.SqliteAttModel("score", False, True, "int", "INTEGER"),
             entities.SqliteAttModel("time", False, True, "int", "INTEGER"),
-            entities.SqliteAttModel("title", False, False, "str", "TEXT"),
-            entities.SqliteAttModel("text", False, False, "str", "TEXT"),
+            entities.SqliteAttModel("title", False, False, "str", "TEXT", full_text=True),
+            entities.SqliteAttModel("text", False, False, "str", "TEXT", full_text=True),
             entities.SqliteAttModel("url", False, False, "str", "TEXT"),
             entities.SqliteAttModel("url_content", False, False, "str", "TEXT"),
         ]),
@@ -214,7 +223,11 @@ class HNPost(HNSubmission, entities.Root):
         ]),
         entities.AttClassModel([
             entities.GeneratedAttModel("url_content_summary", False, False, "str", "TEXT", "This is the body of an HTML web page. {{url_content}} Can you please give a summary of its contents in 500 characters or less?")
-        ])
+        ]),
+        indexes=[
+            entities.IndexModel(["time"]),
+            entities.IndexModel(["by", "time"], where="by IS NOT NULL")
+        ]
     )
 
     """
@@ -248,6 +261,8 @@ class HNPost(HNSubmission, entities.Root):
 
 class HNComment(HNSubmission, entities.Stem):
 
+    submission_kind = "comments"
+
     model = entities.EntityModel(
         "id",
         "comments",
@@ -255,12 +270,16 @@ class HNComment(HNSubmission, entities.Stem):
             entities.SqliteAttModel("by", False, False, "str", "TEXT"),
             entities.SqliteAttModel("id", False, False, "int", "INTEGER"),
             entities.SqliteAttModel("time", False, True, "int", "INTEGER"),
-            entities.SqliteAttModel("text", True, True, "str", "TEXT"),
+            entities.SqliteAttModel("text", True, True, "str", "TEXT", full_text=True),
         ]),
         entities.AttClassModel([
             entities.DerivedAttModel("author", False, False, "entity", lambda a, b ,c: a),
         ]),
-        entities.AttClassModel([])
+        entities.AttClassModel([]),
+        indexes=[
+            entities.IndexModel(["time"]),
+            entities.IndexModel(["by", "time"], where="by IS NOT NULL")
+        ]
     )
 
     def __str__(self):
@@ -277,4 +296,31 @@ class HNComment(HNSubmission, entities.Stem):
 
     def get_prompt_str(self):
         return "COMMENT: " + self.get_att("text")
-    """
\ No newline at end of file
+    """
+
+"""
+    The types of submission in a user's history, the users column holding each one's id list,
+    and the entity class for it.
+"""
+def get_submission_types():
+    return {
+        "posts": {
+            "id_list": "post_ids",
+            "init_func": HNPost
+        },
+        "comments": {
+            "id_list": "comment_ids",
+            "init_func": HNComment
+        },
+        "favorite_posts": {
+            "id_list": "favorite_post_ids",
+            "init_func": HNPost
+        }
+    }
+
+"""
+    Sqlite migrations for datasets of HN entities, to be passed to the forum.
+    The user_submissions table is kept in sync by triggers, and refilled whenever the schema changes,
+    so it needs no migration of its own.
+"""
+migrations = []
@@ -0,0 +1,190 @@
+"""
+    An approximate nearest neighbor index over embeddings, for finding the submissions
+    closest to a user without scoring every user against every submission.
+"""
+
+import numpy as np
+
+import pickle
+import time
+
+import utils
+
+"""
+    How many vectors are scored against the centroids at once while clustering,
+    to bound the memory used by the distance matrix.
+"""
+ASSIGN_CHUNK_SIZE = 4096
+
+class ANNIndexError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+"""
+    Scale each row of a matrix to unit length, so inner products are cosine similarities.
+"""
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+"""
+    Get the indices of the k largest scores, highest first.
+"""
+def top_k(scores, k):
+    k = min(k, len(scores))
+    if k == 0:
+        return np.array([], dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+"""
+    Assign each row of a normalized matrix to its most similar centroid, in chunks.
+"""
+def assign_to_centroids(matrix, centroids):
+    assignments = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), ASSIGN_CHUNK_SIZE):
+        assignments[start:start + ASSIGN_CHUNK_SIZE] = np.argmax(matrix[start:start + ASSIGN_CHUNK_SIZE] @ centroids.T, axis=1)
+    return assignments
+
+"""
+    Spherical k-means over a normalized matrix, starting from a seeded sample of its rows.
+    Clusters which empty out are restarted at a random row.
+"""
+def kmeans(matrix, num_clusters, num_iterations=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = matrix[rng.choice(len(matrix), size=num_clusters, replace=False)].copy()
+
+    assignments = None
+    for iteration in range(num_iterations):
+        new_assignments = assign_to_centroids(matrix, centroids)
+        if assignments is not None and np.array_equal(new_assignments, assignments):
+            break
+        assignments = new_assignments
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, matrix)
+        counts = np.bincount(assignments, minlength=num_clusters)
+
+        empty = counts == 0
+        sums[empty] = matrix[rng.choice(len(matrix), size=int(empty.sum()))]
+        centroids = normalize_rows(sums)
+
+    return centroids, assign_to_centroids(matrix, centroids)
+
+"""
+    An inverted file index: the embeddings are clustered with k-means, and stored grouped by cluster.
+    A query is scored against the centroids, and then only against the embeddings of the nprobe
+    closest clusters, so roughly nprobe / num_lists of the index is scanned.
+    Similarity is cosine, and ids can be anything, as they're only handed back from searches.
+"""
+class IVFIndex:
+    def __init__(self, num_lists=None, nprobe=8, num_iterations=20, seed=0):
+        self.num_lists = num_lists
+        self.nprobe = nprobe
+        self.num_iterations = num_iterations
+        self.seed = seed
+
+        self.ids = []
+        self.vectors = None
+        self.centroids = None
+        self.list_offsets = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    """
+        Build the index from a list of ids and a matrix with the embedding for each as a row.
+        The number of lists defaults to about the square root of the number of embeddings.
+    """
+    def build(self, ids, matrix):
+        if len(ids) != len(matrix):
+            raise ANNIndexError(f"Error: cannot build an index from {len(ids)} ids and {len(matrix)} embeddings.")
+        if len(ids) == 0:
+            raise ANNIndexError("Error: cannot build an index with no embeddings.")
+
+        matrix = normalize_rows(matrix)
+        num_lists = int(np.sqrt(len(matrix))) if self.num_lists == None else self.num_lists
+        num_lists = max(1, min(num_lists, len(matrix)))
+
+        self.centroids, assignments = kmeans(matrix, num_lists, num_iterations=self.num_iterations, seed=self.seed)
+
+        order = np.argsort(assignments, kind="stable")
+        self.ids = [ids[i] for i in order]
+        self.vectors = matrix[order]
+        self.list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=num_lists))))
+        self.num_lists = num_lists
+
+    """
+        Get the ids and cosine similarities of the k embeddings closest to a query,
+        searching the nprobe closest lists.
+    """
+    def search(self, query, k, nprobe=None):
+        if self.centroids is None:
+            raise ANNIndexError("Error: attempted to search an index before it was built.")
+
+        nprobe = self.nprobe if nprobe == None else nprobe
+        query = normalize_rows(query)
+
+        probed = top_k(self.centroids @ query, min(nprobe, self.num_lists))
+        rows = np.concatenate([np.arange(self.list_offsets[i], self.list_offsets[i + 1]) for i in probed])
+
+        scores = self.vectors[rows] @ query
+        top = top_k(scores, k)
+        return [self.ids[rows[i]] for i in top], scores[top]
+
+    """
+        Get the exact k closest embeddings to a query by scoring all of them.
+    """
+    def brute_force_search(self, query, k):
+        scores = self.vectors @ normalize_rows(query)
+        top = top_k(scores, k)
+        return [self.ids[i] for i in top], scores[top]
+
+    """
+        Measure the recall at k of searches for a matrix of queries against brute force,
+        along with the average time taken by each, and the fraction of the index scanned.
+    """
+    def measure_recall(self, queries, k, nprobe=None):
+        nprobe = self.nprobe if nprobe == None else nprobe
+
+        recalls = []
+        search_time = 0
+        brute_force_time = 0
+        for query in queries:
+            start = time.perf_counter()
+            found_ids, scores = self.search(query, k, nprobe=nprobe)
+            search_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            true_ids, true_scores = self.brute_force_search(query, k)
+            brute_force_time += time.perf_counter() - start
+
+            recalls.append(len(set(found_ids) & set(true_ids)) / max(len(true_ids), 1))
+
+        list_sizes = np.diff(self.list_offsets)
+        return {
+            "k": k,
+            "nprobe": nprobe,
+            "num_queries": len(recalls),
+            "recall": float(np.mean(recalls)) if len(recalls) > 0 else 0.0,
+            "search_ms": 1000 * search_time / max(len(recalls), 1),
+            "brute_force_ms": 1000 * brute_force_time / max(len(recalls), 1),
+            "scanned_fraction": float(np.sort(list_sizes)[::-1][:min(nprobe, self.num_lists)].sum() / max(len(self), 1))
+        }
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        if not utils.check_file_exists(path):
+            raise ANNIndexError(f"Error: no index exists at {path}.")
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+def print_recall_report(report):
+    print(f"Recall@{report['k']} with nprobe {report['nprobe']} over {report['num_queries']} queries: {report['recall']:.3f}")
+    print(f"    {report['search_ms']:.2f}ms per search against {report['brute_force_ms']:.2f}ms brute force, scanning at most {report['scanned_fraction']:.1%} of the index")
@@ -0,0 +1,91 @@
+"""
+    Unit tests for the IVF approximate nearest neighbor index, on seeded synthetic embeddings.
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+
+import numpy as np
+
+import ann_index
+
+"""
+    Make a seeded matrix of embeddings scattered around a number of cluster centers,
+    roughly how embeddings of submissions on similar topics fall.
+"""
+def get_clustered_matrix(num_rows, dimension, num_clusters, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dimension))
+    return (centers[rng.integers(num_clusters, size=num_rows)] + 0.3 * rng.standard_normal((num_rows, dimension))).astype(np.float32)
+
+class IVFIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.matrix = get_clustered_matrix(2000, 32, 20)
+        self.ids = [f"id{i}" for i in range(len(self.matrix))]
+        self.queries = get_clustered_matrix(50, 32, 20, seed=1)
+
+        self.index = ann_index.IVFIndex(num_lists=40, nprobe=8, seed=0)
+        self.index.build(self.ids, self.matrix)
+
+    def test_recall(self):
+        report = self.index.measure_recall(self.queries, 10)
+
+        self.assertGreaterEqual(report["recall"], 0.9)
+        self.assertLess(report["scanned_fraction"], 0.5)
+
+    """
+        Probing every list scans the whole index, so must agree exactly with brute force.
+    """
+    def test_exhaustive_probe(self):
+        for query in self.queries[:10]:
+            found_ids, scores = self.index.search(query, 10, nprobe=self.index.num_lists)
+            true_ids, true_scores = self.index.brute_force_search(query, 10)
+
+            self.assertEqual(found_ids, true_ids)
+            np.testing.assert_allclose(scores, true_scores, rtol=1e-5)
+
+    """
+        Brute force search returns the ids with the highest cosine similarity, highest first.
+    """
+    def test_brute_force(self):
+        normalized = ann_index.normalize_rows(self.matrix)
+        query = self.queries[0]
+        expected = np.argsort(-(normalized @ ann_index.normalize_rows(query)))[:5]
+
+        found_ids, scores = self.index.brute_force_search(query, 5)
+
+        self.assertEqual(found_ids, [self.ids[i] for i in expected])
+        self.assertTrue(np.all(np.diff(scores) <= 0))
+
+    """
+        The same seed builds the same index.
+    """
+    def test_deterministic(self):
+        other = ann_index.IVFIndex(num_lists=40, nprobe=8, seed=0)
+        other.build(self.ids, self.matrix)
+
+        np.testing.assert_array_equal(other.centroids, self.index.centroids)
+        self.assertEqual(other.search(self.queries[0], 10)[0], self.index.search(self.queries[0], 10)[0])
+
+    def test_save_load(self):
+        dir_path = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir_path, "index.pkl")
+            self.index.save(path)
+            loaded = ann_index.IVFIndex.load(path)
+        finally:
+            shutil.rmtree(dir_path)
+
+        self.assertEqual(loaded.search(self.queries[0], 10)[0], self.index.search(self.queries[0], 10)[0])
+
+    def test_errors(self):
+        with self.assertRaises(ann_index.ANNIndexError):
+            ann_index.IVFIndex().search(self.queries[0], 10)
+        with self.assertRaises(ann_index.ANNIndexError):
+            ann_index.IVFIndex().build(self.ids[:10], self.matrix)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+    Asyncio facades over the sqlite and chroma databases, so that coroutines
+    making network calls can overlap them with database reads and writes.
+    Each blocking call is run on a bounded thread pool, which the databases are safe to share.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from chroma_db import CHROMA_GET_CHUNK_SIZE
+
+"""
+    The pieces shared by both facades: the wrapped database and the executor its calls are run on.
+    If no executor is given, one is created with max_workers threads, and shut down on close().
+"""
+class AsyncDB:
+    def __init__(self, db, max_workers=4, executor=None):
+        self.db = db
+        self.owns_executor = executor == None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers) if executor == None else executor
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    """
+        Run a blocking function on the executor, and wait for its result.
+    """
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        if self.owns_executor:
+            self.executor.shutdown(wait=True)
+
+"""
+    An asyncio facade over a SqliteDB.
+"""
+class AsyncSqliteDB(AsyncDB):
+
+    async def select(self, table_name, att_model_list, where_dict):
+        return await self.run(self.db.select, table_name, att_model_list, where_dict)
+
+    async def get_by_id(self, id_att, table_name, id_val, att_model_list=None):
+        return await self.run(self.db.get_by_id, id_att, table_name, id_val, att_model_list=att_model_list)
+
+    async def get_by_ids(self, id_att, table_name, ids, att_model_list=None):
+        return await self.run(self.db.get_by_ids, id_att, table_name, ids, att_model_list=att_model_list)
+
+    async def get_user_submissions(self, username, kind, table_name, id_att, before=None, limit=None, att_model_list=None):
+        return await self.run(self.db.get_user_submissions, username, kind, table_name, id_att, before=before, limit=limit, att_model_list=att_model_list)
+
+    async def search(self, table_name, query, limit=10, att_model_list=None):
+        return await self.run(self.db.search, table_name, query, limit=limit, att_model_list=att_model_list)
+
+    async def insert(self, table_name, att_dict_list, att_model_list, ignore_dups=False):
+        return await self.run(self.db.insert, table_name, att_dict_list, att_model_list, ignore_dups=ignore_dups)
+
+    async def upsert(self, table_name, att_dict_list, att_model_list, conflict_att, only_if_changed=False):
+        return await self.run(self.db.upsert, table_name, att_dict_list, att_model_list, conflict_att, only_if_changed=only_if_changed)
+
+    async def update(self, table_name, where_dict, update_dict):
+        return await self.run(self.db.update, table_name, where_dict, update_dict)
+
+    async def delete(self, table_name, where_dict):
+        return await self.run(self.db.delete, table_name, where_dict)
+
+    async def delete_by_ids(self, id_att, table_name, id_list):
+        return await self.run(self.db.delete_by_ids, id_att, table_name, id_list)
+
+    """
+        Run a function taking the SqliteDB inside a single transaction.
+        Transactions belong to a thread's connection, so the whole function runs as one call on the executor.
+    """
+    async def run_in_transaction(self, func, *args, **kwargs):
+        def run_transaction():
+            with self.db.transaction():
+                return func(self.db, *args, **kwargs)
+        return await self.run(run_transaction)
+
+"""
+    An asyncio facade over a ChromaDB.
+"""
+class AsyncChromaDB(AsyncDB):
+
+    async def retrieve(self, att_model, id_val):
+        return await self.run(self.db.retrieve, att_model, id_val)
+
+    async def retrieve_many(self, att_model, id_list, chunk_size=CHROMA_GET_CHUNK_SIZE):
+        return await self.run(self.db.retrieve_many, att_model, id_list, chunk_size=chunk_size)
+
+    async def generate(self, att_model, id_list, value_list, update=False):
+        return await self.run(self.db.generate, att_model, id_list, value_list, update=update)
+
+    async def update(self, att_model, id_list, value_list):
+        return await self.run(self.db.update, att_model, id_list, value_list)
+
+    async def delete(self, att_model, id_list):
+        return await self.run(self.db.delete, att_model, id_list)
@@ -4,11 +4,17 @@
 """
 
 import chromadb
+import numpy as np
+
+from embedding_cache import get_document_hash
 
 import utils
 
 import functools
 import uuid
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 """
     For chroma errors
@@ -26,12 +32,189 @@ class GenerateNullEmbeddingsError(Exception):
         super().__init__(message)
 
 
+"""
+    How many ids to request from chroma per get call when retrieving in bulk.
+"""
+CHROMA_GET_CHUNK_SIZE = 1000
+
+"""
+    The wait before the first retry of a failed embedding batch, doubled on each retry after.
+"""
+RETRY_BACKOFF_SECONDS = 1
+
+"""
+    Pack documents, given their token counts, into batches of indices
+    with at most max_batch_tokens tokens and max_batch_items documents each, keeping their order.
+"""
+def pack_batches(token_counts, max_batch_tokens, max_batch_items):
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for i, token_count in enumerate(token_counts):
+        if len(batch) > 0 and (batch_tokens + token_count > max_batch_tokens or len(batch) == max_batch_items):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += token_count
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+"""
+    Embed one batch of documents, retrying it up to the embedding model's max_retries times
+    with exponential backoff.
+"""
+def embed_with_retries(embedding_model, documents):
+    for attempt in range(embedding_model.max_retries + 1):
+        try:
+            return embedding_model.embed_batch(documents)
+        except Exception as e:
+            if attempt == embedding_model.max_retries:
+                raise e
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+"""
+    Embed a list of documents with an embedding model, packed into batches bounded by the model's
+    max_batch_tokens and max_batch_items, up to max_concurrency batches at a time.
+
+    Documents found in the model's embedding cache, if it has one, aren't embedded at all,
+    and a document repeated in the list is only embedded once. Their tokens are counted as saved.
+
+    Each batch that succeeds is passed to write_batch, with its document indices and embeddings,
+    from the calling thread as soon as it's done, and its tokens are accrued to the model.
+    A batch that fails is retried on its own; the indices of those which still failed are returned.
+"""
+def embed_in_batches(embedding_model, documents, token_counts, write_batch):
+    hashes = [get_document_hash(doc) for doc in documents]
+    indices_by_hash = {}
+    for i, hash_val in enumerate(hashes):
+        indices_by_hash.setdefault(hash_val, []).append(i)
+
+    cache_key = embedding_model.get_cache_key()
+    cached = {} if embedding_model.cache == None else embedding_model.cache.get_many(cache_key, list(indices_by_hash.keys()))
+
+    if len(cached) > 0:
+        cached_indices = [i for hash_val in cached for i in indices_by_hash[hash_val]]
+        write_batch(cached_indices, np.array([cached[hashes[i]] for i in cached_indices], dtype=np.float32))
+        embedding_model.record_cache_hits(len(cached_indices), sum([token_counts[i] for i in cached_indices]))
+
+    to_embed = [indices[0] for hash_val, indices in indices_by_hash.items() if not (hash_val in cached)]
+    repeated = [i for hash_val, indices in indices_by_hash.items() if not (hash_val in cached) for i in indices[1:]]
+    embedding_model.record_cache_misses(len(to_embed))
+    embedding_model.record_cache_hits(len(repeated), sum([token_counts[i] for i in repeated]))
+
+    batches = [[to_embed[i] for i in batch] for batch in pack_batches([token_counts[i] for i in to_embed], embedding_model.max_batch_tokens, embedding_model.max_batch_items)]
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=embedding_model.max_concurrency) as executor:
+        futures = {executor.submit(embed_with_retries, embedding_model, [documents[i] for i in batch]): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                embeddings = future.result()
+            except Exception as e:
+                utils.print_error(e)
+                failed += [i for first_index in batch for i in indices_by_hash[hashes[first_index]]]
+                continue
+
+            if embedding_model.cache != None:
+                embedding_model.cache.put_many(cache_key, [hashes[i] for i in batch], embeddings)
+
+            batch_indices = [i for first_index in batch for i in indices_by_hash[hashes[first_index]]]
+            batch_rows = [j for j, first_index in enumerate(batch) for i in indices_by_hash[hashes[first_index]]]
+            write_batch(batch_indices, np.asarray(embeddings, dtype=np.float32)[batch_rows])
+            embedding_model.accrued_input_tokens += sum([token_counts[i] for i in batch])
+
+    return sorted(failed)
+
+"""
+    Embed a list of documents as embed_in_batches does, splitting any over the embedding model's
+    max_tokens into chunks when it's in chunk mode, rather than raising an error.
+    All the chunks are embedded in the same batches as the other documents,
+    and once every chunk of a document is done, the chunks are passed to write_chunks
+    with the document's index, their texts and embeddings, and their pooled vector is
+    passed to write_documents as the document's own embedding.
+    Returns the indices of the documents which failed, either themselves or in any chunk.
+"""
+def embed_documents(embedding_model, documents, token_counts, ids, write_documents, write_chunks):
+    long_indices = [i for i in range(len(documents)) if token_counts[i] > embedding_model.max_tokens]
+    if len(long_indices) > 0 and embedding_model.long_document_mode != "chunk":
+        raise ChromaError(f"Error: attempted to generate embeddings for documents with ids {[ids[i] for i in long_indices]}, which are over the token limit.")
+
+    long_set = set(long_indices)
+    embed_docs = [documents[i] for i in range(len(documents)) if not (i in long_set)]
+    embed_token_counts = [token_counts[i] for i in range(len(documents)) if not (i in long_set)]
+    owners = [(i, None) for i in range(len(documents)) if not (i in long_set)]
+
+    chunks = {}
+    for i in long_indices:
+        chunk_texts = embedding_model.split_document(documents[i])
+        chunk_token_counts = embedding_model.tokenize_batch(chunk_texts)
+        chunks[i] = {
+            "texts": chunk_texts,
+            "token_counts": chunk_token_counts,
+            "embeddings": [None for chunk_text in chunk_texts],
+            "remaining": len(chunk_texts)
+        }
+        embed_docs += chunk_texts
+        embed_token_counts += chunk_token_counts
+        owners += [(i, k) for k in range(len(chunk_texts))]
+
+    def write_batch(batch, embeddings):
+        document_indices = []
+        document_rows = []
+        for j, embed_index in enumerate(batch):
+            i, k = owners[embed_index]
+            if k == None:
+                document_indices.append(i)
+                document_rows.append(j)
+                continue
+
+            chunks[i]["embeddings"][k] = embeddings[j]
+            chunks[i]["remaining"] -= 1
+            if chunks[i]["remaining"] == 0:
+                chunk_embeddings = np.array(chunks[i]["embeddings"], dtype=np.float32)
+                write_chunks(i, chunks[i]["texts"], chunk_embeddings)
+                write_documents([i], embedding_model.pool_chunks(chunk_embeddings, chunks[i]["token_counts"])[np.newaxis])
+
+        if len(document_indices) > 0:
+            write_documents(document_indices, np.asarray(embeddings, dtype=np.float32)[document_rows])
+
+    failed = embed_in_batches(embedding_model, embed_docs, embed_token_counts, write_batch)
+
+    return sorted(set([owners[embed_index][0] for embed_index in failed]))
+
+def get_collection_name(table_name, att_name):
+    return f"{table_name}_{att_name}"
+
+"""
+    The collection holding the chunk embeddings of an attribute's over-long documents.
+"""
+def get_chunk_collection_name(table_name, att_name):
+    return f"{table_name}_{att_name}_chunks"
+
+def get_chunk_id(id_val, chunk_index):
+    return f"{id_val}#{chunk_index}"
+
+"""
+    Get the hash of an attribute value as it would be embedded, an empty value being embedded as "EMPTY",
+    to compare against the hashes of the documents already embedded.
+"""
+def get_value_hash(value):
+    return get_document_hash("EMPTY" if value == "" else value)
+
 """
     A class used to create the object with which the dataset
     will interact with Chroma
 
     (wanted to do this the same way i did sqlite with connection only being open when necessary,
     but looks like chroma doesnt have functionality for that. oh well.)
+
+    It's safe to share across threads: the client is, and writes to collections
+    are serialized with a lock while reads run concurrently.
 """
 class ChromaDB:
     def __init__(self, path, forum, embedding_model):
@@ -40,29 +223,85 @@ class ChromaDB:
         self.embedding_model = embedding_model
 
         self.client = chromadb.PersistentClient(path=self.path)
+        self.write_lock = threading.RLock()
+
+        self.collections = {}
+        self.collections_lock = threading.Lock()
 
         self.check_update_collections(forum)
 
+    """
+        Make sure there's a collection for every embedded attribute of the forum's entities,
+        and keep handles to them.
+    """
     def check_update_collections(self, forum):
-        collection_names = self.client.list_collections()
-
         for entity_model in forum.get_entity_models():
-            for att in entity_model.all_embedded_atts():
-                collection_name = f"{entity_model.table_name}_{att.name}"
-                if not (att_collection_name in collection_names):
-                    self.client.create_collection(name=att_collection_name,
+            for att in entity_model.all_embedded_atts:
+                with self.write_lock:
+                    collection = self.client.get_or_create_collection(name=get_collection_name(entity_model.table_name, att.name),
                         embedding_function=self.embedding_model.get_chroma_embedding_function())
+                with self.collections_lock:
+                    self.collections[(entity_model.table_name, att.name)] = collection
     
     """
         Get a collection of a given attribute for a given entity.
+        Handles are kept after the first lookup, until invalidated.
     """
     def get_collection(self, table_name, att_name):
-        return self.client.get_collection(name=f"{table_name}_{att_name}", embedding_function=self.embedding_model.get_chroma_embedding_function())
+        with self.collections_lock:
+            if (table_name, att_name) in self.collections:
+                return self.collections[(table_name, att_name)]
+
+        collection = self.client.get_collection(name=get_collection_name(table_name, att_name), embedding_function=self.embedding_model.get_chroma_embedding_function())
+
+        with self.collections_lock:
+            self.collections[(table_name, att_name)] = collection
+        return collection
+
+    """
+        Get the chunk collection of a given attribute for a given entity, creating it on first use.
+    """
+    def get_chunk_collection(self, table_name, att_name):
+        chunk_att_name = f"{att_name}_chunks"
+        with self.collections_lock:
+            if (table_name, chunk_att_name) in self.collections:
+                return self.collections[(table_name, chunk_att_name)]
+
+        with self.write_lock:
+            collection = self.client.get_or_create_collection(name=get_chunk_collection_name(table_name, att_name), embedding_function=self.embedding_model.get_chroma_embedding_function())
+
+        with self.collections_lock:
+            self.collections[(table_name, chunk_att_name)] = collection
+        return collection
+
+    """
+        Drop the kept handle for a collection, or every handle if none is given,
+        so the next use looks it up again. To be called whenever collections are
+        created, deleted or reset outside of this object.
+    """
+    def invalidate_collections(self, table_name=None, att_name=None):
+        with self.collections_lock:
+            if table_name == None:
+                self.collections = {}
+            else:
+                self.collections.pop((table_name, att_name), None)
+
+    """
+        Delete the collection of a given attribute for a given entity, along with its handle.
+    """
+    def delete_collection(self, table_name, att_name):
+        with self.write_lock:
+            self.client.delete_collection(name=get_collection_name(table_name, att_name))
+        self.invalidate_collections(table_name, att_name)
 
 
     """
         Generate embeddings for a given attribute of a given entity type,
-        given an id list and a value list
+        given an id list and a value list.
+        The documents are embedded in token bounded batches with embed_documents, and each batch
+        is written as soon as it's embedded, so a batch failing leaves the others in place.
+        Documents over the token limit are chunked and pooled if the embedding model is in chunk mode,
+        with the chunks kept in a separate collection, see retrieve_chunks.
     """
     def generate(self, att_model, id_list, value_list, update=False):
         documents = [val for val in value_list]
@@ -78,15 +317,59 @@ class ChromaDB:
 
         documents = [("EMPTY" if doc == "" else doc) for doc in documents]
 
-        for i in range(len(documents)):
-            if self.embedding_model.tokenize(documents[i]) > self.embedding_model.max_tokens:
-                raise ChromaError(f"Error: attempted to generate embeddings for document with id {metadatas[i]['id_val'] if att_model['is_list'] else ids[i]}")
+        token_counts = self.embedding_model.tokenize_batch(documents)
 
         collection = self.get_collection(att_model.table_name, att_model.name)
 
         operation = collection.update if update else collection.add
 
-        operation(documents=documents, ids=ids)
+        def write_documents(batch, embeddings):
+            with self.write_lock:
+                operation(embeddings=embeddings, documents=[documents[i] for i in batch], ids=[ids[i] for i in batch])
+                if update and self.embedding_model.long_document_mode == "chunk":
+                    unchunked_ids = [ids[i] for i in batch if token_counts[i] <= self.embedding_model.max_tokens]
+                    if len(unchunked_ids) > 0:
+                        self.get_chunk_collection(att_model.table_name, att_model.name).delete(where={"parent_id": {"$in": unchunked_ids}})
+
+        def write_chunks(i, chunk_texts, chunk_embeddings):
+            chunk_collection = self.get_chunk_collection(att_model.table_name, att_model.name)
+            with self.write_lock:
+                chunk_collection.delete(where={"parent_id": ids[i]})
+                chunk_collection.add(
+                    embeddings=chunk_embeddings,
+                    documents=chunk_texts,
+                    ids=[get_chunk_id(ids[i], k) for k in range(len(chunk_texts))],
+                    metadatas=[{"parent_id": ids[i], "chunk_index": k} for k in range(len(chunk_texts))]
+                )
+
+        failed = embed_documents(self.embedding_model, documents, token_counts, ids, write_documents, write_chunks)
+
+        if len(failed) > 0:
+            raise ChromaError(f"Error: failed to generate embeddings for attribute {att_model.name} of {att_model.table_name} with ids {[ids[i] for i in failed]}.")
+
+    """
+        Get the documents currently embedded for a list of ids, as a dict keyed by id.
+        Ids without embeddings are left out.
+    """
+    def retrieve_values(self, att_model, id_list, chunk_size=CHROMA_GET_CHUNK_SIZE):
+        collection = self.get_collection(att_model.table_name, att_model.name)
+
+        id_strs = list(dict.fromkeys([str(id_val) for id_val in id_list]))
+        values = {}
+        for i in range(0, len(id_strs), chunk_size):
+            result = collection.get(ids=id_strs[i:i + chunk_size], include=["documents"])
+            for result_id, document in zip(result['ids'], result['documents']):
+                values[result_id] = "" if document == "EMPTY" else document
+
+        return values
+
+    """
+        Get the hashes of the documents currently embedded for a list of ids, as a dict keyed by id,
+        to tell which embeddings are stale without comparing whole documents.
+    """
+    def retrieve_value_hashes(self, att_model, id_list, chunk_size=CHROMA_GET_CHUNK_SIZE):
+        values = self.retrieve_values(att_model, id_list, chunk_size=chunk_size)
+        return {id_str: get_value_hash(value) for id_str, value in values.items()}
 
     """
         Retrieve embeddings for a given id list
@@ -106,10 +389,54 @@ class ChromaDB:
 
         return {'embeddings': result['embeddings'][0], 'value': values[0]}
 
+    """
+        Retrieve the embeddings of a given attribute for a list of ids, with one get per chunk of ids.
+        Returns a float32 matrix with one row per requested id, in the order requested,
+        and a boolean mask of which ids were found. Rows of missing ids are left as zeros.
+    """
+    def retrieve_many(self, att_model, id_list, chunk_size=CHROMA_GET_CHUNK_SIZE):
+        collection = self.get_collection(att_model.table_name, att_model.name)
+
+        positions = {}
+        for i, id_val in enumerate(id_list):
+            positions.setdefault(str(id_val), []).append(i)
+
+        embeddings = np.zeros((len(id_list), self.embedding_model.dimension), dtype=np.float32)
+        found = np.zeros(len(id_list), dtype=bool)
+
+        unique_ids = list(positions.keys())
+        for i in range(0, len(unique_ids), chunk_size):
+            result = collection.get(ids=unique_ids[i:i + chunk_size], include=["embeddings"])
+            for result_id, result_embeddings in zip(result['ids'], result['embeddings']):
+                embeddings[positions[result_id]] = result_embeddings
+                found[positions[result_id]] = True
+
+        return embeddings, found
+
+    """
+        Retrieve the chunk embeddings of a given id's document, if it was chunked,
+        as a float32 matrix with a row per chunk in order, along with the chunks' texts.
+    """
+    def retrieve_chunks(self, att_model, id_val):
+        chunk_collection = self.get_chunk_collection(att_model.table_name, att_model.name)
+
+        result = chunk_collection.get(where={"parent_id": str(id_val)}, include=["documents", "embeddings", "metadatas"])
+        if len(result['ids']) == 0:
+            raise EmbeddingsNotFoundError(f"Error: chunk embeddings for attribute {att_model.name} of {att_model.table_name} with id {id_val} not found.")
+
+        order = np.argsort([metadata["chunk_index"] for metadata in result['metadatas']])
+
+        return {'embeddings': np.asarray(result['embeddings'], dtype=np.float32)[order], 'values': [result['documents'][i] for i in order]}
 
     def delete(self, att_model, id_list):
         collection = self.get_collection(att_model.table_name, att_model.name)
-        collection.delete(ids=[str(id_val) for id_val in id_list])
+        with self.write_lock:
+            collection.delete(ids=[str(id_val) for id_val in id_list])
+
+        if self.embedding_model.long_document_mode == "chunk":
+            chunk_collection = self.get_chunk_collection(att_model.table_name, att_model.name)
+            with self.write_lock:
+                chunk_collection.delete(where={"parent_id": {"$in": [str(id_val) for id_val in id_list]}})
 
     def update(self, att_model, id_list, value_list):
         self.generate(att_model, id_list, value_list, update=True)
@@ -0,0 +1,147 @@
+"""
+    Tests for embedding documents in batches, run offline with the local embedding model.
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+from unittest import mock
+
+import numpy as np
+
+import chroma_db
+import embeddings
+import embedding_cache
+
+def get_local_model(**config):
+    return embeddings.LocalEmbeddingModel({"name": "local", "max_tokens": 8191, "input_token_cost": 0, "dimension": 16, "num_features": 256, "seed": 0, **config})
+
+"""
+    A local embedding model which records the batches it's asked to embed,
+    and fails the first num_failures of them.
+"""
+class RecordingModel(embeddings.LocalEmbeddingModel):
+    def __init__(self, config, num_failures=0):
+        super().__init__(config)
+        self.num_failures = num_failures
+        self.batches = []
+
+    def embed_batch(self, documents):
+        self.batches.append(list(documents))
+        if len(self.batches) <= self.num_failures:
+            raise RuntimeError("embedding request failed")
+        return super().embed_batch(documents)
+
+def get_recording_model(num_failures=0, **config):
+    return RecordingModel({"name": "local", "max_tokens": 8191, "input_token_cost": 0, "dimension": 16, "num_features": 256, "seed": 0, "max_concurrency": 1, **config}, num_failures=num_failures)
+
+"""
+    Embed documents with embed_in_batches, returning the matrix of embeddings written and the failed indices.
+"""
+def embed(embedding_model, documents):
+    written = np.full((len(documents), embedding_model.dimension), np.nan, dtype=np.float32)
+    def write_batch(indices, batch_embeddings):
+        written[indices] = batch_embeddings
+    failed = chroma_db.embed_in_batches(embedding_model, documents, embedding_model.tokenize_batch(documents), write_batch)
+    return written, failed
+
+class PackBatchesTests(unittest.TestCase):
+
+    def test_token_bound(self):
+        self.assertEqual(chroma_db.pack_batches([3, 3, 3, 5, 1], 6, 100), [[0, 1], [2], [3, 4]])
+
+    def test_item_bound(self):
+        self.assertEqual(chroma_db.pack_batches([1, 1, 1, 1, 1], 100, 2), [[0, 1], [2, 3], [4]])
+
+    """
+        A document over the token budget on its own still gets a batch, rather than being dropped.
+    """
+    def test_oversized_document(self):
+        self.assertEqual(chroma_db.pack_batches([2, 10, 2], 5, 100), [[0], [1], [2]])
+
+class EmbedInBatchesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def test_matches_unbatched(self):
+        embedding_model = get_recording_model(max_batch_items=2)
+        documents = ["the first document", "a second one", "and a third", "the fourth"]
+
+        written, failed = embed(embedding_model, documents)
+
+        self.assertEqual(failed, [])
+        self.assertEqual([len(batch) for batch in embedding_model.batches], [2, 2])
+        np.testing.assert_allclose(written, get_local_model().embed_batch(documents), rtol=1e-5, atol=1e-6)
+
+    """
+        A document repeated in the list is only embedded once, and counted as a hit.
+    """
+    def test_repeated_documents(self):
+        embedding_model = get_recording_model()
+        written, failed = embed(embedding_model, ["same text", "other text", "same text"])
+
+        self.assertEqual(sorted(sum(embedding_model.batches, [])), ["other text", "same text"])
+        np.testing.assert_array_equal(written[0], written[2])
+        self.assertEqual((embedding_model.cache_hits, embedding_model.cache_misses), (1, 2))
+
+    """
+        Documents already in the cache aren't embedded again, by this model or another with the same config.
+    """
+    def test_cache(self):
+        cache = embedding_cache.EmbeddingCache(os.path.join(self.dir_path, "cache.db"))
+
+        first_model = get_recording_model()
+        first_model.set_cache(cache)
+        first_written, failed = embed(first_model, ["cached text", "more text"])
+
+        second_model = get_recording_model()
+        second_model.set_cache(cache)
+        second_written, failed = embed(second_model, ["more text", "new text", "cached text"])
+        cache.close()
+
+        self.assertEqual(second_model.batches, [["new text"]])
+        np.testing.assert_array_equal(second_written[[0, 2]], first_written[[1, 0]])
+        self.assertEqual(second_model.cache_hits, 2)
+
+    """
+        A batch which fails is retried with exponential backoff, and reported as failed once out of retries.
+    """
+    @mock.patch("chroma_db.time.sleep")
+    def test_retries(self, sleep):
+        embedding_model = get_recording_model(num_failures=2, max_retries=2)
+        written, failed = embed(embedding_model, ["retried text"])
+
+        self.assertEqual(failed, [])
+        self.assertEqual(len(embedding_model.batches), 3)
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [chroma_db.RETRY_BACKOFF_SECONDS, 2 * chroma_db.RETRY_BACKOFF_SECONDS])
+        self.assertFalse(np.isnan(written).any())
+
+    @mock.patch("chroma_db.time.sleep")
+    def test_retries_exhausted(self, sleep):
+        embedding_model = get_recording_model(num_failures=10, max_retries=1, max_batch_items=1)
+        with mock.patch("utils.print_error"):
+            written, failed = embed(embedding_model, ["failed text", "also failed", "failed text"])
+
+        self.assertEqual(failed, [0, 1, 2])
+        self.assertEqual(embedding_model.accrued_input_tokens, 0)
+
+class LocalEmbeddingModelTests(unittest.TestCase):
+
+    def test_deterministic(self):
+        documents = ["Show HN: a lisp in 100 lines", ""]
+        first = get_local_model().embed_batch(documents)
+        second = get_local_model().embed_batch(documents)
+
+        np.testing.assert_array_equal(first, second)
+        self.assertAlmostEqual(float(np.linalg.norm(first[0])), 1.0, places=5)
+
+    def test_seed(self):
+        self.assertFalse(np.allclose(get_local_model(seed=0).embed_batch(["text"]), get_local_model(seed=1).embed_batch(["text"])))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,9 +11,15 @@ import functools
 import utils
 import sqlite_db
 import chroma_db
+import embedding_store
+import embedding_cache
+import quantization
+import projection
+import ann_index
 import user_pool
 import submission_forest
 import HN_entities
+import entities
 import llms
 import embeddings
 
@@ -25,10 +31,14 @@ class DatasetError(Exception):
         super().__init__(message)
 
 class Dataset:
-    def __init__(self, name, forum, data_source_file_names=None, llm_config=None, embedding_config=None, verbose=False):
+    def __init__(self, name, forum, data_source_file_names=None, llm_config=None, embedding_config=None, read_only=False, slow_query_threshold=None, quantization_mode=None, when_name=None, verbose=False):
 
         self.name = name
         self.forum = forum
+        self.read_only = read_only
+        self.quantization_mode = quantization_mode
+        self.when_name = None
+        self.projection = None
         self.verbose = verbose
         
         self.dataset_path = utils.get_dataset_path(self.name)
@@ -46,7 +56,7 @@ class Dataset:
         self.sqlite_path = self.get_data_source_path(self.data_source_file_names["sqlite_path"])
         self.chroma_path = self.get_data_source_path(self.data_source_file_names["chroma_path"])
 
-        self.sqlite = sqlite_db.SqliteDB(self.sqlite_path, self.forum)
+        self.sqlite = sqlite_db.SqliteDB(self.sqlite_path, self.forum, read_only=self.read_only, slow_query_threshold=slow_query_threshold)
 
         if embedding_config == None:
             self.embedding_config = utils.read_json(utils.fetch_env_var("DEFAULT_EMBEDDING_CONFIG"))
@@ -55,7 +65,21 @@ class Dataset:
 
         self.embedding_model = embeddings.get_embedding_model(self.embedding_config)
 
-        self.chroma = chroma_db.ChromaDB(self.chroma_path, self.forum, self.embedding_model)
+        self.embedding_cache = None
+        cache_path = embedding_cache.get_shared_cache_path()
+        #a read only dataset opens the shared cache read only, and goes without if there isn't one yet
+        if self.embedding_config.get("use_cache", True) and (utils.check_file_exists(cache_path) or not self.read_only):
+            self.embedding_cache = embedding_cache.EmbeddingCache(cache_path, read_only=self.read_only)
+            self.embedding_model.set_cache(self.embedding_cache)
+
+        self.embedding_backend = self.data_source_file_names.get("embedding_backend", "chroma")
+        if self.embedding_backend == "chroma":
+            self.chroma = chroma_db.ChromaDB(self.chroma_path, self.forum, self.embedding_model)
+        elif self.embedding_backend == "embedding_store":
+            self.embedding_store_path = self.get_data_source_path(self.data_source_file_names["embedding_store_path"])
+            self.chroma = embedding_store.EmbeddingStore(self.embedding_store_path, self.forum, self.embedding_model, read_only=self.read_only)
+        else:
+            raise DatasetError(f"Error: unknown embedding backend {self.embedding_backend}.")
 
         self.user_factory = lambda id_val: self.forum.user(id_val, self.sqlite, self.chroma, verbose=self.verbose)
         self.root_factory = lambda id_val: self.forum.root(id_val, self.sqlite, self.chroma, verbose=self.verbose)
@@ -73,124 +97,440 @@ class Dataset:
             self.sf = submission_forest.SubmissionForest(self.name, utils.read_json(self.sf_path), self.root_factory, self.stem_factory, verbose=self.verbose)
         else:
             self.sf = submission_forest.SubmissionForest(self.name, [], self.root_factory, self.stem_factory, verbose=self.verbose)
-            self.write_current_sf()
+            if not self.read_only:
+                self.write_current_sf()
 
         has_user_pool = utils.check_file_exists(self.user_pool_path)
         if has_user_pool:
             self.user_pool = user_pool.UserPool(self.name, utils.read_json(self.user_pool_path), self.user_factory, verbose=self.verbose)
         else:
             self.user_pool = user_pool.UserPool(self.name, [], self.user_factory, verbose=self.verbose)
-            self.write_current_user_pool()
+            if not self.read_only:
+                self.write_current_user_pool()
 
-    def get_when_train_row(self, user, branch, start_time, end_time):
-        user_dict = user.get_when_dict()
-        root_dict = branch.root.get_when_dict()
+        self.candidate_index_path = self.get_data_source_path(self.data_source_file_names.get("candidate_index_path", "candidate_index.pkl"))
+        self.candidate_index = ann_index.IVFIndex.load(self.candidate_index_path) if utils.check_file_exists(self.candidate_index_path) else None
 
-        if len(branch.stems) < 1:
-            raise DatasetError(f"Error: cannot get a training row from a branch which has no stems.")
+        if when_name != None:
+            self.pair_with_when(when_name)
 
-        label_stem = branch.stems[-1]
-        feature_stems = [stem.get_when_dict() for stem in branch.stems[:-1]]
+    """
+        Fit a projection of the embedded when attributes given a projection config,
+        streaming each attribute's embeddings from chroma in chunks,
+        and use it for all following when rows, saving it next to the paired when model if there is one.
+    """
+    def fit_when_projection(self, projection_config, chunk_size=chroma_db.CHROMA_GET_CHUNK_SIZE):
+        embedding_projection = projection.EmbeddingProjection(projection_config, self.embedding_model.dimension)
+        unfit_att_names = embedding_projection.get_unfit_att_names()
+
+        for entity_class in list(dict.fromkeys([self.forum.user, self.forum.root, self.forum.stem])):
+            model = entity_class.model
+            fit_atts = [att for att in model.all_embedded_atts if att.name in unfit_att_names and att.in_when]
+            if len(fit_atts) == 0:
+                continue
+
+            def fit_chunk(ids):
+                for att in fit_atts:
+                    embeddings, found = self.chroma.retrieve_many(att, ids, chunk_size=chunk_size)
+                    if found.any():
+                        embedding_projection.partial_fit(att.name, embeddings[found])
+
+            ids = []
+            for sqlite_row in self.sqlite.iter_rows(model.table_name, [att for att in model.base.att_list if att.name == model.id_att], batch_size=chunk_size):
+                ids.append(sqlite_row[model.id_att])
+                if len(ids) == chunk_size:
+                    fit_chunk(ids)
+                    ids = []
+            if len(ids) > 0:
+                fit_chunk(ids)
+
+        embedding_projection.finalize()
+        self.set_projection(embedding_projection)
+        return embedding_projection
+
+    def set_projection(self, embedding_projection):
+        self.projection = embedding_projection
+        if self.when_name != None:
+            self.projection.save(projection.get_projection_path(self.when_name))
+
+    """
+        Pair the dataset with a when model, using the projection saved next to it for all following
+        when rows, so that they're as wide as the rows the model was trained or will be trained on.
+        If the model has no projection yet, embeddings are left unprojected.
+    """
+    def pair_with_when(self, when_name):
+        self.when_name = when_name
+        projection_path = projection.get_projection_path(when_name)
+        self.projection = projection.EmbeddingProjection.load(projection_path) if utils.check_file_exists(projection_path) else None
+        self._print(f"Paired {self} with when model {when_name}, {'using its projection' if self.projection != None else 'which has no projection'}.")
+
+    """
+        Get the projection when rows are built with: that of a given When model,
+        or if none is given, that of the when model the dataset is paired with.
+    """
+    def get_when_projection(self, when_model=None):
+        if when_model != None:
+            return when_model.projection
+        return self.projection
+
+    """
+        Get an entity's when dict, with its embeddings projected if there's a projection.
+    """
+    def get_projected_when_dict(self, entity, embedding_projection):
+        when_dict = entity.get_when_dict()
+        if embedding_projection == None:
+            return when_dict
+        return embedding_projection.transform_when_dict(when_dict, [att.name for att in entity.model.all_embedded_atts])
+
+    def get_when_embedding_dimension(self, att_name, embedding_projection):
+        if embedding_projection == None:
+            return self.embedding_model.dimension
+        return embedding_projection.get_dimension(att_name)
+
+    """
+        Get the stem attributes which go into the when model, as they're laid out by get_when_dict.
+    """
+    def get_when_stem_atts(self):
+        return [att for att in self.forum.stem.model.all_atts if att.in_when]
 
+    """
+        Merge the when dicts of the stems leading up to a point in a branch into one:
+        embeddings are averaged, and other values are taken from the last stem.
+        With no stems, every value is zeros.
+    """
+    def get_when_stem_dict(self, feature_stems, embedding_projection):
         stem_dict = {}
-        stem_atts = []
-        stem_bases = []
-        stem_mergers = []
-
-        #so damn janky
-        for att_class in self.entity_models['stem']['attributes'].values():
-            for att_model in att_class:
-                when_rep = att_model['when_rep']
-                if when_rep != 'none':
-                    stem_atts.append(att_model['name'])
-                    if when_rep == 'direct':
-                        stem_bases.append(np.array([0]))
-                    if when_rep == 'embeddings':
-                        stem_bases.append(np.zeros(self.embedding_model.dimension))
-                    stem_mergers.append(att_model['when_merger'])
-
-        for i in range(len(stem_bases)):
-            stem_dict[stem_atts[i]] = stem_bases[i]
-            for feature_stem in feature_stems:
-                if stem_mergers[i] == 'last':
-                    stem_dict[stem_atts[i]] = feature_stem[stem_atts[i]]
-                if stem_mergers[i] == 'average':
-                    stem_dict[stem_atts[i]] = stem_dict[stem_atts[i]] + (1 / len(feature_stems)) * feature_stem[stem_atts[i]]
+        for att in self.get_when_stem_atts():
+            if att.store_embeddings:
+                stem_dict[att.name] = np.zeros(self.get_when_embedding_dimension(att.name, embedding_projection), dtype=np.float32)
+                for feature_stem in feature_stems:
+                    stem_dict[att.name] = stem_dict[att.name] + (1 / len(feature_stems)) * feature_stem[att.name]
+            else:
+                stem_dict[att.name] = np.zeros(1, dtype=np.float32) if len(feature_stems) == 0 else feature_stems[-1][att.name]
+        return stem_dict
+
+    """
+        Concatenate a user, a branch's root, and the merged stems of the branch into a when row.
+    """
+    def get_when_features(self, user, branch_root, stems, start_time, end_time, embedding_projection):
+        user_dict = self.get_projected_when_dict(user, embedding_projection)
+        root_dict = self.get_projected_when_dict(branch_root, embedding_projection)
+        stem_dict = self.get_when_stem_dict([self.get_projected_when_dict(stem, embedding_projection) for stem in stems], embedding_projection)
 
         conc = lambda d: functools.reduce(lambda acc, i: np.concatenate((acc, i)), d.values(), np.array([]))
 
-        features = np.concatenate((conc(user_dict), conc(root_dict), conc(stem_dict), np.array([start_time, end_time])))
-        
-        label_stem_time = label_stem.get_att(self.entity_models['stem']['time_att'])
+        return np.concatenate((conc(user_dict), conc(root_dict), conc(stem_dict), np.array([start_time, end_time])))
+
+    """
+        Get a training row for a user and branch: the features of the branch up to its last stem,
+        labelled by whether the last stem was made between the start and end times.
+    """
+    def get_when_train_row(self, user, branch, start_time, end_time, when_model=None):
+        if len(branch.stems) < 1:
+            raise DatasetError(f"Error: cannot get a training row from a branch which has no stems.")
 
-        label = int(start_time < label_stem_time < end_time)
+        label_stem = branch.stems[-1]
+        features = self.get_when_features(user, branch.root, branch.stems[:-1], start_time, end_time, self.get_when_projection(when_model))
+        label = int(start_time < label_stem.get_time() < end_time)
 
         return features, label
 
-    def get_when_inference_row(self, user, branch, start_time, end_time):
-        user_dict = user.get_when_dict()
-        root_dict = branch.root.get_when_dict()
+    def get_when_inference_row(self, user, branch, start_time, end_time, when_model=None):
+        return self.get_when_features(user, branch.root, branch.stems, start_time, end_time, self.get_when_projection(when_model))
 
-        feature_stems = [stem.get_when_dict() for stem in branch.stems]
+    """
+        Get a mask of which columns of a user and branch's when rows hold embeddings,
+        laid out the same way as by get_when_features.
+    """
+    def get_when_embedded_mask(self, user, branch, when_model=None):
+        embedding_projection = self.get_when_projection(when_model)
 
-        stem_dict = {}
-        stem_atts = []
-        stem_bases = []
-        stem_mergers = []
-
-        #so damn janky
-        for att_class in self.entity_models['stem']['attributes'].values():
-            for att_model in att_class:
-                when_rep = att_model['when_rep']
-                if when_rep != 'none':
-                    stem_atts.append(att_model['name'])
-                    if when_rep == 'direct':
-                        stem_bases.append(np.array([0]))
-                    if when_rep == 'embeddings':
-                        stem_bases.append(np.zeros(self.embedding_model.dimension))
-                    stem_mergers.append(att_model['when_merger'])
-
-        for i in range(len(stem_bases)):
-            stem_dict[stem_atts[i]] = stem_bases[i]
-            for feature_stem in feature_stems:
-                if stem_mergers[i] == 'last':
-                    stem_dict[stem_atts[i]] = feature_stem[stem_atts[i]]
-                if stem_mergers[i] == 'average':
-                    stem_dict[stem_atts[i]] = stem_dict[stem_atts[i]] + (1 / len(feature_stems)) * feature_stem[stem_atts[i]]
-
-        conc = lambda d: functools.reduce(lambda acc, i: np.concatenate((acc, i)), d.values())
-
-        features = np.concatenate((conc(user_dict), conc(root_dict), conc(stem_dict), np.array([start_time, end_time])))
-
-        return features
-        
+        mask = []
+        for entity in [user, branch.root]:
+            embedded_att_names = [att.name for att in entity.model.all_embedded_atts]
+            for att_name, value in self.get_projected_when_dict(entity, embedding_projection).items():
+                mask += [att_name in embedded_att_names] * len(value)
 
-    def export_train_when(self, user_loader, branch_loader, interval=60):
-        start_time = max([root.get_time() for root in self.sf.iter_roots(branch_loader)])
-        end_time = max([node.get_time() for node in self.sf.iter_dfs(branch_loader)])
+        for att in self.get_when_stem_atts():
+            if att.store_embeddings:
+                mask += [True] * self.get_when_embedding_dimension(att.name, embedding_projection)
+            else:
+                mask.append(False)
 
-        feature_rows = []
-        label_rows = []
+        return np.array(mask + [False, False], dtype=bool)
 
-        for t in range(start_time, end_time, interval):
-            for user in self.user_pool.iterate(user_loader):
-                for branch in self.sf.iter_dfs_branches(branch_loader):
-                    if len(branch.stems)  > 0:
-                        features, label = self.get_when_train_row(user, branch, start_time, end_time)
-                        feature_rows.append(features)
-                        label_rows.append(label)
+    """
+        Get the path prefix the when model's training features are exported to.
+    """
+    def get_when_features_path(self):
+        return self.get_data_source_path("features")
         
-        features = np.array(feature_rows)
-        labels = np.array(label_rows)
+    """
+        Export training rows for the when model, pairing each user with each branch at every interval.
+        If candidate_k is given, users are only paired with branches under the roots of their
+        candidate_k closest branches in the candidate index, which are found once per user up front.
+        Embeddings are projected as in get_when_train_row, with a given When model's projection or the paired one.
+
+        Embeddings are loaded in the dataset's quantization mode. The user pool is loaded once and held,
+        and each tree is loaded once and paired with every user, at every interval, before moving on to the next,
+        so the export never holds more than the user pool and one tree of embeddings.
+        Rows are written one at a time into memory mapped files sized up front.
+        Columns holding embeddings are stored in the quantization mode, and the rest as float32,
+        until they're put back together by load_train_when.
+    """
+    def export_train_when(self, interval=60, candidate_k=None, when_model=None):
+        time_att = self.forum.root.time_att
+        start_time = max([root.get_time() for root in self.sf.iter_roots(load_sqlite=True, att_names=[time_att])])
+        end_time = max([node.get_time() for node in self.sf.iter_dfs(load_sqlite=True, att_names=[time_att])])
+
+        candidate_root_ids = {}
+        if candidate_k != None:
+            candidate_root_ids = {uid: self.get_candidate_root_ids(self.user_factory(uid), k=candidate_k) for uid in self.user_pool.get_uids()}
+
+        #every node but the root ends one branch with stems
+        branch_counts = {root.get_id(): len(list(root.iter_nodes())) - 1 for root in self.sf.get_roots()}
+        num_rows_per_interval = 0
+        for uid in self.user_pool.get_uids():
+            user_candidate_root_ids = candidate_root_ids.get(uid)
+            num_rows_per_interval += sum([count for root_id, count in branch_counts.items() if user_candidate_root_ids == None or root_id in user_candidate_root_ids])
+        num_rows = num_rows_per_interval * len(range(start_time, end_time, interval))
+
+        quantization_mode = "float32" if self.quantization_mode == None else self.quantization_mode
+        features_path = self.get_when_features_path()
+        labels = np.lib.format.open_memmap(self.get_data_source_path("labels.npy"), mode="w+", dtype=np.int64, shape=(num_rows,))
+
+        mask = None
+        embedded_features = None
+        direct_features = None
+        row = 0
+
+        users = list(self.user_pool.iterate(load_sqlite=True, load_chroma=True, quantization_mode=self.quantization_mode))
+        #only the trees some user is a candidate for are loaded, unless a user has no candidates and so is paired with every tree
+        root_ids = None
+        if candidate_k != None and not (None in candidate_root_ids.values()):
+            root_ids = set().union(*candidate_root_ids.values())
+
+        for branch in self.sf.iter_dfs_branches(load_sqlite=True, load_chroma=True, quantization_mode=self.quantization_mode, root_ids=root_ids):
+            if len(branch.stems) == 0:
+                continue
+            for user in users:
+                user_candidate_root_ids = candidate_root_ids.get(user.get_id())
+                if user_candidate_root_ids != None and not (branch.root.get_id() in user_candidate_root_ids):
+                    continue
+
+                #rows don't depend on the interval, so each is built once and written for every interval
+                features, label = self.get_when_train_row(user, branch, start_time, end_time, when_model=when_model)
+
+                if mask is None:
+                    mask = self.get_when_embedded_mask(user, branch, when_model=when_model)
+                    embedded_features = quantization.QuantizedMatrix.open_memmap(f"{features_path}.embedded", quantization_mode, (num_rows, int(mask.sum())))
+                    direct_features = np.lib.format.open_memmap(f"{features_path}.direct.npy", mode="w+", dtype=np.float32, shape=(num_rows, int((~mask).sum())))
+                if len(features) != len(mask):
+                    raise DatasetError(f"Error: got a when row with {len(features)} features, where the first had {len(mask)}.")
+
+                for t in range(start_time, end_time, interval):
+                    embedded_features.set_row(row, features[mask])
+                    direct_features[row] = features[~mask]
+                    labels[row] = label
+                    row += 1
+
+        if row != num_rows:
+            raise DatasetError(f"Error: exported {row} when rows, where {num_rows} were expected.")
+
+        if mask is None:
+            mask = np.zeros(0, dtype=bool)
+            embedded_features = quantization.QuantizedMatrix.open_memmap(f"{features_path}.embedded", quantization_mode, (0, 0))
+            direct_features = np.lib.format.open_memmap(f"{features_path}.direct.npy", mode="w+", dtype=np.float32, shape=(0, 0))
+
+        embedded_features.flush()
+        direct_features.flush()
+        labels.flush()
+        np.save(f"{features_path}.mask.npy", mask)
+        utils.write_json({"quantization_mode": quantization_mode, "num_rows": num_rows}, f"{features_path}.json")
+        self._print(f"Exported {num_rows} when rows, with {int(mask.sum())} embedding features stored as {quantization_mode}.")
+
+    """
+        Measure the size and accuracy of each quantization mode on a sample of up to
+        sample_size embeddings of each embedded attribute in the dataset, print it, and return it.
+    """
+    def quantization_report(self, sample_size=1000):
+        reports = {}
+        for entity_class in list(dict.fromkeys([self.forum.user, self.forum.root, self.forum.stem])):
+            model = entity_class.model
+            sample_ids = []
+            for sqlite_row in self.sqlite.iter_rows(model.table_name, [att for att in model.base.att_list if att.name == model.id_att], batch_size=sample_size):
+                sample_ids.append(sqlite_row[model.id_att])
+                if len(sample_ids) == sample_size:
+                    break
+
+            for att in model.all_embedded_atts:
+                if att.py_type in ["entity", "list(entity)"] or len(sample_ids) == 0:
+                    continue
+                embeddings, found = self.chroma.retrieve_many(att, sample_ids)
+                if not found.any():
+                    continue
+                report = quantization.tradeoff_report(embeddings[found])
+                quantization.print_tradeoff_report(report, title=f"Quantization tradeoffs for {att.name} of {model.table_name}, over {found.sum()} embeddings")
+                reports[(model.table_name, att.name)] = report
+
+        return reports
+
+    def get_embedded_att(self, entity_class, att_name):
+        matching_atts = [att for att in entity_class.model.all_embedded_atts if att.name == att_name]
+        if len(matching_atts) == 0:
+            raise DatasetError(f"Error: {entity_class.model.table_name} has no embedded attribute {att_name}.")
+        return matching_atts[0]
+
+    """
+        Build the approximate nearest neighbor index used to pick candidate branches for users,
+        over the root_att_name embeddings of the roots in the submission forest and the
+        stem_att_name embeddings of their stems, and save it to the dataset.
+        Each entry's id is a (root id, submission id) pair, so candidates can be traced to their tree.
+    """
+    def build_candidate_index(self, root_att_name="full_content", stem_att_name="text", num_lists=None, nprobe=8):
+        root_keys = []
+        stem_keys = []
+        for root in self.sf.get_roots():
+            for node in root.iter_nodes():
+                (root_keys if node.get_is_root() else stem_keys).append((root.get_id(), node.get_id()))
+
+        keys = []
+        matrices = []
+        for entity_class, att_name, entity_keys in [(self.forum.root, root_att_name, root_keys), (self.forum.stem, stem_att_name, stem_keys)]:
+            if len(entity_keys) == 0:
+                continue
+            embeddings, found = self.chroma.retrieve_many(self.get_embedded_att(entity_class, att_name), [sub_id for root_id, sub_id in entity_keys])
+            keys += [key for key, key_found in zip(entity_keys, found) if key_found]
+            matrices.append(embeddings[found])
+            self._print(f"Found embeddings for {found.sum()} of {len(entity_keys)} {entity_class.model.table_name} to index.")
+
+        index = ann_index.IVFIndex(num_lists=num_lists, nprobe=nprobe)
+        index.build(keys, np.concatenate(matrices) if len(matrices) > 0 else np.zeros((0, self.embedding_model.dimension), dtype=np.float32))
+        self.candidate_index = index
+
+        if not self.read_only:
+            index.save(self.candidate_index_path)
+
+        return index
+
+    """
+        Get the direction a user's interests lie in: the mean of the unit length embeddings
+        of their embedded when attributes (e.g. about), and of their history_limit most recent stems.
+        Returns None if none of them have embeddings.
+    """
+    def get_user_centroid(self, user, stem_att_name="text", history_limit=100):
+        vectors = []
+        for att in user.model.all_embedded_atts:
+            if att.in_when and not (att.py_type in ["entity", "list(entity)"]):
+                embeddings, found = self.chroma.retrieve_many(att, [user.get_id()])
+                vectors += list(embeddings[found])
+
+        submission_kind = getattr(self.forum.stem, "submission_kind", None)
+        if submission_kind != None:
+            stem_model = self.forum.stem.model
+            history_rows = self.sqlite.get_user_submissions(user.get_id(), submission_kind, stem_model.table_name, stem_model.id_att, limit=history_limit, att_model_list=[att for att in stem_model.base.att_list if att.name == stem_model.id_att])
+            if len(history_rows) > 0:
+                embeddings, found = self.chroma.retrieve_many(self.get_embedded_att(self.forum.stem, stem_att_name), [row[stem_model.id_att] for row in history_rows])
+                vectors += list(embeddings[found])
+
+        if len(vectors) == 0:
+            return None
+        return ann_index.normalize_rows(np.array(vectors)).mean(axis=0)
+
+    """
+        Get the (root id, submission id) pairs of the k branches closest to a user in the candidate index.
+        If the dataset has no candidate index, or the user has no embeddings to search with, returns None,
+        meaning every branch is a candidate.
+    """
+    def get_candidate_branches(self, user, k=100, nprobe=None):
+        if self.candidate_index == None:
+            return None
+        centroid = self.get_user_centroid(user)
+        if centroid is None:
+            return None
+        candidate_keys, scores = self.candidate_index.search(centroid, k, nprobe=nprobe)
+        return candidate_keys
+
+    def get_candidate_root_ids(self, user, k=100, nprobe=None):
+        candidate_keys = self.get_candidate_branches(user, k=k, nprobe=nprobe)
+        if candidate_keys == None:
+            return None
+        return set([root_id for root_id, sub_id in candidate_keys])
+
+    """
+        Measure the recall of the candidate index against brute force, searching with the
+        centroids of up to num_queries users in the user pool.
+    """
+    def measure_candidate_recall(self, k=100, nprobe=None, num_queries=100):
+        if self.candidate_index == None:
+            raise DatasetError(f"Error: cannot measure the recall of {self.name}'s candidate index, as it has none.")
+
+        centroids = [self.get_user_centroid(self.user_factory(uid)) for uid in self.user_pool.get_uids()[:num_queries]]
+        report = self.candidate_index.measure_recall([centroid for centroid in centroids if centroid is not None], k, nprobe=nprobe)
+        ann_index.print_recall_report(report)
+        return report
 
-        np.save(self.get_data_source_path("features.npy"), features) 
-        np.save(self.get_data_source_path("labels.npy"), labels)
+    """
+        Load the when model's training features and labels as exported by export_train_when,
+        dequantizing the embedding features chunk_size rows at a time as the float32 matrix is put back together.
+    """
+    def load_train_when(self, chunk_size=4096):
+        features_path = self.get_when_features_path()
+        features_info = utils.read_json(f"{features_path}.json")
+
+        mask = np.load(f"{features_path}.mask.npy")
+        embedded_features = quantization.QuantizedMatrix.load(f"{features_path}.embedded", features_info["quantization_mode"], mmap_mode="r")
+        direct_features = np.load(f"{features_path}.direct.npy", mmap_mode="r")
+
+        num_rows = features_info["num_rows"]
+        features = np.empty((num_rows, len(mask)), dtype=np.float32)
+        for start in range(0, num_rows, chunk_size):
+            rows = np.arange(start, min(start + chunk_size, num_rows))
+            features[start:start + len(rows), mask] = embedded_features.dequantize(rows)
+            features[start:start + len(rows), ~mask] = direct_features[start:start + len(rows)]
 
-    def load_train_when(self):
-        features = np.load(self.get_data_source_path("features.npy"))
         labels = np.load(self.get_data_source_path("labels.npy"))
         return features, labels
 
+    """
+        Add a list of users to the dataset given dicts of their base attributes,
+        storing them in sqlite with a single batched upsert.
+    """
+    def add_users(self, user_dicts):
+        id_att = self.forum.user.model.id_att
+        users = [self.user_factory(user_dict[id_att]) for user_dict in user_dicts]
+        for user, user_dict in zip(users, user_dicts):
+            user.base.fill_from_dict(user_dict)
+
+        entities.store_list_in_sqlite(users)
+
+        new_uids = [user.get_id() for user in users if not (user.get_id() in self.user_pool.get_uids())]
+        self.user_pool.add_uids(new_uids)
+        self.write_current_user_pool()
+
+    """
+        Generate or update the embeddings of every user in the user pool, batch_size users at a time,
+        with one batched embedding request per attribute per batch.
+    """
+    def embed_user_pool(self, batch_size=1000):
+        num_stored = entities.store_iter_in_chroma(self.user_pool.iterate(load_sqlite=True, batch_size=batch_size), batch_size=batch_size)
+        self._print(f"Stored embeddings for {num_stored} users.")
+
+    """
+        Generate or update the embeddings of every submission in the submission forest, the same way.
+    """
+    def embed_sf(self, batch_size=1000):
+        num_stored = entities.store_iter_in_chroma(self.sf.iter_dfs(load_sqlite=True, batch_size=batch_size), batch_size=batch_size)
+        self._print(f"Stored embeddings for {num_stored} submissions.")
+
+    """
+        Close the dataset's sqlite connection.
+    """
+    def close(self):
+        self.sqlite.close()
+        if self.embedding_cache != None:
+            self.embedding_cache.close()
+
     def get_data_source_path(self, filename):
         return self.dataset_path + "/" + filename
 
@@ -266,7 +606,24 @@ class Dataset:
 
 
     """
-        Get a cost estimate for creating embeddings for a list of dicts.
+        Get a cost estimate for creating embeddings of every embedded sqlite attribute
+        of every entity in the dataset, streaming each table and counting tokens batch_size rows at a time.
     """
-    def embedding_cost_estimate():
-        return
+    def embedding_cost_estimate(self, batch_size=1000, accrue=False):
+        cost_estimate = 0
+        for entity_class in list(dict.fromkeys([self.forum.user, self.forum.root, self.forum.stem])):
+            model = entity_class.model
+            embedded_atts = [att for att in model.base.embedded_list + model.generated.embedded_list if not (att.py_type in ["entity", "list(entity)"])]
+            if len(embedded_atts) == 0:
+                continue
+
+            documents = []
+            for sqlite_row in self.sqlite.iter_rows(model.table_name, embedded_atts, batch_size=batch_size):
+                documents += [("EMPTY" if sqlite_row[att.name] == "" else str(sqlite_row[att.name])) for att in embedded_atts if sqlite_row[att.name] != None]
+                if len(documents) >= batch_size:
+                    cost_estimate += self.embedding_model.estimate_batch_cost(documents, accrue=accrue)
+                    documents = []
+            if len(documents) > 0:
+                cost_estimate += self.embedding_model.estimate_batch_cost(documents, accrue=accrue)
+
+        return cost_estimate
@@ -17,7 +17,7 @@ import when
 class NewTests(unittest.TestCase):
     @classmethod
     def setupClass(cls):
-        cls.forum = entities.Forum(HN_entities.HNUser, HN_entities.HNPost, HN_entities.HNComment)
+        cls.forum = entities.Forum(HN_entities.HNUser, HN_entities.HNPost, HN_entities.HNComment, migrations=HN_entities.migrations)
         cls.test_dataset_name = utils.fetch_env_var("TEST_DATASET_NAME")
         cls.test_dataset = dataset.Dataset(cls.test_dataset_name, cls.forum)
 
@@ -92,44 +92,13 @@ class InitTests(unittest.TestCase):
         Test generating embeddings for the user pool.
     """
     def test_embed_up(self):
-        base_loader = entities.SqliteLoader("base")
-        gen_loader = entities.SqliteLoader("generated")
-        der_loader= HN_entities.HNSubmissionLoader()
-        sub_loader = entities.EntityLoader(base=base_loader, derived=der_loader, generated = gen_loader)
-        post_factory = lambda id_val: self.test_dataset.entity_factory("root", id_val, sub_loader)
-        comment_factory = lambda id_val: self.test_dataset.entity_factory("stem", id_val, sub_loader)
-        user_derived_loader = HN_entities.HNUserLoader(post_factory, comment_factory)
-        loader = entities.EntityLoader(base=base_loader, derived=user_derived_loader)
-
-        for user in self.test_dataset.user_pool.iterate(loader):
-            user.pupdate_in_chroma(embed_sub_his=True)
+        self.test_dataset.embed_user_pool()
 
     def test_embed_sf(self):
-        base_loader = entities.SqliteLoader("base")
-        gen_loader = entities.SqliteLoader("generated")
-
-        user_loader = entities.EntityLoader(base=base_loader)
-        user_factory = lambda uid: self.test_dataset.entity_factory("user", uid, user_loader)
-        derived_loader = HN_entities.HNSubmissionLoader()
-        
-        loader = entities.EntityLoader(base=base_loader, derived=derived_loader, generated=gen_loader)
-
-        for node in self.test_dataset.sf.iter_dfs(loader):
-            node.pupdate_in_chroma(embed_author=True)
-        
+        self.test_dataset.embed_sf()
 
     def test_load_up_embeddings(self):
-        base_loader = entities.SqliteLoader("base", embeddings=True)
-        gen_loader = entities.SqliteLoader('generated', embeddings=True)
-        user_loader = entities.EntityLoader(base=base_loader)
-        derived_loader = HN_entities.HNSubmissionLoader(embeddings=True, author_att_classes=[])
-        sub_loader = entities.EntityLoader(base=base_loader, derived=derived_loader)
-        post_factory = lambda id_val: self.test_dataset.entity_factory("root", id_val, sub_loader)
-        comment_factory = lambda id_val: self.test_dataset.entity_factory("stem", id_val, sub_loader)
-        derived_loader = HN_entities.HNUserLoader(post_factory, comment_factory, sub_att_classes=['base'], embeddings=True)
-        loader = entities.EntityLoader(base=base_loader, derived=derived_loader,generated=gen_loader)
-
-        for user in self.test_dataset.user_pool.iterate(loader):
+        for user in self.test_dataset.user_pool.iterate(load_sqlite=True, load_chroma=True):
             print(user.embeddings)
             for post in user.get_att("posts"):
                 print(post.embeddings)
@@ -435,14 +404,7 @@ class IterableTests(unittest.TestCase):
         print(f"test insertion number: {cls.insertion_num}")
 
     def test_up(self):
-        base_sqlite_loader = entities.SqliteLoader("base", embeddings=True)
-        sub_loader = entities.EntityLoader(base=base_sqlite_loader)
-        post_factory = lambda id_val: self.test_dataset.entity_factory("root", id_val, sub_loader)
-        comment_factory = lambda id_val: self.test_dataset.entity_factory("stem", id_val, sub_loader)
-        derived_user_loader =HN_entities.HNUserLoader(post_factory, comment_factory)
-        loader = entities.EntityLoader(base=base_sqlite_loader, derived=derived_user_loader)
-
-        for user in self.test_dataset.user_pool.iterate(loader):
+        for user in self.test_dataset.user_pool.iterate(load_sqlite=True):
             print(user.get_att("username"))
 
     def test_sf(self):
@@ -461,13 +423,7 @@ class IterableTests(unittest.TestCase):
             print(submission.get_att("id"))
 
     def test_sf_branch(self):
-        base_sqlite_loader = entities.SqliteLoader("base", embeddings=True)
-        user_loader = entities.EntityLoader(base=base_sqlite_loader)
-        user_factory = lambda uid: self.test_dataset.entity_factory("user", uid, user_loader)
-        derived_loader = HN_entities.HNSubmissionLoader(user_factory)
-        loader = entities.EntityLoader(base=base_sqlite_loader, derived=derived_loader)
-
-        sf_iterable = self.test_dataset.sf.iter_dfs_branches(loader)
+        sf_iterable = self.test_dataset.sf.iter_dfs_branches(load_sqlite=True, load_chroma=True)
 
         for branch in sf_iterable:
             print("BRANCH")
@@ -644,25 +600,7 @@ class WhenTests(unittest.TestCase):
         model.save_ds_train_data(self.test_dataset, user_loader, branch_loader)
 
     def test_export_npy(self):
-        base_loader = entities.SqliteLoader("base", embeddings=True)
-        gen_loader = entities.SqliteLoader('generated', embeddings=True)
-        user_loader = entities.EntityLoader(base=base_loader)
-        derived_loader = HN_entities.HNSubmissionLoader(embeddings=True, author_att_classes=[])
-        sub_loader = entities.EntityLoader(base=base_loader, derived=derived_loader, generated=gen_loader)
-        post_factory = lambda id_val: self.test_dataset.entity_factory("root", id_val, sub_loader)
-        comment_factory = lambda id_val: self.test_dataset.entity_factory("stem", id_val, sub_loader)
-        derived_loader = HN_entities.HNUserLoader(post_factory, comment_factory, sub_att_classes=['base', 'generated'], embeddings=True)
-
-        user_loader = entities.EntityLoader(base=base_loader, derived=derived_loader,generated=gen_loader)
-
-
-        user_loader = entities.EntityLoader(base=base_loader)
-        user_factory = lambda uid: self.test_dataset.entity_factory("user", uid, user_loader)
-        derived_loader = HN_entities.HNSubmissionLoader(user_factory=user_factory, embeddings=True, author_att_classes=['base', 'derived', 'generated'])
-        
-        branch_loader = entities.EntityLoader(base=base_loader, derived=derived_loader, generated=gen_loader)
-
-        self.test_dataset.export_train_when(user_loader, branch_loader)
+        self.test_dataset.export_train_when()
 
     def test_xgboost(self):
         features, labels = self.test_dataset.load_train_when()
@@ -0,0 +1,96 @@
+"""
+    A content addressed cache of embeddings, so that a document which has been embedded before,
+    in any entity of any dataset, is never embedded and paid for again.
+"""
+
+import numpy as np
+
+import sqlite3
+import hashlib
+import pathlib
+import threading
+
+import utils
+from sqlite_db import SQLITE_MAX_VARIABLES
+
+"""
+    Get the key a document is cached under: the sha256 of its text.
+"""
+def get_document_hash(document):
+    return hashlib.sha256(document.encode("utf-8")).hexdigest()
+
+"""
+    Get the path of the cache shared by every dataset, in the root dataset directory.
+"""
+def get_shared_cache_path():
+    return utils.fetch_env_var("ROOT_DATASET_DIR") + "embedding_cache.db"
+
+"""
+    The cache itself, a sqlite database of float32 embeddings keyed by (embedding model key, document hash).
+    One connection is shared behind a lock, so the cache can be used from any thread,
+    and it's in WAL mode so that processes working on different datasets can share it.
+    If read_only is set, the cache is opened read only, for read only datasets,
+    and embeddings put in it are dropped.
+"""
+class EmbeddingCache:
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.lock = threading.Lock()
+
+        if self.read_only:
+            uri = pathlib.Path(self.path).absolute().as_uri() + "?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self.conn.execute("PRAGMA busy_timeout = 5000")
+            return
+
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA busy_timeout = 5000")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT,
+                hash TEXT,
+                embedding BLOB,
+                PRIMARY KEY (model, hash)
+            )
+        """)
+        self.conn.commit()
+
+    """
+        Get the cached embeddings for a list of document hashes, as a dict keyed by hash.
+        Hashes which aren't cached are left out.
+    """
+    def get_many(self, model_key, hashes):
+        unique_hashes = list(dict.fromkeys(hashes))
+
+        embeddings = {}
+        with self.lock:
+            for i in range(0, len(unique_hashes), SQLITE_MAX_VARIABLES - 1):
+                chunk = unique_hashes[i:i + SQLITE_MAX_VARIABLES - 1]
+                rows = self.conn.execute(f"""
+                    SELECT hash, embedding FROM embeddings WHERE model = ? AND hash IN ({', '.join(['?' for hash_val in chunk])})
+                """, (model_key, *chunk)).fetchall()
+                for hash_val, embedding in rows:
+                    embeddings[hash_val] = np.frombuffer(embedding, dtype=np.float32)
+
+        return embeddings
+
+    """
+        Cache embeddings for a list of document hashes.
+    """
+    def put_many(self, model_key, hashes, embeddings):
+        if self.read_only:
+            return
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self.lock:
+            self.conn.executemany("""
+                INSERT OR REPLACE INTO embeddings (model, hash, embedding) VALUES (?, ?, ?)
+            """, [(model_key, hash_val, embedding.tobytes()) for hash_val, embedding in zip(hashes, embeddings)])
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
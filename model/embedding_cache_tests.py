@@ -0,0 +1,79 @@
+"""
+    Tests for the content addressed embedding cache.
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+
+import numpy as np
+
+import embedding_cache
+
+class EmbeddingCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir_path, "cache.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def test_put_get(self):
+        cache = embedding_cache.EmbeddingCache(self.path)
+        hashes = [embedding_cache.get_document_hash(document) for document in ["first", "second"]]
+        cache.put_many("model", hashes, np.array([[1, 2], [3, 4]], dtype=np.float32))
+
+        cached = cache.get_many("model", hashes + [embedding_cache.get_document_hash("third")])
+        cache.close()
+
+        self.assertEqual(sorted(cached.keys()), sorted(hashes))
+        np.testing.assert_array_equal(cached[hashes[1]], [3, 4])
+
+    """
+        The same document embedded by different model configs is cached separately.
+    """
+    def test_model_keys(self):
+        cache = embedding_cache.EmbeddingCache(self.path)
+        hash_val = embedding_cache.get_document_hash("document")
+        cache.put_many("small", [hash_val], np.array([[1, 1]]))
+        cache.put_many("large", [hash_val], np.array([[2, 2, 2]]))
+
+        self.assertEqual(len(cache.get_many("small", [hash_val])[hash_val]), 2)
+        self.assertEqual(len(cache.get_many("large", [hash_val])[hash_val]), 3)
+        self.assertEqual(cache.get_many("other", [hash_val]), {})
+        cache.close()
+
+    """
+        Lookups of more hashes than sqlite allows variables in one statement are chunked.
+    """
+    def test_many_hashes(self):
+        cache = embedding_cache.EmbeddingCache(self.path)
+        hashes = [embedding_cache.get_document_hash(str(i)) for i in range(2000)]
+        cache.put_many("model", hashes, np.arange(2000, dtype=np.float32)[:, np.newaxis])
+
+        cached = cache.get_many("model", hashes)
+        cache.close()
+
+        self.assertEqual(len(cached), 2000)
+        self.assertEqual(float(cached[hashes[1999]][0]), 1999.0)
+
+    """
+        A cache opened read only serves what's there, and drops puts.
+    """
+    def test_read_only(self):
+        cache = embedding_cache.EmbeddingCache(self.path)
+        hash_val = embedding_cache.get_document_hash("document")
+        cache.put_many("model", [hash_val], np.array([[1, 2]]))
+        cache.close()
+
+        read_only_cache = embedding_cache.EmbeddingCache(self.path, read_only=True)
+        other_hash = embedding_cache.get_document_hash("other")
+        read_only_cache.put_many("model", [other_hash], np.array([[3, 4]]))
+
+        self.assertEqual(list(read_only_cache.get_many("model", [hash_val, other_hash]).keys()), [hash_val])
+        read_only_cache.close()
+
+if __name__ == '__main__':
+    unittest.main()
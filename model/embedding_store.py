@@ -0,0 +1,452 @@
+"""
+    A local embedding store, to be used in place of the Chroma database when
+    all that's needed is looking up embeddings by id, as in training and simulation.
+"""
+
+import numpy as np
+
+import json
+import os
+import threading
+
+import utils
+from embedding_cache import get_document_hash
+from chroma_db import ChromaError, EmbeddingsNotFoundError, GenerateNullEmbeddingsError, CHROMA_GET_CHUNK_SIZE, get_collection_name, get_chunk_collection_name, get_chunk_id, embed_documents
+
+"""
+    How many rows a collection's matrix is created with, doubled whenever it fills.
+"""
+INITIAL_CAPACITY = 1024
+
+"""
+    One collection of the store, holding the embeddings of one attribute of one entity.
+
+    The embeddings are rows of a float32 .npy file, opened as a memory map,
+    so that loading is zero-copy and every process reading the same store shares the OS page cache.
+    Rows are only ever appended: an update writes a new row and points the id at it,
+    so a row never changes under a reader. Rows left unused are reclaimed by compact().
+
+    Which row belongs to which id is kept in a snapshot of three memory mapped .npy arrays,
+    the ids sorted, and each one's row and the hash of its embedded document, looked up by binary search.
+    Changes since the snapshot are kept in an append only log, which is replayed on open into a dict
+    consulted before the snapshot, and folded into a new snapshot on compact().
+    Only hashes of documents are kept, which is all that's needed to tell when an embedding is stale.
+"""
+class EmbeddingCollection:
+    def __init__(self, path, name, dimension, read_only=False):
+        self.name = name
+        self.dimension = dimension
+        self.read_only = read_only
+
+        self.matrix_path = os.path.join(path, f"{name}.npy")
+        self.ids_path = os.path.join(path, f"{name}.ids.npy")
+        self.rows_path = os.path.join(path, f"{name}.rows.npy")
+        self.hashes_path = os.path.join(path, f"{name}.hashes.npy")
+        self.log_path = os.path.join(path, f"{name}.log.jsonl")
+
+        self.snapshot_ids = None
+        self.snapshot_rows = None
+        self.snapshot_hashes = None
+        self.changes = {}
+        self.num_rows = 0
+
+        if not utils.check_file_exists(self.matrix_path):
+            if self.read_only:
+                raise ChromaError(f"Error: embedding collection {name} does not exist, and cannot be created in read only mode.")
+            self.create()
+
+        self.load_index()
+        self.matrix = np.load(self.matrix_path, mmap_mode="r" if self.read_only else "r+")
+
+    def create(self):
+        matrix = np.lib.format.open_memmap(self.matrix_path, mode="w+", dtype=np.float32, shape=(INITIAL_CAPACITY, self.dimension))
+        matrix.flush()
+        del matrix
+        self.write_index([], [], [])
+
+    """
+        Open the index snapshot, then replay the log on top of it.
+    """
+    def load_index(self):
+        self.snapshot_ids = np.load(self.ids_path, mmap_mode="r")
+        self.snapshot_rows = np.load(self.rows_path, mmap_mode="r")
+        self.snapshot_hashes = np.load(self.hashes_path, mmap_mode="r")
+        self.changes = {}
+        self.num_rows = int(self.snapshot_rows.max()) + 1 if len(self.snapshot_rows) > 0 else 0
+
+        if utils.check_file_exists(self.log_path):
+            with open(self.log_path, "r") as log_file:
+                for line in log_file:
+                    if line.strip() == "":
+                        continue
+                    self.apply_log_entry(json.loads(line))
+
+    """
+        Record a change in the dict of changes since the snapshot, a deleted id being kept as None.
+    """
+    def apply_log_entry(self, entry):
+        if entry["op"] == "put":
+            self.changes[entry["id"]] = (entry["row"], entry["hash"])
+            self.num_rows = max(self.num_rows, entry["row"] + 1)
+        elif entry["op"] == "delete":
+            self.changes[entry["id"]] = None
+
+    """
+        Write a new index snapshot from lists of ids, rows and hashes, and clear the log.
+    """
+    def write_index(self, ids, rows, hashes):
+        order = np.argsort(np.array(ids, dtype=str), kind="stable")
+        arrays = [
+            (self.ids_path, np.array(ids, dtype=str)[order]),
+            (self.rows_path, np.array(rows, dtype=np.int64)[order]),
+            (self.hashes_path, np.array(hashes, dtype="S64")[order])
+        ]
+        for array_path, array in arrays:
+            temp_path = f"{array_path}.tmp.npy"
+            np.save(temp_path, array)
+            os.replace(temp_path, array_path)
+
+        if utils.check_file_exists(self.log_path):
+            os.remove(self.log_path)
+        self.changes = {}
+
+    def append_log(self, entries):
+        with open(self.log_path, "a") as log_file:
+            for entry in entries:
+                log_file.write(json.dumps(entry) + "\n")
+
+    """
+        Find the position of each of a list of ids in the snapshot, -1 for those not in it.
+    """
+    def find_in_snapshot(self, ids):
+        if len(ids) == 0 or len(self.snapshot_ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+
+        ids = np.array(ids, dtype=str)
+        positions = np.minimum(np.searchsorted(self.snapshot_ids, ids), len(self.snapshot_ids) - 1)
+        return np.where(self.snapshot_ids[positions] == ids, positions, -1)
+
+    """
+        Get the row and document hash of an id, or None if it has no embedding.
+    """
+    def get_entry(self, id_val):
+        if id_val in self.changes:
+            return self.changes[id_val]
+
+        position = self.find_in_snapshot([id_val])[0]
+        if position == -1:
+            return None
+        return int(self.snapshot_rows[position]), self.snapshot_hashes[position].decode()
+
+    def contains(self, id_val):
+        return self.get_entry(id_val) != None
+
+    """
+        Get the rows of a list of ids, -1 for those without embeddings.
+    """
+    def get_rows(self, ids):
+        positions = self.find_in_snapshot(ids)
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        rows[positions != -1] = self.snapshot_rows[positions[positions != -1]]
+        for i, id_val in enumerate(ids):
+            if id_val in self.changes:
+                rows[i] = -1 if self.changes[id_val] == None else self.changes[id_val][0]
+        return rows
+
+    """
+        Get the hashes of the documents embedded for a list of ids, as a dict keyed by id,
+        with ids without embeddings left out.
+    """
+    def get_hashes(self, ids):
+        hashes = {}
+        for id_val in ids:
+            entry = self.get_entry(id_val)
+            if entry != None:
+                hashes[id_val] = entry[1]
+        return hashes
+
+    """
+        Get the ids, rows and hashes of every embedding in use, as three lists.
+    """
+    def get_live_entries(self):
+        live_ids = []
+        live_rows = []
+        live_hashes = []
+        for id_val, row, document_hash in zip(self.snapshot_ids, self.snapshot_rows, self.snapshot_hashes):
+            id_val = str(id_val)
+            if not (id_val in self.changes):
+                live_ids.append(id_val)
+                live_rows.append(int(row))
+                live_hashes.append(document_hash.decode())
+        for id_val, entry in self.changes.items():
+            if entry != None:
+                live_ids.append(id_val)
+                live_rows.append(entry[0])
+                live_hashes.append(entry[1])
+        return live_ids, live_rows, live_hashes
+
+    """
+        Make sure the matrix has room for a number of rows past the ones in use,
+        doubling its capacity into a new file if not.
+    """
+    def reserve(self, num_new_rows):
+        capacity = self.matrix.shape[0]
+        if self.num_rows + num_new_rows <= capacity:
+            return
+
+        while self.num_rows + num_new_rows > capacity:
+            capacity *= 2
+
+        temp_path = f"{self.matrix_path}.tmp"
+        new_matrix = np.lib.format.open_memmap(temp_path, mode="w+", dtype=np.float32, shape=(capacity, self.dimension))
+        new_matrix[:self.num_rows] = self.matrix[:self.num_rows]
+        new_matrix.flush()
+        del new_matrix
+
+        del self.matrix
+        os.replace(temp_path, self.matrix_path)
+        self.matrix = np.load(self.matrix_path, mmap_mode="r+")
+
+    """
+        Write embeddings for a list of ids to new rows, pointing the ids at them,
+        and recording the hashes of the documents they were made from.
+    """
+    def put(self, ids, documents, embeddings):
+        self.reserve(len(ids))
+
+        start_row = self.num_rows
+        self.matrix[start_row:start_row + len(ids)] = embeddings
+        self.matrix.flush()
+
+        entries = [{"op": "put", "id": id_val, "row": start_row + i, "hash": get_document_hash(document)} for i, (id_val, document) in enumerate(zip(ids, documents))]
+        self.append_log(entries)
+        for entry in entries:
+            self.apply_log_entry(entry)
+
+    def remove(self, ids):
+        entries = [{"op": "delete", "id": id_val} for id_val in ids if self.contains(id_val)]
+        self.append_log(entries)
+        for entry in entries:
+            self.apply_log_entry(entry)
+
+    """
+        Rewrite the matrix with only the rows in use, and fold the log into a new index snapshot.
+    """
+    def compact(self):
+        live_ids, live_rows, live_hashes = self.get_live_entries()
+
+        temp_path = f"{self.matrix_path}.tmp"
+        new_matrix = np.lib.format.open_memmap(temp_path, mode="w+", dtype=np.float32, shape=(max(len(live_ids), INITIAL_CAPACITY), self.dimension))
+        if len(live_rows) > 0:
+            new_matrix[:len(live_rows)] = self.matrix[live_rows]
+        new_matrix.flush()
+        del new_matrix
+
+        del self.matrix
+        os.replace(temp_path, self.matrix_path)
+        self.matrix = np.load(self.matrix_path, mmap_mode="r+")
+
+        self.snapshot_ids = None
+        self.snapshot_rows = None
+        self.snapshot_hashes = None
+        self.write_index(live_ids, list(range(len(live_ids))), live_hashes)
+        self.load_index()
+
+"""
+    A store with the same interface as ChromaDB, keeping one EmbeddingCollection per embedded attribute,
+    in a directory at the given path. Embeddings are computed in batches, and over-long documents
+    chunked, the same way as ChromaDB.generate.
+
+    Unlike chroma, generate overwrites the embeddings of ids already present rather than skipping them.
+    Only one process should write to a store at a time; any number can read it,
+    seeing the state as of when they opened it.
+"""
+class EmbeddingStore:
+    def __init__(self, path, forum, embedding_model, read_only=False):
+        self.path = path
+        self.embedding_model = embedding_model
+        self.read_only = read_only
+
+        self.collections = {}
+        self.write_lock = threading.RLock()
+
+        if not utils.check_directory_exists(self.path):
+            if self.read_only:
+                raise ChromaError(f"Error: cannot open embedding store at {self.path} in read only mode, as it does not exist.")
+            utils.create_directory(self.path)
+
+        self.check_update_collections(forum)
+
+    """
+        Open a collection for every embedded attribute of the forum's entities, creating any missing.
+    """
+    def check_update_collections(self, forum):
+        for entity_model in forum.get_entity_models():
+            for att in entity_model.all_embedded_atts:
+                self.collections[(entity_model.table_name, att.name)] = EmbeddingCollection(self.path, get_collection_name(entity_model.table_name, att.name), self.embedding_model.dimension, read_only=self.read_only)
+
+    """
+        Get the chunk collection of a given attribute for a given entity, opening or creating it on first use.
+    """
+    def get_chunk_collection(self, table_name, att_name):
+        chunk_att_name = f"{att_name}_chunks"
+        with self.write_lock:
+            if not ((table_name, chunk_att_name) in self.collections):
+                self.collections[(table_name, chunk_att_name)] = EmbeddingCollection(self.path, get_chunk_collection_name(table_name, att_name), self.embedding_model.dimension, read_only=self.read_only)
+            return self.collections[(table_name, chunk_att_name)]
+
+    """
+        Get the ids of the chunks stored for an id's document, in order.
+    """
+    def get_chunk_ids(self, chunk_collection, id_val):
+        chunk_ids = []
+        while chunk_collection.contains(get_chunk_id(id_val, len(chunk_ids))):
+            chunk_ids.append(get_chunk_id(id_val, len(chunk_ids)))
+        return chunk_ids
+
+    """
+        Retrieve the chunk embeddings of a given id's document the same way as ChromaDB.retrieve_chunks,
+        but with the hashes of the chunks' texts in place of the texts.
+    """
+    def retrieve_chunks(self, att_model, id_val):
+        chunk_collection = self.get_chunk_collection(att_model.table_name, att_model.name)
+
+        chunk_ids = self.get_chunk_ids(chunk_collection, str(id_val))
+        if len(chunk_ids) == 0:
+            raise EmbeddingsNotFoundError(f"Error: chunk embeddings for attribute {att_model.name} of {att_model.table_name} with id {id_val} not found.")
+
+        return {'embeddings': np.array(chunk_collection.matrix[chunk_collection.get_rows(chunk_ids)]), 'hashes': [chunk_collection.get_entry(chunk_id)[1] for chunk_id in chunk_ids]}
+
+    def get_collection(self, table_name, att_name):
+        if not ((table_name, att_name) in self.collections):
+            raise ChromaError(f"Error: no embedding collection for attribute {att_name} of {table_name}.")
+        return self.collections[(table_name, att_name)]
+
+    """
+        Generate embeddings for a given attribute of a given entity type,
+        given an id list and a value list
+    """
+    def generate(self, att_model, id_list, value_list, update=False):
+        if self.read_only:
+            raise ChromaError(f"Error: attempted to generate embeddings for {att_model.name} in a read only embedding store.")
+
+        documents = [val for val in value_list]
+        ids = [str(id_val) for id_val in id_list]
+
+        if len(documents) != len(ids):
+            raise ChromaError("Error creating embeddings: provided list of documents differs in length from list of ids.")
+        if len(documents) == 0:
+            raise GenerateNullEmbeddingsError(f"Attempted to create embeddings for {att_model.name} for ids {ids} with empty list of documents.")
+        for doc in documents:
+            if doc == None:
+                raise GenerateNullEmbeddingsError(f"Error: attempted to generate embeddings for unfilled attribute for {att_model.name} for ids {ids}.")
+
+        documents = [("EMPTY" if doc == "" else doc) for doc in documents]
+
+        token_counts = self.embedding_model.tokenize_batch(documents)
+
+        collection = self.get_collection(att_model.table_name, att_model.name)
+
+        if update:
+            missing_ids = [id_val for id_val in ids if not collection.contains(id_val)]
+            if len(missing_ids) > 0:
+                raise EmbeddingsNotFoundError(f"Error: attempted to update embeddings for attribute {att_model.name} of {att_model.table_name} with ids {missing_ids}, which are not present.")
+
+        def write_documents(batch, embeddings):
+            with self.write_lock:
+                collection.put([ids[i] for i in batch], [documents[i] for i in batch], embeddings)
+                if update and self.embedding_model.long_document_mode == "chunk":
+                    chunk_collection = self.get_chunk_collection(att_model.table_name, att_model.name)
+                    for i in batch:
+                        if token_counts[i] <= self.embedding_model.max_tokens:
+                            chunk_collection.remove(self.get_chunk_ids(chunk_collection, ids[i]))
+
+        def write_chunks(i, chunk_texts, chunk_embeddings):
+            chunk_collection = self.get_chunk_collection(att_model.table_name, att_model.name)
+            with self.write_lock:
+                chunk_collection.remove(self.get_chunk_ids(chunk_collection, ids[i]))
+                chunk_collection.put([get_chunk_id(ids[i], k) for k in range(len(chunk_texts))], chunk_texts, chunk_embeddings)
+
+        failed = embed_documents(self.embedding_model, documents, token_counts, ids, write_documents, write_chunks)
+
+        if len(failed) > 0:
+            raise ChromaError(f"Error: failed to generate embeddings for attribute {att_model.name} of {att_model.table_name} with ids {[ids[i] for i in failed]}.")
+
+    """
+        The store keeps only hashes of the embedded documents, see retrieve_value_hashes.
+    """
+    def retrieve_values(self, att_model, id_list, chunk_size=CHROMA_GET_CHUNK_SIZE):
+        raise ChromaError(f"Error: the embedding store does not keep the documents embedded for {att_model.name} of {att_model.table_name}, only their hashes.")
+
+    """
+        Get the hashes of the documents currently embedded for a list of ids, as a dict keyed by id,
+        the same way as ChromaDB.retrieve_value_hashes.
+    """
+    def retrieve_value_hashes(self, att_model, id_list, chunk_size=CHROMA_GET_CHUNK_SIZE):
+        collection = self.get_collection(att_model.table_name, att_model.name)
+        return collection.get_hashes([str(id_val) for id_val in id_list])
+
+    """
+        Retrieve embeddings for a given id, along with the hash of the document they were made from
+    """
+    def retrieve(self, att_model, id_val):
+        collection = self.get_collection(att_model.table_name, att_model.name)
+
+        entry = collection.get_entry(str(id_val))
+        if entry == None:
+            raise EmbeddingsNotFoundError(f"Error: embeddings for attribute {att_model.name} of {att_model.table_name} with id {id_val} not found.")
+
+        return {'embeddings': np.array(collection.matrix[entry[0]]), 'hash': entry[1]}
+
+    """
+        Retrieve the embeddings of a given attribute for a list of ids, the same way as ChromaDB.retrieve_many:
+        a float32 matrix in the order requested, and a mask of which ids were found.
+    """
+    def retrieve_many(self, att_model, id_list, chunk_size=CHROMA_GET_CHUNK_SIZE):
+        collection = self.get_collection(att_model.table_name, att_model.name)
+
+        rows = collection.get_rows([str(id_val) for id_val in id_list])
+        found = rows != -1
+
+        embeddings = np.zeros((len(id_list), self.embedding_model.dimension), dtype=np.float32)
+        if found.any():
+            embeddings[found] = collection.matrix[rows[found]]
+
+        return embeddings, found
+
+    """
+        Get the whole matrix of a given attribute's embeddings, without copying,
+        along with a dict from id to row. Rows not in the dict are unused.
+    """
+    def get_embedding_matrix(self, att_model):
+        collection = self.get_collection(att_model.table_name, att_model.name)
+        live_ids, live_rows, live_hashes = collection.get_live_entries()
+        return collection.matrix[:collection.num_rows], dict(zip(live_ids, live_rows))
+
+    def delete(self, att_model, id_list):
+        if self.read_only:
+            raise ChromaError(f"Error: attempted to delete embeddings for {att_model.name} in a read only embedding store.")
+
+        collection = self.get_collection(att_model.table_name, att_model.name)
+        with self.write_lock:
+            collection.remove([str(id_val) for id_val in id_list])
+
+        if self.embedding_model.long_document_mode == "chunk":
+            chunk_collection = self.get_chunk_collection(att_model.table_name, att_model.name)
+            with self.write_lock:
+                for id_val in id_list:
+                    chunk_collection.remove(self.get_chunk_ids(chunk_collection, str(id_val)))
+
+    def update(self, att_model, id_list, value_list):
+        self.generate(att_model, id_list, value_list, update=True)
+
+    """
+        Compact every collection, reclaiming the rows of updated and deleted embeddings.
+    """
+    def compact(self):
+        if self.read_only:
+            raise ChromaError("Error: attempted to compact a read only embedding store.")
+
+        with self.write_lock:
+            for collection in self.collections.values():
+                collection.compact()
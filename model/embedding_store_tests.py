@@ -0,0 +1,143 @@
+"""
+    Unit tests for the memory mapped embedding store,
+    run offline with the local embedding model.
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+
+import numpy as np
+
+import entities
+import embeddings
+import embedding_store
+import chroma_db
+from embedding_cache import get_document_hash
+from sqlite_db_tests import User, Post, Comment
+
+def get_local_model():
+    return embeddings.LocalEmbeddingModel({"name": "local", "max_tokens": 8191, "input_token_cost": 0, "dimension": 16, "num_features": 256, "seed": 0})
+
+def get_text_att():
+    return Comment.model.base.att_list[3]
+
+class EmbeddingStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir_path, "store")
+        self.forum = entities.Forum(User, Post, Comment)
+        self.embedding_model = get_local_model()
+        self.store = embedding_store.EmbeddingStore(self.path, self.forum, self.embedding_model)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def reopen(self, read_only=True):
+        return embedding_store.EmbeddingStore(self.path, self.forum, get_local_model(), read_only=read_only)
+
+    def test_put(self):
+        self.store.generate(get_text_att(), [1, 2], ["first", ""])
+
+        retrieved = self.store.retrieve(get_text_att(), 1)
+
+        np.testing.assert_allclose(retrieved['embeddings'], self.embedding_model.embed_batch(["first"])[0], rtol=1e-5, atol=1e-6)
+        self.assertEqual(retrieved['hash'], get_document_hash("first"))
+        self.assertEqual(self.store.retrieve_value_hashes(get_text_att(), [1, 2, 3]), {"1": get_document_hash("first"), "2": chroma_db.get_value_hash("")})
+
+    """
+        An update points the id at a new row, leaving the old one for compaction,
+        and updating an id with no embedding raises.
+    """
+    def test_update(self):
+        self.store.generate(get_text_att(), [1], ["first"])
+        self.store.update(get_text_att(), [1], ["changed"])
+
+        self.assertEqual(self.store.retrieve(get_text_att(), 1)['hash'], get_document_hash("changed"))
+        self.assertEqual(self.store.get_collection("comments", "text").num_rows, 2)
+        with self.assertRaises(chroma_db.EmbeddingsNotFoundError):
+            self.store.update(get_text_att(), [2], ["missing"])
+
+    def test_delete(self):
+        self.store.generate(get_text_att(), [1, 2], ["first", "second"])
+        self.store.delete(get_text_att(), [1, 3])
+
+        with self.assertRaises(chroma_db.EmbeddingsNotFoundError):
+            self.store.retrieve(get_text_att(), 1)
+        self.assertEqual(self.store.retrieve_value_hashes(get_text_att(), [1, 2]), {"2": get_document_hash("second")})
+
+    """
+        A store reopened before compaction replays its log to the same state.
+    """
+    def test_reopen_from_log(self):
+        self.store.generate(get_text_att(), [1, 2, 3], ["first", "second", "third"])
+        self.store.update(get_text_att(), [2], ["changed"])
+        self.store.delete(get_text_att(), [3])
+        expected, expected_found = self.store.retrieve_many(get_text_att(), [1, 2, 3])
+
+        reopened = self.reopen()
+        embeddings, found = reopened.retrieve_many(get_text_att(), [1, 2, 3])
+
+        np.testing.assert_array_equal(embeddings, expected)
+        np.testing.assert_array_equal(found, [True, True, False])
+        self.assertEqual(reopened.retrieve(get_text_att(), 2)['hash'], get_document_hash("changed"))
+        with self.assertRaises(chroma_db.ChromaError):
+            reopened.generate(get_text_att(), [4], ["fourth"])
+
+    """
+        Compaction drops unused rows and the log, keeping every live embedding,
+        and the store keeps accepting writes after it.
+    """
+    def test_compact(self):
+        self.store.generate(get_text_att(), [1, 2, 3], ["first", "second", "third"])
+        self.store.update(get_text_att(), [2], ["changed"])
+        self.store.delete(get_text_att(), [1])
+        expected, expected_found = self.store.retrieve_many(get_text_att(), [1, 2, 3])
+
+        self.store.compact()
+        collection = self.store.get_collection("comments", "text")
+
+        self.assertEqual(collection.num_rows, 2)
+        self.assertFalse(os.path.exists(collection.log_path))
+        for store in [self.store, self.reopen()]:
+            embeddings, found = store.retrieve_many(get_text_att(), [1, 2, 3])
+            np.testing.assert_array_equal(embeddings, expected)
+            np.testing.assert_array_equal(found, expected_found)
+
+        self.store.generate(get_text_att(), [4], ["fourth"])
+        self.assertEqual(self.reopen().retrieve(get_text_att(), 4)['hash'], get_document_hash("fourth"))
+
+    """
+        The matrix grows past its initial capacity without losing rows.
+    """
+    def test_grow(self):
+        num_ids = embedding_store.INITIAL_CAPACITY + 10
+        ids = list(range(num_ids))
+        self.store.generate(get_text_att(), ids, [f"comment {i}" for i in ids])
+
+        embeddings, found = self.reopen().retrieve_many(get_text_att(), [0, num_ids - 1])
+
+        self.assertTrue(found.all())
+        np.testing.assert_allclose(embeddings, self.embedding_model.embed_batch(["comment 0", f"comment {num_ids - 1}"]), rtol=1e-5, atol=1e-6)
+
+    """
+        retrieve_many returns the same matrix and mask as chroma for the same documents,
+        including repeated and missing ids.
+    """
+    def test_retrieve_many_matches_chroma(self):
+        chroma = chroma_db.ChromaDB(os.path.join(self.dir_path, "chroma"), self.forum, self.embedding_model)
+        for db in [chroma, self.store]:
+            db.generate(get_text_att(), [1, 2, 3], ["first", "", "third"])
+
+        id_list = [3, 1, 4, 3, 2]
+        chroma_embeddings, chroma_found = chroma.retrieve_many(get_text_att(), id_list)
+        store_embeddings, store_found = self.store.retrieve_many(get_text_att(), id_list)
+
+        np.testing.assert_array_equal(store_found, chroma_found)
+        np.testing.assert_allclose(store_embeddings, chroma_embeddings, rtol=1e-5, atol=1e-6)
+        self.assertEqual(self.store.retrieve_value_hashes(get_text_att(), id_list), chroma.retrieve_value_hashes(get_text_att(), id_list))
+
+if __name__ == '__main__':
+    unittest.main()
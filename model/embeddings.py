@@ -1,7 +1,11 @@
-from tiktoken import encoding_for_model
 import chromadb
+import numpy as np
+import threading
+import re
+import zlib
 
 import utils
+from tokenizer_service import get_tokenizer_service, get_chunk_starts
 
 class EmbeddingModelError(Exception):
     def __init__(self, message):
@@ -9,7 +13,8 @@ class EmbeddingModelError(Exception):
 
 def get_embedding_model(embedding_config):
     models = {
-        "openai": OpenAIEmbeddingModel
+        "openai": OpenAIEmbeddingModel,
+        "local": LocalEmbeddingModel
     }
 
     if not ('name' in embedding_config):
@@ -29,6 +34,76 @@ class EmbeddingModel:
 
         self.accrued_input_tokens = 0
 
+        self.cache = None
+        self.accrued_cached_tokens = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self.max_batch_tokens = config.get("max_batch_tokens", 300000)
+        self.max_batch_items = config.get("max_batch_items", 2048)
+        self.max_concurrency = config.get("max_concurrency", 4)
+        self.max_retries = config.get("max_retries", 3)
+
+        self.long_document_mode = config.get("long_document_mode", "raise")
+        self.chunk_tokens = config.get("chunk_tokens", self.max_tokens)
+        self.chunk_overlap = config.get("chunk_overlap", 128)
+        self.pooling = config.get("pooling", "mean")
+
+        if not (self.long_document_mode in ["raise", "chunk"]):
+            raise EmbeddingModelError(f"Error: unknown long document mode {self.long_document_mode}.")
+        if not (self.pooling in ["mean", "length_weighted"]):
+            raise EmbeddingModelError(f"Error: unknown pooling {self.pooling}.")
+        if self.chunk_tokens > self.max_tokens or self.chunk_overlap >= self.chunk_tokens:
+            raise EmbeddingModelError(f"Error: chunks of {self.chunk_tokens} tokens overlapping by {self.chunk_overlap} don't fit within {self.max_tokens} tokens.")
+
+        self.chroma_embedding_function = None
+        self.chroma_embedding_function_lock = threading.Lock()
+
+    """
+        Get the embedding function for chroma collections, built once on first use and shared
+        by every collection after that.
+    """
+    def get_chroma_embedding_function(self):
+        with self.chroma_embedding_function_lock:
+            if self.chroma_embedding_function == None:
+                self.chroma_embedding_function = self.build_chroma_embedding_function()
+            return self.chroma_embedding_function
+
+    """
+        Count the tokens of each of a list of documents.
+    """
+    def tokenize_batch(self, documents):
+        return [self.tokenize(document) for document in documents]
+
+    """
+        Split a document which is too long to embed into chunks of chunk_tokens tokens,
+        each overlapping the one before by chunk_overlap.
+    """
+    def split_document(self, document):
+        raise EmbeddingModelError(f"Error: {self} does not support splitting documents.")
+
+    """
+        Pool the embeddings of a document's chunks into one unit length vector,
+        either their mean or their mean weighted by each chunk's token count.
+    """
+    def pool_chunks(self, chunk_embeddings, chunk_token_counts):
+        weights = np.ones(len(chunk_token_counts)) if self.pooling == "mean" else np.array(chunk_token_counts, dtype=np.float64)
+        pooled = np.average(np.asarray(chunk_embeddings, dtype=np.float32), axis=0, weights=weights).astype(np.float32)
+
+        norm = np.linalg.norm(pooled)
+        return pooled if norm == 0 else pooled / norm
+
+    """
+        Estimate the cost of embedding a list of documents, counting their tokens together.
+    """
+    def estimate_batch_cost(self, documents, accrue=False):
+        input_tokens = sum(self.tokenize_batch(documents))
+
+        if accrue:
+            self.accrued_input_tokens += input_tokens
+
+        return input_tokens * self.input_token_cost
+
     def estimate_doc_cost(self, doc, accrue=False):
         cost_estimate = 0
         input_tokens = self.tokenize(doc)
@@ -42,6 +117,43 @@ class EmbeddingModel:
     def __str__(self):
         return f"Embedding Model {self.name}"
 
+    """
+        Embed a list of documents, returning a float32 matrix with a row per document.
+    """
+    def embed_batch(self, documents):
+        return np.array(self.get_chroma_embedding_function()(documents), dtype=np.float32)
+
+    """
+        Use an EmbeddingCache for every document this model embeds from now on.
+    """
+    def set_cache(self, cache):
+        self.cache = cache
+
+    """
+        The key this model's embeddings are cached under, which should differ for
+        any two configs which embed the same document differently.
+    """
+    def get_cache_key(self):
+        return f"{self.name}:{self.dimension}"
+
+    """
+        Record documents which didn't need embedding, as they were cached or repeated,
+        along with the tokens that would have been paid for them.
+    """
+    def record_cache_hits(self, num_hits, tokens):
+        self.cache_hits += num_hits
+        self.accrued_cached_tokens += tokens
+
+    def record_cache_misses(self, num_misses):
+        self.cache_misses += num_misses
+
+    def get_cache_hit_rate(self):
+        total = self.cache_hits + self.cache_misses
+        return 0 if total == 0 else self.cache_hits / total
+
+    def get_accrued_savings(self):
+        return self.accrued_cached_tokens * self.input_token_cost
+
     def get_accrued_cost(self):
         accrued_cost = 0
 
@@ -54,6 +166,8 @@ class EmbeddingModel:
         print(f"Current accrued costs for {self}:")
         print(f"{self.accrued_input_tokens} input tokens at rate ${self.input_token_cost}: {self.accrued_input_tokens * self.input_token_cost}")
         print(f"Total accrued cost: {self.get_accrued_cost()}")
+        print(f"{self.cache_hits} cache hits and {self.cache_misses} misses, hit rate {self.get_cache_hit_rate():.2%}")
+        print(f"{self.accrued_cached_tokens} cached input tokens saved: {self.get_accrued_savings()}")
 
 
 class OpenAIEmbeddingModel(EmbeddingModel):
@@ -62,15 +176,113 @@ class OpenAIEmbeddingModel(EmbeddingModel):
 
         self.model_name = config['model_name']
 
-    def get_chroma_embedding_function(self):
+    def get_cache_key(self):
+        return f"{self.name}:{self.model_name}:{self.dimension}"
+
+    def build_chroma_embedding_function(self):
         return chromadb.utils.embedding_functions.OpenAIEmbeddingFunction(
             api_key=utils.fetch_env_var("OPENAI_API_KEY"),
             model_name=self.model_name
         )
 
     def tokenize(self, document):
-        encoding = encoding_for_model(self.model_name)
-        tokens = encoding.encode(document)
-        return len(tokens)
-        
+        return get_tokenizer_service().count(self.model_name, document)
+
+    def tokenize_batch(self, documents):
+        return get_tokenizer_service().count_batch(self.model_name, documents)
+
+    def split_document(self, document):
+        return get_tokenizer_service().split(self.model_name, document, self.chunk_tokens, self.chunk_overlap)
+
+
+"""
+    A deterministic embedding model which runs entirely offline, for tests and benchmarks.
+
+    Documents are split into lowercased word and punctuation tokens, which are hashed with a
+    seeded hash into num_features signed buckets, weighted by log term frequency.
+    The bucket counts are then projected down to the configured dimension with a seeded Gaussian
+    random projection, and normalized to unit length like OpenAI's embeddings.
+    The same config always gives the same embeddings, on any machine.
+"""
+class LocalEmbeddingModel(EmbeddingModel):
+
+    TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+    def __init__(self, config):
+        super().__init__(config)
+
+        self.config = config
+        self.num_features = config.get("num_features", 4096)
+        self.seed = config.get("seed", 0)
+
+        rng = np.random.default_rng(self.seed)
+        self.projection = (rng.standard_normal((self.num_features, self.dimension)) / np.sqrt(self.dimension)).astype(np.float32)
+
+    def get_cache_key(self):
+        return f"{self.name}:{self.num_features}:{self.seed}:{self.dimension}"
+
+    def get_tokens(self, document):
+        return self.TOKEN_PATTERN.findall(document.lower())
+
+    def tokenize(self, document):
+        return len(self.get_tokens(document))
+
+    def split_document(self, document):
+        spans = [match.span() for match in self.TOKEN_PATTERN.finditer(document)]
+        return [document[spans[start][0]:spans[min(start + self.chunk_tokens, len(spans)) - 1][1]] for start in get_chunk_starts(len(spans), self.chunk_tokens, self.chunk_overlap)]
+
+    """
+        Get the bucket and sign of a token, from a seeded crc32 of it.
+        This is cheap enough to redo for every occurrence, rather than keeping a table of every token seen.
+    """
+    def get_token_bucket(self, token):
+        token_hash = zlib.crc32(token.encode("utf-8"), self.seed)
+        return token_hash % self.num_features, 1.0 if (token_hash >> 31) & 1 else -1.0
+
+    def embed_batch(self, documents):
+        doc_indices = []
+        buckets = []
+        signs = []
+        for doc_index, document in enumerate(documents):
+            for token in self.get_tokens(document):
+                bucket, sign = self.get_token_bucket(token)
+                doc_indices.append(doc_index)
+                buckets.append(bucket)
+                signs.append(sign)
+
+        counts = np.zeros((len(documents), self.num_features), dtype=np.float32)
+        np.add.at(counts, (np.array(doc_indices, dtype=np.int64), np.array(buckets, dtype=np.int64)), np.array(signs, dtype=np.float32))
+        features = np.sign(counts) * np.log1p(np.abs(counts))
+
+        embeddings = features @ self.projection
+
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return embeddings / norms
+
+    def build_chroma_embedding_function(self):
+        return LocalChromaEmbeddingFunction(self.config, embedding_model=self)
+
+"""
+    The chroma embedding function for the local embedding model.
+"""
+class LocalChromaEmbeddingFunction(chromadb.EmbeddingFunction):
+    def __init__(self, config, embedding_model=None):
+        self.config = config
+        self.embedding_model = embedding_model
+
+    def __call__(self, input):
+        if self.embedding_model == None:
+            self.embedding_model = LocalEmbeddingModel(self.config)
+        return list(self.embedding_model.embed_batch(list(input)))
+
+    @staticmethod
+    def name():
+        return "is_hackernews_dead_local"
+
+    def get_config(self):
+        return self.config
 
+    @staticmethod
+    def build_from_config(config):
+        return LocalChromaEmbeddingFunction(config)
@@ -2,11 +2,16 @@
     Classes for entities.
 """
 
+import json
+import asyncio
+import functools
+
 import utils
 from jinja2 import Template
 from sqlite_db import UniqueDBItemNotFound
-from chroma_db import EmbeddingsNotFoundError
+from chroma_db import EmbeddingsNotFoundError, CHROMA_GET_CHUNK_SIZE, get_value_hash
 import numpy as np
+import quantization
 
 class Entity:
 
@@ -20,10 +25,34 @@ class Entity:
         self.derived = DerivedAttClassValues(self.id, self.model.derived, self.sqlite, self.chroma)
         self.generated = GeneratedAttClassValues(self.id, self.model.generated, self.sqlite, self.chroma)
 
-    def load_from_sqlite(self):
-        sqlite_row = self.sqlite.get_by_id(self.model.id_att, self.model.table_name, self.id)
-        self.base.fill_from_dict(sqlite_row)
-        self.generated.fill_from_dict(sqlite_row)
+    """
+        Load this entity's values from sqlite.
+        If a list of attribute names is given, only those columns are read,
+        and the rest are loaded lazily the first time they're accessed.
+    """
+    def load_from_sqlite(self, att_names=None):
+        att_model_list = self.get_sqlite_att_list(att_names)
+        sqlite_row = self.sqlite.get_by_id(self.model.id_att, self.model.table_name, self.id, att_model_list=att_model_list)
+        self.fill_from_sqlite_row(sqlite_row, partial=att_names != None)
+
+    """
+        Fill this entity's values from a sqlite row.
+        If partial is set, any attributes missing from the row are marked to be loaded lazily.
+    """
+    def fill_from_sqlite_row(self, sqlite_row, partial=False):
+        for att_class in [self.base, self.generated]:
+            if partial:
+                att_class.set_unloaded([att.name for att in att_class.model.att_list if not (att.name in sqlite_row)])
+            att_class.fill_from_sqlite_dict(sqlite_row, partial=partial)
+
+    """
+        Get the sqlite attribute models of this entity, optionally limited to a list of names.
+    """
+    def get_sqlite_att_list(self, att_names=None):
+        att_list = self.model.base.att_list + self.model.generated.att_list
+        if att_names == None:
+            return att_list
+        return [att for att in att_list if att.name in att_names]
     
     def derive(self):
         self.derived.derive(self.base.values, self.generated.values)
@@ -38,41 +67,102 @@ class Entity:
         self.derive()
         self.load_from_chroma()
 
-    def store_in_sqlite(self):
-        try:
-            self._print(f"Updating {self} in sqlite...")
-            current_sqlite_row = self.sqlite.get_by_id(self.entity_model, self.id)
-            self.base.update_in_sqlite()
-            self.generated.update_in_sqlite()
-        except UniqueDBItemNotFound as e:
-            self._print(f"Inserting {self} into sqlite...")
-            self.sqlite.insert(self.table_name, [{**self.base.values, **self.generated.values}], self.model.base.att_list + self.model.generated.att_list)
-            self._print(f"Successfully inserted {self} into sqlite.")
-    
-    def store_in_chroma(self):
-        self.base.pupdate_in_chroma()
-        self.derived.pupdate_in_chroma()
-        self.generated.pupdate_in_chroma()
-
-    def store(self):
-        self.store_in_sqlite()
-        self.store_in_chroma()
+    def get_sqlite_dict(self):
+        return {**self.base.get_sqlite_dict(), **self.generated.get_sqlite_dict()}
+
+    """
+        Get the values of this entity's attributes which go into the when model, as float32 arrays
+        keyed by attribute name: embeddings for those which store them, dequantized if need be,
+        and the value itself otherwise.
+    """
+    def get_when_dict(self):
+        when_dict = {}
+        for att_class in [self.base, self.derived, self.generated]:
+            for att in att_class.model.att_list:
+                if not att.in_when:
+                    continue
+                if att.store_embeddings:
+                    when_dict[att.name] = quantization.dequantize(att_class.get_embeddings(att.name))
+                else:
+                    when_dict[att.name] = np.array([att_class.get_value(att.name)], dtype=np.float32)
+        return when_dict
+
+    """
+        Insert this entity into sqlite, or update its row if already present,
+        in a single statement.
+    """
+    def store_in_sqlite(self, unit_of_work=None):
+        if unit_of_work != None:
+            unit_of_work.store(self)
+            return
+
+        self._print(f"Storing {self} in sqlite...")
+        with self.sqlite.transaction():
+            self.sqlite.upsert(self.model.table_name, [self.get_sqlite_dict()], self.model.base.att_list + self.model.generated.att_list, self.model.id_att, only_if_changed=True)
+        self._print(f"Successfully stored {self} in sqlite.")
 
-    def delete_from_sqlite(self):
-        self.sqlite.delete_by_id(self.model.id_att, self.model.table_name, self.id)
     
-    def delete_from_chroma(self):
+    """
+        Store this entity's embeddings, and those of entities held in its attributes,
+        the same way as store_list_in_chroma. With a unit of work, it's queued until the unit flushes.
+    """
+    def store_in_chroma(self, unit_of_work=None):
+        if unit_of_work != None:
+            unit_of_work.store_in_chroma(self)
+            return
+
+        store_list_in_chroma([self])
+
+    def store(self, unit_of_work=None):
+        self.store_in_sqlite(unit_of_work=unit_of_work)
+        self.store_in_chroma(unit_of_work=unit_of_work)
+
+    def delete_from_sqlite(self, unit_of_work=None):
+        if unit_of_work != None:
+            unit_of_work.delete(self)
+            return
+
+        with self.sqlite.transaction():
+            self.sqlite.delete_by_id(self.model.id_att, self.model.table_name, self.id)
+    
+    """
+        Delete this entity's embeddings, and those of entities held in its attributes.
+        With a unit of work, it's queued until the unit flushes.
+    """
+    def delete_from_chroma(self, unit_of_work=None):
+        if unit_of_work != None:
+            unit_of_work.delete_from_chroma(self)
+            return
+
         self.base.delete_from_chroma()
         self.derived.delete_from_chroma()
         self.generated.delete_from_chroma()
 
-    def delete(self):
-        self.delete_from_sqlite()
-        self.delete_from_chroma()
+    def delete(self, unit_of_work=None):
+        self.delete_from_sqlite(unit_of_work=unit_of_work)
+        self.delete_from_chroma(unit_of_work=unit_of_work)
 
     def generate(self, llm):
         self.generated.generate(llm, self.base.values, self.derived.values)
 
+    """
+        Async counterparts of load and store, running them on an executor
+        so that a coroutine can await them alongside network calls.
+        If no executor is given, the event loop's default is used;
+        pass an AsyncSqliteDB's executor to keep database work bounded.
+    """
+    async def aload_from_sqlite(self, att_names=None, executor=None):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, functools.partial(self.load_from_sqlite, att_names=att_names))
+
+    async def aload(self, executor=None):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, self.load)
+
+    async def astore(self, executor=None):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, self.store)
+
 
     def set_verbose(self, verbose):
         self.verbose = verbose
@@ -87,10 +177,324 @@ class Entity:
     def get_id(self):
         return self.id
 
+"""
+    Load the sqlite values for a list of entities with one batched query per table,
+    rather than one query per entity, optionally only for a list of attribute names.
+    Returns the list of entities which could not be found.
+"""
+def load_list_from_sqlite(entity_list, att_names=None):
+    entities_by_table = {}
+    for entity in entity_list:
+        entities_by_table.setdefault(entity.model.table_name, []).append(entity)
+
+    missing = []
+    for table_name, table_entities in entities_by_table.items():
+        model = table_entities[0].model
+        sqlite = table_entities[0].sqlite
+
+        att_model_list = table_entities[0].get_sqlite_att_list(att_names) if att_names != None else None
+        rows, missing_ids = sqlite.get_by_ids(model.id_att, table_name, [entity.id for entity in table_entities], att_model_list=att_model_list)
+
+        for entity in table_entities:
+            if entity.id in rows:
+                entity.fill_from_sqlite_row(rows[entity.id], partial=att_names != None)
+            else:
+                missing.append(entity)
+
+    return missing
+
+"""
+    Load the embeddings for a list of entities with one batched retrieval per attribute
+    and entity type, rather than one per attribute per entity.
+    Attributes holding other entities are left to those entities.
+    If a quantization mode is given, the embeddings are held in that form, see quantization.py.
+    Returns the list of entities missing embeddings for any attribute.
+"""
+def load_list_from_chroma(entity_list, chunk_size=CHROMA_GET_CHUNK_SIZE, quantization_mode=None):
+    entities_by_table = {}
+    for entity in entity_list:
+        entities_by_table.setdefault(entity.model.table_name, []).append(entity)
+
+    missing = {}
+    for table_name, table_entities in entities_by_table.items():
+        chroma = table_entities[0].chroma
+        ids = [entity.id for entity in table_entities]
+
+        for att_class_name in ["base", "derived", "generated"]:
+            att_class_model = getattr(table_entities[0].model, att_class_name)
+            for att in att_class_model.embedded_list:
+                if att.py_type in ["entity", "list(entity)"]:
+                    continue
+
+                embeddings, found = chroma.retrieve_many(att, ids, chunk_size=chunk_size)
+                if quantization_mode != None:
+                    embeddings = quantization.QuantizedMatrix.from_float(embeddings, quantization_mode)
+                for i, entity in enumerate(table_entities):
+                    if found[i]:
+                        getattr(entity, att_class_name).set_embeddings(att.name, embeddings[i] if quantization_mode == None else embeddings.row(i))
+                    else:
+                        missing[(table_name, entity.get_id())] = entity
+
+    return list(missing.values())
+
+"""
+    Store the embeddings for a list of entities in chroma, with one batched generate and update
+    per attribute and entity type, for those which are missing or whose values have changed,
+    rather than one request per attribute per entity.
+    Entities held in attributes are stored the same way, all together.
+"""
+def store_list_in_chroma(entity_list):
+    entities_by_table = {}
+    for entity in entity_list:
+        entities_by_table.setdefault(entity.model.table_name, []).append(entity)
+
+    held_entities = []
+    for table_name, table_entities in entities_by_table.items():
+        chroma = table_entities[0].chroma
+
+        for att_class_name in ["base", "derived", "generated"]:
+            att_class_model = getattr(table_entities[0].model, att_class_name)
+            for att in att_class_model.embedded_list:
+                if att.py_type == "entity":
+                    held_entities += [getattr(entity, att_class_name).get_value(att.name) for entity in table_entities]
+                    continue
+                if att.py_type == "list(entity)":
+                    for entity in table_entities:
+                        held_entities += getattr(entity, att_class_name).get_value(att.name)
+                    continue
+
+                if att.update_comparator == None:
+                    current_chroma_vals = chroma.retrieve_value_hashes(att, [entity.id for entity in table_entities])
+                else:
+                    current_chroma_vals = chroma.retrieve_values(att, [entity.id for entity in table_entities])
+
+                to_generate = []
+                to_update = []
+                for entity in table_entities:
+                    current_val = getattr(entity, att_class_name).get_value(att.name)
+                    id_str = str(entity.id)
+                    if not (id_str in current_chroma_vals):
+                        to_generate.append((entity.id, current_val))
+                    elif att.update_comparator == None:
+                        if get_value_hash(current_val) != current_chroma_vals[id_str]:
+                            to_update.append((entity.id, current_val))
+                    elif att.update_comparator(current_val, current_chroma_vals[id_str]):
+                        to_update.append((entity.id, current_val))
+
+                if len(to_generate) > 0:
+                    chroma.generate(att, [id_val for id_val, val in to_generate], [val for id_val, val in to_generate])
+                if len(to_update) > 0:
+                    chroma.update(att, [id_val for id_val, val in to_update], [val for id_val, val in to_update])
+
+    if len(held_entities) > 0:
+        store_list_in_chroma(held_entities)
+
+"""
+    Load the sqlite values for a stream of entities, batch_size at a time,
+    yielding each one once loaded.
+"""
+def iter_load_from_sqlite(entity_iter, batch_size=1000, skip_missing=False, att_names=None):
+    batch = []
+    for entity in entity_iter:
+        batch.append(entity)
+        if len(batch) == batch_size:
+            yield from _load_batch_from_sqlite(batch, skip_missing, att_names)
+            batch = []
+
+    yield from _load_batch_from_sqlite(batch, skip_missing, att_names)
+
+def _load_batch_from_sqlite(batch, skip_missing, att_names):
+    missing = load_list_from_sqlite(batch, att_names=att_names)
+    if len(missing) > 0 and not skip_missing:
+        raise UniqueDBItemNotFound(f"Error: entities {[str(entity.get_id()) for entity in missing]} could not be found in the sqlite database.")
+
+    missing_ids = set([(entity.model.table_name, entity.get_id()) for entity in missing])
+    for entity in batch:
+        if not ((entity.model.table_name, entity.get_id()) in missing_ids):
+            yield entity
+
+"""
+    Load the embeddings of a stream of entities batch_size at a time, with load_list_from_chroma,
+    yielding each as it's loaded. Entities missing embeddings raise an EmbeddingsNotFoundError,
+    unless skip_missing is set, in which case they're left out.
+    If a quantization mode is given, the embeddings are held in that form.
+"""
+def iter_load_from_chroma(entity_iter, batch_size=1000, skip_missing=False, quantization_mode=None):
+    batch = []
+    for entity in entity_iter:
+        batch.append(entity)
+        if len(batch) == batch_size:
+            yield from _load_batch_from_chroma(batch, skip_missing, quantization_mode)
+            batch = []
+
+    yield from _load_batch_from_chroma(batch, skip_missing, quantization_mode)
+
+def _load_batch_from_chroma(batch, skip_missing, quantization_mode):
+    missing = load_list_from_chroma(batch, quantization_mode=quantization_mode)
+    if len(missing) > 0 and not skip_missing:
+        raise EmbeddingsNotFoundError(f"Error: embeddings for entities {[str(entity.get_id()) for entity in missing]} could not be found.")
+
+    missing_ids = set([(entity.model.table_name, entity.get_id()) for entity in missing])
+    for entity in batch:
+        if not ((entity.model.table_name, entity.get_id()) in missing_ids):
+            yield entity
+
+"""
+    Store the embeddings of a stream of entities batch_size at a time, with store_list_in_chroma.
+    Returns the number of entities stored.
+"""
+def store_iter_in_chroma(entity_iter, batch_size=1000):
+    num_stored = 0
+    batch = []
+    for entity in entity_iter:
+        batch.append(entity)
+        if len(batch) == batch_size:
+            store_list_in_chroma(batch)
+            num_stored += len(batch)
+            batch = []
+
+    store_list_in_chroma(batch)
+    return num_stored + len(batch)
+
+"""
+    Iterate through every entity of a given class stored in its sqlite table,
+    streaming the rows rather than reading the whole table at once.
+"""
+def iter_table(entity_class, sqlite, chroma, where_dict=None, order_by=None, batch_size=1000, verbose=False):
+    model = entity_class.model
+    for sqlite_row in sqlite.iter_rows(model.table_name, model.base.att_list + model.generated.att_list, where_dict=where_dict, order_by=order_by, batch_size=batch_size):
+        entity = entity_class(sqlite_row[model.id_att], sqlite, chroma, verbose=verbose)
+        entity.fill_from_sqlite_row(sqlite_row)
+        yield entity
+
+"""
+    Store a list of entities in sqlite with one batched upsert per table.
+"""
+def store_list_in_sqlite(entity_list):
+    entities_by_table = {}
+    for entity in entity_list:
+        entities_by_table.setdefault(entity.model.table_name, []).append(entity)
+
+    for table_name, table_entities in entities_by_table.items():
+        model = table_entities[0].model
+        sqlite = table_entities[0].sqlite
+
+        att_dict_list = [entity.get_sqlite_dict() for entity in table_entities]
+        with sqlite.transaction():
+            sqlite.upsert(table_name, att_dict_list, model.base.att_list + model.generated.att_list, model.id_att, only_if_changed=True)
+
+"""
+    Queues sqlite writes across entities of any type, to be flushed together in a
+    single transaction with one batched statement per table and operation.
+    Embeddings queued with store_in_chroma or delete_from_chroma are stored or deleted once
+    the transaction commits, the stores with one store_list_in_chroma over all of them,
+    so a unit which raises or is discarded leaves chroma untouched too.
+    As a context manager it flushes on exit, or discards the queue if an error was raised,
+    leaving the database untouched.
+    If batch_size is given, it also flushes whenever that many writes are queued,
+    to commit periodically inside long ingest loops.
+
+        with UnitOfWork(sqlite) as unit_of_work:
+            comment.store(unit_of_work=unit_of_work)
+            author.store(unit_of_work=unit_of_work)
+"""
+class UnitOfWork:
+    def __init__(self, sqlite, batch_size=None):
+        self.sqlite = sqlite
+        self.batch_size = batch_size
+        self.to_store = {}
+        self.to_delete = {}
+        self.to_store_in_chroma = {}
+        self.to_delete_from_chroma = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type == None:
+            self.flush()
+        else:
+            self.discard()
+
+    def get_num_queued(self):
+        return sum([len(queued) for queued in self.to_store.values()]) + sum([len(queued) for queued in self.to_delete.values()]) + len(self.to_store_in_chroma) + len(self.to_delete_from_chroma)
+
+    """
+        Queue an entity to be inserted or updated, replacing any write already queued for it.
+    """
+    def store(self, entity):
+        table_name = entity.model.table_name
+        self.to_delete.get(table_name, {}).pop(entity.get_id(), None)
+        self.to_store.setdefault(table_name, {})[entity.get_id()] = entity
+        self._check_batch()
+
+    """
+        Queue an entity's embeddings to be stored, replacing any queued for it.
+    """
+    def store_in_chroma(self, entity):
+        self.to_delete_from_chroma.pop((entity.model.table_name, entity.get_id()), None)
+        self.to_store_in_chroma[(entity.model.table_name, entity.get_id())] = entity
+        self._check_batch()
+
+    """
+        Queue an entity's embeddings to be deleted, replacing any store queued for them.
+    """
+    def delete_from_chroma(self, entity):
+        self.to_store_in_chroma.pop((entity.model.table_name, entity.get_id()), None)
+        self.to_delete_from_chroma[(entity.model.table_name, entity.get_id())] = entity
+        self._check_batch()
+
+    """
+        Queue an entity to be deleted, replacing any write already queued for it.
+    """
+    def delete(self, entity):
+        table_name = entity.model.table_name
+        self.to_store.get(table_name, {}).pop(entity.get_id(), None)
+        self.to_store_in_chroma.pop((table_name, entity.get_id()), None)
+        self.to_delete.setdefault(table_name, {})[entity.get_id()] = entity
+        self._check_batch()
+
+    def _check_batch(self):
+        if self.batch_size != None and self.get_num_queued() >= self.batch_size:
+            self.flush()
+
+    """
+        Write everything queued to sqlite in one transaction, then delete and store the queued embeddings,
+        and clear the queue.
+    """
+    def flush(self):
+        with self.sqlite.transaction():
+            for table_entities in self.to_store.values():
+                store_list_in_sqlite(list(table_entities.values()))
+            for table_name, table_entities in self.to_delete.items():
+                if len(table_entities) > 0:
+                    entity_list = list(table_entities.values())
+                    self.sqlite.delete_by_ids(entity_list[0].model.id_att, table_name, list(table_entities.keys()))
+
+        for entity in self.to_delete_from_chroma.values():
+            entity.delete_from_chroma()
+        if len(self.to_store_in_chroma) > 0:
+            store_list_in_chroma(list(self.to_store_in_chroma.values()))
+
+        self.discard()
+
+    def discard(self):
+        self.to_store = {}
+        self.to_delete = {}
+        self.to_store_in_chroma = {}
+        self.to_delete_from_chroma = {}
+
 class User(Entity):
     def foo():
         return
 
+    """
+        Get the kinds of submission kept in users' histories, as SubmissionHistoryModels.
+    """
+    @classmethod
+    def get_submission_histories(cls):
+        return []
+
 class Submission(Entity): 
     def foo():
         return
@@ -104,37 +508,90 @@ class Stem(Submission):
         return
 
 class Forum:
-    def __init__(self, user, root, stem):
+    def __init__(self, user, root, stem, migrations=None):
         self.user = user
         self.root = root
         self.stem = stem
+        self.migrations = [] if migrations == None else migrations
 
     def get_entity_models(self):
         return [self.user.model, self.root.model, self.stem.model]
 
+    def get_submission_histories(self):
+        return self.user.get_submission_histories()
+
 class EntityModel:
-    def __init__(self, id_att, table_name, base, derived, generated):
+    def __init__(self, id_att, table_name, base, derived, generated, indexes=None):
         self.id_att = id_att
         self.table_name = table_name
         self.base = base
         self.derived = derived
         self.generated = generated
         self.all_att_classes = [self.base, self.derived, self.generated]
-        self.all_atts = [*att_class.att_list for att_class in self.att_classes]
+        self.all_atts = [att for att_class in self.all_att_classes for att in att_class.att_list]
         self.all_embedded_atts = [att for att in self.all_atts if att.store_embeddings]
 
-        for att in self.all_att_classes:
-            att.add_context(self.id_att, self.table_name)
+        for att_class in self.all_att_classes:
+            att_class.add_context(self.id_att, self.table_name)
+
+        self.full_text_atts = [att for att in self.base.att_list + self.generated.att_list if att.full_text]
+
+        self.indexes = [*(indexes if indexes != None else [])]
+        for att in self.base.att_list + self.generated.att_list:
+            if att.index:
+                self.indexes.append(IndexModel([att.name]))
+
+        for index in self.indexes:
+            index.add_context(self.table_name)
+
+"""
+    A secondary sqlite index over one or more attributes of an entity's table.
+    If where is given, it's created as a partial index over only the rows matching it.
+"""
+class IndexModel:
+    def __init__(self, att_names, where=None, unique=False, name=None):
+        self.att_names = att_names
+        self.where = where
+        self.unique = unique
+        self.name = name
+
+    def add_context(self, table_name):
+        self.table_name = table_name
+        if self.name == None:
+            self.name = f"idx_{table_name}_{'_'.join(self.att_names)}"
     
+"""
+    A kind of submission kept in the user_submissions table, which sqlite keeps in sync with triggers.
+    Either the submissions a user authored, found by author_att on the submission's table,
+    or those listed in a JSON id list column of the users table, id_list_att.
+"""
+class SubmissionHistoryModel:
+    def __init__(self, kind, submission_model, author_att=None, id_list_att=None, time_att="time"):
+        if (author_att == None) == (id_list_att == None):
+            raise ValueError(f"Error: submission history {kind} needs exactly one of an author attribute or an id list attribute.")
+
+        self.kind = kind
+        self.submission_model = submission_model
+        self.author_att = author_att
+        self.id_list_att = id_list_att
+        self.time_att = time_att
+
 class AttClassModel:
     def __init__(self, att_list):
         self.att_list = att_list
         self.embedded_list = [att for att in att_list if att.store_embeddings]
+
+    def add_context(self, id_att, table_name):
+        self.id_att = id_att
+        self.table_name = table_name
+        for att in self.att_list:
+            att.add_context(id_att, table_name)
         
 
 class AttModel:
     def __init__(self, name, store_embeddings, in_when, py_type, update_comparator=None):
         self.name = name
+        self.py_type = py_type
         self.store_embeddings = store_embeddings
         self.in_when = in_when
         self.update_comparator = update_comparator
@@ -144,15 +601,17 @@ class AttModel:
         self.table_name = table_name
 
 class SqliteAttModel(AttModel):
-    def __init__(self, name, store_embeddings, in_when, py_type, sqlite_type, update_comparator=None, load_conversion=None, store_conversion=None):
+    def __init__(self, name, store_embeddings, in_when, py_type, sqlite_type, update_comparator=None, load_conversion=None, store_conversion=None, index=False, full_text=False):
         super().__init__(name, store_embeddings, in_when, py_type, update_comparator=update_comparator)
         self.sqlite_type = sqlite_type
         self.load_conversion = load_conversion
         self.store_conversion = store_conversion
+        self.index = index
+        self.full_text = full_text
     
 class GeneratedAttModel(SqliteAttModel):
-    def __init__(self, name, store_embeddings, in_when, py_type, sqlite_type, prompt, update_comparator=None, load_conversion=None, store_conversion=None):
-        super().__init__(name, store_embeddings, in_when, py_type, sqlite_type, update_comparator=update_comparator, load_conversion=load_conversion, store_conversion=store_conversion)
+    def __init__(self, name, store_embeddings, in_when, py_type, sqlite_type, prompt, update_comparator=None, load_conversion=None, store_conversion=None, index=False, full_text=False):
+        super().__init__(name, store_embeddings, in_when, py_type, sqlite_type, update_comparator=update_comparator, load_conversion=load_conversion, store_conversion=store_conversion, index=index, full_text=full_text)
         self.prompt = prompt
 
 class DerivedAttModel(AttModel):
@@ -213,28 +672,8 @@ class AttClassValues:
                     entity.load_from_chroma()
             else:
                 embeddings = self.chroma.retrieve(att, self.id)['embeddings']
-                self.set_embeddings(att_model.name, embeddings)
+                self.set_embeddings(att.name, embeddings)
 
-    def pupdate_in_chroma(self):
-        for att in self.model.embedded_list:
-            if att.py_type == "entity":
-                self.get_value(att.name).store_in_chroma()
-            elif att.py_type == "list(entity)":
-                for entity in self.get_value(att.name):
-                    entity.store_in_chroma()
-            else:
-                current_val = self.get_value(att.name)
-                try:
-                    current_chroma_val = self.chroma.retrieve(att, self.id)['value']
-                    if att.update_comparator == None:
-                        needs_update = current_val != current_embedded_val
-                    else:
-                        needs_update = att.update_comparator(current_val, current_chroma_val)
-                    if needs_update:
-                        self.chroma.update(att, [self.id], [current_val])
-                except EmbeddingsNotFoundError as e:
-                    self.chroma.generate(att, [self.id], [current_val])
-        
     def delete_from_chroma(self):
         for att in self.model.embedded_list:
             if att.py_type == "entity":
@@ -246,6 +685,7 @@ class AttClassValues:
                 self.chroma.delete(att, [self.id])
 
 class SqliteAttClassValues(AttClassValues):
+    @staticmethod
     def convert_load(att, value):
         if att.load_conversion == None:
             if value == None:
@@ -261,6 +701,7 @@ class SqliteAttClassValues(AttClassValues):
         else:
             return att.load_conversion(value)
     
+    @staticmethod
     def convert_store(att, value):
         if att.store_conversion == None:
             if value == None:
@@ -277,9 +718,43 @@ class SqliteAttClassValues(AttClassValues):
         else:
             return att.store_conversion(value)
 
-    def load_from_sqlite(self):
-        sqlite_result = self.sqlite.get_by_id(self.id_att, self.table_name, self.id)
+    def __init__(self, id_val, model, sqlite, chroma):
+        super().__init__(id_val, model, sqlite, chroma)
+        self.unloaded = set()
+
+    """
+        Get an attribute's value, loading it from sqlite first if it was left out of a partial load.
+    """
+    def get_value(self, att_name):
+        if att_name in self.unloaded:
+            self.load_from_sqlite(att_names=[att_name])
+        return super().get_value(att_name)
+
+    def set_value(self, att_name, att_value):
+        super().set_value(att_name, att_value)
+        self.unloaded.discard(att_name)
+
+    def set_unloaded(self, att_names):
+        self.unloaded.update(att_names)
+
+    """
+        Fill values from a sqlite row.
+        If partial is set, attributes missing from the row are left as they are.
+    """
+    def fill_from_sqlite_dict(self, sqlite_dict, partial=False):
         for att in self.model.att_list:
+            if att.name in sqlite_dict:
+                self.set_value(att.name, self.convert_load(att, sqlite_dict[att.name]))
+            elif not partial:
+                raise KeyError(f"Error filling values from sqlite: att {att.name} is not present in given dict.")
+
+    def get_sqlite_dict(self):
+        return {att.name: self.convert_store(att, self.get_value(att.name)) for att in self.model.att_list}
+
+    def load_from_sqlite(self, att_names=None):
+        att_model_list = [att for att in self.model.att_list if att_names == None or att.name in att_names]
+        sqlite_result = self.sqlite.get_by_id(self.model.id_att, self.model.table_name, self.id, att_model_list=att_model_list)
+        for att in att_model_list:
             if att.name in sqlite_result:
                 self.set_value(att.name, self.convert_load(att, sqlite_result[att.name]))
             else:
@@ -1,21 +1,34 @@
 
 
 class Generator:
-    def __init__(self, dataset, when, what):
+    def __init__(self, dataset, when, what, candidate_k=None):
         self.dataset = dataset
         self.when = when
         self.what = what
-
-    def prepare_run(self, full_loaders, user_filter, initial_time=None, final_time=None, interval=60, time_loader=None):
+        self.candidate_k = candidate_k
+
+    """
+        Get the roots worth scoring for a user: those holding one of the candidate_k branches
+        closest to them in the dataset's candidate index, or all of them if there's no index.
+    """
+    def get_candidate_roots(self, user_object):
+        candidate_root_ids = None if self.candidate_k == None else self.dataset.get_candidate_root_ids(user_object, k=self.candidate_k)
+        if candidate_root_ids == None:
+            return self.dataset.sf.roots
+        return [root for root in self.dataset.sf.roots if root.get_id() in candidate_root_ids]
+
+    def prepare_run(self, full_loaders, user_filter, initial_time=None, final_time=None, interval=60):
         self.users = [uid for uid in self.dataset.user_pool.uids if user_filter(self.dataset.entity_factory("user", uid, full_loaders['user']))]
 
+        time_att = self.dataset.forum.root.time_att
+
         if initial_time == None:
-            self.initial_time = min([root.fetch_submission_object(time_loader).get_time() for root in self.dataset.sf.roots])
+            self.initial_time = min([root.get_time() for root in self.dataset.sf.iter_roots(load_sqlite=True, att_names=[time_att])])
         else:
             self.initial_time = initial_time
 
         if final_time == None:
-            self.final_time = max([root.dfs(lambda s: max(s['sub_obj'].get_time(), s['desc_result']), loader=time_loader, reduce_kids_acc=0, reduce_kids_f=lambda acc, i: max(acc, i)) for root in self.sf.roots])
+            self.final_time = self.dataset.sf.get_time_range(time_att)[1]
         else:
             self.final_time = final_time
         #activate all before time
@@ -30,6 +43,6 @@ class Generator:
     def generate(self):
         for user in self.users:
             user_object = user.fetch_submission_object(full_loaders['user'])
-            for root in self.dataset.sf.roots:
+            for root in self.get_candidate_roots(user_object):
                 root_object = root.fetch_submission_object(full_loaders['root'])
                 
\ No newline at end of file
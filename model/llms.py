@@ -1,5 +1,6 @@
 from openai import OpenAI
-from tiktoken import encoding_for_model
+
+from tokenizer_service import get_tokenizer_service
 
 class LLMError(Exception):
     def __init__(self, message):
@@ -34,9 +35,11 @@ class LLM:
 
     def estimate_prompt_cost(self, cached, uncached, output_token_estimate=100, example_output=None, accrue=False):
         cost_estimate = 0
-        cached_tokens = self.tokenize(cached)
-        input_tokens = self.tokenize(uncached)
-        output_tokens = output_token_estimate if example_output == None else self.tokenize(example_output) 
+        if example_output == None:
+            cached_tokens, input_tokens = self.tokenize_batch([cached, uncached])
+            output_tokens = output_token_estimate
+        else:
+            cached_tokens, input_tokens, output_tokens = self.tokenize_batch([cached, uncached, example_output])
 
         cost_estimate += cached_tokens * self.cached_input_token_cost
         cost_estimate += input_tokens * self.input_token_cost
@@ -52,6 +55,9 @@ class LLM:
     def __str__(self):
         return f"LLM {self.name}"
 
+    def tokenize_batch(self, prompts):
+        return [self.tokenize(prompt) for prompt in prompts]
+
     def check_prompt(self, prompt):
         prompt_tokens = self.tokenize(prompt)
         if prompt_tokens > self.context_window:
@@ -85,9 +91,10 @@ class OpenAILLM(LLM):
         self.client = OpenAI()
 
     def tokenize(self, prompt):
-        encoding = encoding_for_model(self.model_name)
-        tokens = encoding.encode(prompt)
-        return len(tokens)
+        return get_tokenizer_service().count(self.model_name, prompt)
+
+    def tokenize_batch(self, prompts):
+        return get_tokenizer_service().count_batch(self.model_name, prompts)
 
     def complete(self, prompt):
         self.check_prompt(prompt)
@@ -0,0 +1,176 @@
+"""
+    Dimensionality reduction of embeddings before they're used as when model features,
+    fit once per when model and applied the same way at export and inference.
+"""
+
+import numpy as np
+
+import pickle
+
+import utils
+
+PROJECTION_METHODS = ["pca", "random", "none"]
+
+class ProjectionError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+"""
+    PCA fit by streaming: chunks of embeddings are accumulated into a running sum and
+    sum of outer products, so the whole matrix never has to be in memory at once.
+    The components are the top eigenvectors of the covariance, found once all chunks are in.
+"""
+class StreamingPCA:
+    def __init__(self, dimension, target_dimension):
+        if target_dimension > dimension:
+            raise ProjectionError(f"Error: cannot reduce {dimension} dimensional embeddings to {target_dimension} dimensions.")
+
+        self.dimension = dimension
+        self.target_dimension = target_dimension
+
+        self.count = 0
+        self.sum = np.zeros(dimension, dtype=np.float64)
+        self.outer_sum = np.zeros((dimension, dimension), dtype=np.float64)
+
+        self.mean = None
+        self.components = None
+        self.explained_variance_ratio = None
+
+    def partial_fit(self, matrix):
+        matrix = np.asarray(matrix, dtype=np.float64)
+        self.count += matrix.shape[0]
+        self.sum += matrix.sum(axis=0)
+        self.outer_sum += matrix.T @ matrix
+
+    """
+        Find the components from everything accumulated so far,
+        and free the accumulators, which are much larger than the result.
+    """
+    def finalize(self):
+        if self.count < 2:
+            raise ProjectionError(f"Error: cannot fit PCA with {self.count} embeddings.")
+
+        self.mean = self.sum / self.count
+        covariance = (self.outer_sum - self.count * np.outer(self.mean, self.mean)) / (self.count - 1)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:self.target_dimension]
+
+        self.components = eigenvectors[:, order].T.astype(np.float32)
+        self.explained_variance_ratio = float(eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12))
+        self.mean = self.mean.astype(np.float32)
+
+        self.sum = None
+        self.outer_sum = None
+
+    def transform(self, matrix):
+        if self.components is None:
+            raise ProjectionError("Error: attempted to use a PCA projection before it was fit.")
+        return (np.asarray(matrix, dtype=np.float32) - self.mean) @ self.components.T
+
+"""
+    A seeded Gaussian random projection, which needs no fitting, and roughly preserves
+    distances between embeddings.
+"""
+class RandomProjection:
+    def __init__(self, dimension, target_dimension, seed=0):
+        if target_dimension > dimension:
+            raise ProjectionError(f"Error: cannot reduce {dimension} dimensional embeddings to {target_dimension} dimensions.")
+
+        self.dimension = dimension
+        self.target_dimension = target_dimension
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        self.components = (rng.standard_normal((target_dimension, dimension)) / np.sqrt(target_dimension)).astype(np.float32)
+
+    def transform(self, matrix):
+        return np.asarray(matrix, dtype=np.float32) @ self.components.T
+
+"""
+    The projections for each embedded attribute of a when model, built from a config of the form
+    {"seed": 0, "attributes": {"about": {"method": "pca", "dimension": 64}, ...}},
+    where attributes left out of the config are passed through unchanged.
+"""
+class EmbeddingProjection:
+    def __init__(self, config, dimension):
+        self.config = config
+        self.dimension = dimension
+        self.seed = config.get("seed", 0)
+
+        self.projections = {}
+        for att_name, att_config in config.get("attributes", {}).items():
+            method = att_config.get("method", "pca")
+            if not (method in PROJECTION_METHODS):
+                raise ProjectionError(f"Error: unknown projection method {method} for {att_name}, must be one of {PROJECTION_METHODS}.")
+            if method == "none":
+                continue
+
+            target_dimension = att_config.get("dimension")
+            if target_dimension == None or target_dimension < 1:
+                raise ProjectionError(f"Error: the projection for {att_name} needs a positive target dimension.")
+
+            if method == "pca":
+                self.projections[att_name] = StreamingPCA(dimension, target_dimension)
+            if method == "random":
+                self.projections[att_name] = RandomProjection(dimension, target_dimension, seed=self.seed)
+
+    """
+        Get the attributes whose projections still need to be fit on embeddings.
+    """
+    def get_unfit_att_names(self):
+        return [att_name for att_name, projection in self.projections.items() if isinstance(projection, StreamingPCA) and projection.components is None]
+
+    def partial_fit(self, att_name, matrix):
+        self.projections[att_name].partial_fit(matrix)
+
+    def finalize(self):
+        for att_name in self.get_unfit_att_names():
+            self.projections[att_name].finalize()
+
+    """
+        Get the number of features an attribute's embeddings are reduced to.
+    """
+    def get_dimension(self, att_name):
+        if att_name in self.projections:
+            return self.projections[att_name].target_dimension
+        return self.dimension
+
+    def transform(self, att_name, matrix):
+        if not (att_name in self.projections):
+            return np.asarray(matrix, dtype=np.float32)
+        return self.projections[att_name].transform(matrix)
+
+    """
+        Project the embedded attributes of a dict from Entity.get_when_dict,
+        given the names of the attributes which are embeddings.
+    """
+    def transform_when_dict(self, when_dict, embedded_att_names):
+        return {att_name: (self.transform(att_name, value[np.newaxis, :])[0] if att_name in embedded_att_names else value) for att_name, value in when_dict.items()}
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+        print(f"Projection saved to {path}")
+
+    @staticmethod
+    def load(path):
+        if not utils.check_file_exists(path):
+            raise ProjectionError(f"Error: no projection exists at {path}.")
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def print_summary(self):
+        print("Embedding projections:")
+        for att_name, projection in self.projections.items():
+            method = "pca" if isinstance(projection, StreamingPCA) else "random"
+            explained = f", {projection.explained_variance_ratio:.1%} of variance explained" if method == "pca" and projection.explained_variance_ratio != None else ""
+            print(f"    {att_name}: {method}, {projection.dimension} -> {projection.target_dimension}{explained}")
+
+"""
+    Get the path a when model's projection is saved at, next to the model itself.
+"""
+def get_projection_path(when_name):
+    dir_path = utils.fetch_env_var("ROOT_WHEN_MODELS_DIR") + when_name + "/"
+    if not utils.check_directory_exists(dir_path):
+        utils.create_directory(dir_path)
+    return dir_path + "projection.pkl"
@@ -0,0 +1,146 @@
+"""
+    Unit tests for reducing the dimension of embeddings before they're used as when model features.
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+from unittest import mock
+
+import numpy as np
+
+import projection
+
+try:
+    import when
+except ImportError:
+    when = None
+
+"""
+    Make a seeded matrix of embeddings whose variance lies almost entirely in a few directions.
+"""
+def get_low_rank_matrix(num_rows, dimension, rank, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.standard_normal((num_rows, rank)) @ rng.standard_normal((rank, dimension)) + 0.01 * rng.standard_normal((num_rows, dimension)) + 1.0).astype(np.float32)
+
+class StreamingPCATests(unittest.TestCase):
+
+    """
+        Fitting in chunks finds the same components as fitting on the whole matrix at once.
+    """
+    def test_chunked_fit(self):
+        matrix = get_low_rank_matrix(500, 16, 3)
+
+        whole = projection.StreamingPCA(16, 3)
+        whole.partial_fit(matrix)
+        whole.finalize()
+
+        chunked = projection.StreamingPCA(16, 3)
+        for start in range(0, len(matrix), 64):
+            chunked.partial_fit(matrix[start:start + 64])
+        chunked.finalize()
+
+        np.testing.assert_allclose(np.abs(chunked.transform(matrix)), np.abs(whole.transform(matrix)), rtol=1e-3, atol=1e-3)
+
+    """
+        Projecting onto the top components and back loses only the noise, when the data is low rank.
+    """
+    def test_reconstruction(self):
+        matrix = get_low_rank_matrix(500, 16, 3)
+
+        pca = projection.StreamingPCA(16, 3)
+        pca.partial_fit(matrix)
+        pca.finalize()
+        reconstructed = pca.transform(matrix) @ pca.components + pca.mean
+
+        self.assertGreater(pca.explained_variance_ratio, 0.99)
+        self.assertLess(np.abs(reconstructed - matrix).max(), 0.1)
+
+    def test_errors(self):
+        with self.assertRaises(projection.ProjectionError):
+            projection.StreamingPCA(4, 8)
+
+        pca = projection.StreamingPCA(4, 2)
+        with self.assertRaises(projection.ProjectionError):
+            pca.transform(np.zeros((1, 4)))
+        pca.partial_fit(np.zeros((1, 4)))
+        with self.assertRaises(projection.ProjectionError):
+            pca.finalize()
+
+class RandomProjectionTests(unittest.TestCase):
+
+    def test_seeded(self):
+        matrix = get_low_rank_matrix(10, 64, 4)
+
+        np.testing.assert_array_equal(projection.RandomProjection(64, 8, seed=1).transform(matrix), projection.RandomProjection(64, 8, seed=1).transform(matrix))
+        self.assertFalse(np.allclose(projection.RandomProjection(64, 8, seed=1).transform(matrix), projection.RandomProjection(64, 8, seed=2).transform(matrix)))
+        self.assertEqual(projection.RandomProjection(64, 8).transform(matrix).shape, (10, 8))
+
+class EmbeddingProjectionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.config = {"seed": 0, "attributes": {"text": {"method": "pca", "dimension": 4}, "about": {"method": "random", "dimension": 8}, "title": {"method": "none"}}}
+        self.matrix = get_low_rank_matrix(200, 32, 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def get_fit_projection(self):
+        embedding_projection = projection.EmbeddingProjection(self.config, 32)
+        self.assertEqual(embedding_projection.get_unfit_att_names(), ["text"])
+        for start in range(0, len(self.matrix), 50):
+            embedding_projection.partial_fit("text", self.matrix[start:start + 50])
+        embedding_projection.finalize()
+        return embedding_projection
+
+    def test_fit_transform(self):
+        embedding_projection = self.get_fit_projection()
+
+        self.assertEqual(embedding_projection.get_unfit_att_names(), [])
+        self.assertEqual([embedding_projection.get_dimension(att_name) for att_name in ["text", "about", "title", "url"]], [4, 8, 32, 32])
+        self.assertEqual(embedding_projection.transform("text", self.matrix).shape, (200, 4))
+        np.testing.assert_array_equal(embedding_projection.transform("title", self.matrix), self.matrix)
+
+        when_dict = embedding_projection.transform_when_dict({"text": self.matrix[0], "about": self.matrix[1], "score": 3}, ["text", "about"])
+        self.assertEqual((len(when_dict["text"]), len(when_dict["about"]), when_dict["score"]), (4, 8, 3))
+
+    """
+        A saved projection loads back transforming embeddings the same way.
+    """
+    def test_save_load(self):
+        embedding_projection = self.get_fit_projection()
+        path = os.path.join(self.dir_path, "projection.pkl")
+        with mock.patch("builtins.print"):
+            embedding_projection.save(path)
+        loaded = projection.EmbeddingProjection.load(path)
+
+        for att_name in ["text", "about", "title"]:
+            np.testing.assert_array_equal(loaded.transform(att_name, self.matrix), embedding_projection.transform(att_name, self.matrix))
+
+        with self.assertRaises(projection.ProjectionError):
+            projection.EmbeddingProjection.load(os.path.join(self.dir_path, "missing.pkl"))
+
+    def test_unknown_method(self):
+        with self.assertRaises(projection.ProjectionError):
+            projection.EmbeddingProjection({"attributes": {"text": {"method": "umap", "dimension": 4}}}, 32)
+        with self.assertRaises(projection.ProjectionError):
+            projection.EmbeddingProjection({"attributes": {"text": {"method": "pca"}}}, 32)
+
+    """
+        A when model picks up the projection saved next to it, and has none until one is saved.
+    """
+    @unittest.skipIf(when == None, "the when model's dependencies aren't installed")
+    def test_when_loads_projection(self):
+        with mock.patch.dict(os.environ, {"ROOT_WHEN_MODELS_DIR": self.dir_path + "/"}), mock.patch("builtins.print"):
+            self.assertEqual(when.When("test").projection, None)
+
+            self.get_fit_projection().save(projection.get_projection_path("test"))
+            loaded = when.When("test").projection
+
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, "test", "projection.pkl")))
+        np.testing.assert_array_equal(loaded.transform("text", self.matrix), self.get_fit_projection().transform("text", self.matrix))
+
+if __name__ == '__main__':
+    unittest.main()
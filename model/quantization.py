@@ -0,0 +1,170 @@
+"""
+    Compact representations of embeddings, for holding many of them in memory at once
+    while exporting features and running simulations.
+"""
+
+import numpy as np
+
+QUANTIZATION_MODES = ["float32", "float16", "int8"]
+
+QUANTIZATION_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+class QuantizationError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+"""
+    Quantize each row of a float matrix to int8, with its own scale so that
+    the row's largest absolute value maps to 127.
+    Returns the int8 codes and the float32 scales.
+"""
+def quantize_int8(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scales = np.abs(matrix).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(matrix / scales[:, np.newaxis]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+"""
+    A matrix of embeddings, one per row, stored as float32, float16, or int8 with a scale per row.
+"""
+class QuantizedMatrix:
+    def __init__(self, data, mode, scales=None):
+        if not (mode in QUANTIZATION_MODES):
+            raise QuantizationError(f"Error: unknown quantization mode {mode}, must be one of {QUANTIZATION_MODES}.")
+        if mode == "int8" and scales is None:
+            raise QuantizationError("Error: an int8 quantized matrix needs a scale for each row.")
+
+        self.data = data
+        self.mode = mode
+        self.scales = scales
+
+    @staticmethod
+    def from_float(matrix, mode):
+        if mode == "int8":
+            codes, scales = quantize_int8(matrix)
+            return QuantizedMatrix(codes, mode, scales=scales)
+        if mode == "float16":
+            return QuantizedMatrix(np.asarray(matrix, dtype=np.float16), mode)
+        return QuantizedMatrix(np.asarray(matrix, dtype=np.float32), mode)
+
+    """
+        Create a matrix of a given shape in .npy files at a path prefix, laid out as by save,
+        and opened as writable memory maps, to be filled a row at a time with set_row.
+    """
+    @staticmethod
+    def open_memmap(path, mode, shape):
+        if not (mode in QUANTIZATION_MODES):
+            raise QuantizationError(f"Error: unknown quantization mode {mode}, must be one of {QUANTIZATION_MODES}.")
+
+        data = np.lib.format.open_memmap(f"{path}.data.npy", mode="w+", dtype=QUANTIZATION_DTYPES[mode], shape=shape)
+        scales = np.lib.format.open_memmap(f"{path}.scales.npy", mode="w+", dtype=np.float32, shape=(shape[0],)) if mode == "int8" else None
+        return QuantizedMatrix(data, mode, scales=scales)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    """
+        Quantize a float vector into a row.
+    """
+    def set_row(self, i, vector):
+        if self.mode == "int8" and len(vector) > 0:
+            codes, scales = quantize_int8(np.asarray(vector)[np.newaxis, :])
+            self.data[i] = codes[0]
+            self.scales[i] = scales[0]
+        elif self.mode != "int8":
+            self.data[i] = vector
+
+    def flush(self):
+        for array in [self.data, self.scales]:
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    """
+        Get the float32 values of the whole matrix, or of a list of rows.
+    """
+    def dequantize(self, rows=None):
+        data = self.data if rows is None else self.data[rows]
+        if self.mode == "int8":
+            scales = self.scales if rows is None else self.scales[rows]
+            return data.astype(np.float32) * scales[:, np.newaxis]
+        return data.astype(np.float32)
+
+    """
+        Get one row, still quantized, without copying it.
+    """
+    def row(self, i):
+        return QuantizedVector(self.data[i], self.mode, scale=None if self.scales is None else self.scales[i])
+
+    def get_nbytes(self):
+        return self.data.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    """
+        Save to .npy files at a path prefix, so they can be loaded back as memory maps.
+    """
+    def save(self, path):
+        np.save(f"{path}.data.npy", self.data)
+        if self.scales is not None:
+            np.save(f"{path}.scales.npy", self.scales)
+
+    @staticmethod
+    def load(path, mode, mmap_mode=None):
+        data = np.load(f"{path}.data.npy", mmap_mode=mmap_mode)
+        scales = np.load(f"{path}.scales.npy", mmap_mode=mmap_mode) if mode == "int8" else None
+        return QuantizedMatrix(data, mode, scales=scales)
+
+"""
+    A single quantized embedding, as held by an entity's attribute values.
+"""
+class QuantizedVector:
+    def __init__(self, data, mode, scale=None):
+        self.data = data
+        self.mode = mode
+        self.scale = scale
+
+    def dequantize(self):
+        if self.mode == "int8":
+            return self.data.astype(np.float32) * self.scale
+        return self.data.astype(np.float32)
+
+"""
+    Get an embedding as a float32 vector, whether it's quantized or not.
+"""
+def dequantize(embeddings):
+    if isinstance(embeddings, QuantizedVector):
+        return embeddings.dequantize()
+    return np.asarray(embeddings, dtype=np.float32)
+
+"""
+    Measure the size and accuracy of each quantization mode over a sample matrix of embeddings:
+    bytes per vector, compression against float32, the largest absolute error,
+    and the mean and worst cosine similarity of each dequantized vector to its original.
+"""
+def tradeoff_report(matrix, modes=QUANTIZATION_MODES):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    original_norms = np.linalg.norm(matrix, axis=1)
+
+    report = {}
+    for mode in modes:
+        quantized = QuantizedMatrix.from_float(matrix, mode)
+        dequantized = quantized.dequantize()
+
+        norms = original_norms * np.linalg.norm(dequantized, axis=1)
+        norms[norms == 0] = 1.0
+        cosines = (matrix * dequantized).sum(axis=1) / norms
+
+        report[mode] = {
+            "bytes_per_vector": quantized.get_nbytes() / max(len(matrix), 1),
+            "compression": matrix.nbytes / max(quantized.get_nbytes(), 1),
+            "max_abs_error": float(np.abs(matrix - dequantized).max()) if len(matrix) > 0 else 0.0,
+            "mean_cosine": float(cosines.mean()) if len(matrix) > 0 else 1.0,
+            "min_cosine": float(cosines.min()) if len(matrix) > 0 else 1.0
+        }
+
+    return report
+
+def print_tradeoff_report(report, title="Quantization tradeoffs"):
+    print(f"{title}:")
+    for mode, mode_report in report.items():
+        print(f"    {mode}: {mode_report['bytes_per_vector']:.0f} bytes per vector ({mode_report['compression']:.1f}x), "
+            f"max abs error {mode_report['max_abs_error']:.2e}, mean cosine {mode_report['mean_cosine']:.6f}, min cosine {mode_report['min_cosine']:.6f}")
@@ -0,0 +1,135 @@
+"""
+    Unit tests for quantizing embeddings, and for entities' when dicts built from quantized embeddings.
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+
+import numpy as np
+
+import entities
+import quantization
+
+def get_matrix(num_rows=20, dimension=64, seed=0):
+    return np.random.default_rng(seed).standard_normal((num_rows, dimension)).astype(np.float32)
+
+class QuantizedMatrixTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.matrix = get_matrix()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    """
+        Fill a memory mapped matrix a row at a time, and load it back from disk.
+    """
+    def fill_memmap(self, mode):
+        path = os.path.join(self.dir_path, "features")
+        quantized = quantization.QuantizedMatrix.open_memmap(path, mode, self.matrix.shape)
+        for i, vector in enumerate(self.matrix):
+            quantized.set_row(i, vector)
+        quantized.flush()
+        return quantization.QuantizedMatrix.load(path, mode, mmap_mode="r")
+
+    def test_float32_round_trip(self):
+        np.testing.assert_array_equal(self.fill_memmap("float32").dequantize(), self.matrix)
+
+    def test_float16_round_trip(self):
+        loaded = self.fill_memmap("float16")
+
+        self.assertEqual(loaded.data.dtype, np.float16)
+        np.testing.assert_allclose(loaded.dequantize(), self.matrix, rtol=1e-3, atol=1e-3)
+
+    """
+        int8 rows are scaled so the largest value of each maps to 127, which bounds the error by half a step.
+    """
+    def test_int8_round_trip(self):
+        loaded = self.fill_memmap("int8")
+        steps = np.abs(self.matrix).max(axis=1) / 127
+
+        self.assertEqual(loaded.data.dtype, np.int8)
+        self.assertTrue(np.all(np.abs(loaded.dequantize() - self.matrix) <= steps[:, np.newaxis] / 2 + 1e-6))
+        self.assertTrue(np.all(np.abs(loaded.data).max(axis=1) == 127))
+
+    """
+        Dequantizing some rows, or a single row, matches dequantizing the whole matrix.
+    """
+    def test_dequantize_rows(self):
+        for mode in quantization.QUANTIZATION_MODES:
+            quantized = quantization.QuantizedMatrix.from_float(self.matrix, mode)
+            whole = quantized.dequantize()
+
+            np.testing.assert_array_equal(quantized.dequantize([3, 1]), whole[[3, 1]])
+            np.testing.assert_array_equal(quantized.row(5).dequantize(), whole[5])
+
+    def test_zero_row(self):
+        quantized = quantization.QuantizedMatrix.from_float(np.zeros((2, 8)), "int8")
+
+        np.testing.assert_array_equal(quantized.dequantize(), np.zeros((2, 8)))
+
+    """
+        Rows with no columns, as when a when row has no embedding features, are skipped rather than quantized.
+    """
+    def test_empty_rows(self):
+        quantized = quantization.QuantizedMatrix.open_memmap(os.path.join(self.dir_path, "empty"), "int8", (3, 0))
+        quantized.set_row(0, np.zeros(0, dtype=np.float32))
+
+        self.assertEqual(quantized.dequantize().shape, (3, 0))
+
+    def test_unknown_mode(self):
+        with self.assertRaises(quantization.QuantizationError):
+            quantization.QuantizedMatrix(self.matrix, "int4")
+        with self.assertRaises(quantization.QuantizationError):
+            quantization.QuantizedMatrix(self.matrix, "int8")
+
+"""
+    A comment with an embedded text attribute and a time attribute that go into the when model.
+"""
+class WhenComment(entities.Stem):
+    model = entities.EntityModel(
+        "id",
+        "comments",
+        entities.AttClassModel([
+            entities.SqliteAttModel("by", False, False, "str", "TEXT"),
+            entities.SqliteAttModel("id", False, False, "int", "INTEGER"),
+            entities.SqliteAttModel("time", False, True, "int", "INTEGER"),
+            entities.SqliteAttModel("text", True, True, "str", "TEXT"),
+        ]),
+        entities.AttClassModel([]),
+        entities.AttClassModel([])
+    )
+
+class WhenDictTests(unittest.TestCase):
+
+    """
+        An entity holding quantized embeddings gives float32 embeddings in its when dict,
+        dequantized the same way as the matrix they came from.
+    """
+    def test_dequantized(self):
+        matrix = get_matrix(num_rows=1, dimension=16)
+        for mode in quantization.QUANTIZATION_MODES:
+            quantized = quantization.QuantizedMatrix.from_float(matrix, mode)
+
+            comment = WhenComment(1, None, None)
+            comment.base.set_value("time", 100)
+            comment.base.set_embeddings("text", quantized.row(0))
+            when_dict = comment.get_when_dict()
+
+            self.assertEqual(list(when_dict.keys()), ["time", "text"])
+            self.assertEqual(when_dict["text"].dtype, np.float32)
+            np.testing.assert_array_equal(when_dict["text"], quantized.dequantize()[0])
+            np.testing.assert_array_equal(when_dict["time"], [100])
+
+    def test_unquantized(self):
+        comment = WhenComment(1, None, None)
+        comment.base.set_value("time", 100)
+        comment.base.set_embeddings("text", [0.5, -0.5])
+
+        np.testing.assert_array_equal(comment.get_when_dict()["text"], np.array([0.5, -0.5], dtype=np.float32))
+
+if __name__ == '__main__':
+    unittest.main()
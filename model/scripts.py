@@ -4,6 +4,8 @@
 """
 
 from dataset import Dataset
+import entities
+import HN_entities
 import utils
 import sys
 import functools
@@ -218,8 +220,39 @@ def _featurex_cost_estimate(dataset_name):
     Get a cost estimate of generating embeddings for a dataset.
 """
 def _embeddings_cost_estimate(dataset_name):
-    dataset = Dataset(dataset_name, existing_dataset_name=dataset_name)
-    dataset.ce_embedding_dataset()
+    forum = entities.Forum(HN_entities.HNUser, HN_entities.HNPost, HN_entities.HNComment, migrations=HN_entities.migrations)
+    dataset = Dataset(dataset_name, forum, read_only=True)
+    print(f"Estimated cost of embedding {dataset_name}: ${dataset.embedding_cost_estimate():.4f}")
+    dataset.close()
+
+"""
+    Print the size and accuracy tradeoffs of quantizing a sample of a dataset's embeddings.
+"""
+def _quantization_report(dataset_name, sample_size="1000"):
+    forum = entities.Forum(HN_entities.HNUser, HN_entities.HNPost, HN_entities.HNComment, migrations=HN_entities.migrations)
+    dataset = Dataset(dataset_name, forum, read_only=True)
+    dataset.quantization_report(sample_size=int(sample_size))
+    dataset.close()
+
+"""
+    Fit a projection of a dataset's embedded when attributes, and save it next to a when model.
+"""
+def _fit_when_projection(dataset_name, when_name, projection_config_path="when_projection_config.json"):
+    forum = entities.Forum(HN_entities.HNUser, HN_entities.HNPost, HN_entities.HNComment, migrations=HN_entities.migrations)
+    dataset = Dataset(dataset_name, forum, read_only=True, when_name=when_name)
+    embedding_projection = dataset.fit_when_projection(utils.read_json(projection_config_path))
+    embedding_projection.print_summary()
+    dataset.close()
+
+"""
+    Build the index of candidate branches for a dataset, and print its recall against brute force.
+"""
+def _build_candidate_index(dataset_name, k="100", nprobe="8"):
+    forum = entities.Forum(HN_entities.HNUser, HN_entities.HNPost, HN_entities.HNComment, migrations=HN_entities.migrations)
+    dataset = Dataset(dataset_name, forum)
+    dataset.build_candidate_index(nprobe=int(nprobe))
+    dataset.measure_candidate_recall(k=int(k))
+    dataset.close()
 
 """
     Print the full user pool of the dataset.
@@ -285,6 +318,9 @@ if __name__ == "__main__":
         "featurex_dataset": _full_featurex,
         "featurex_cost_estimate": _featurex_cost_estimate,
         "embeddings_cost_estimate": _embeddings_cost_estimate,
+        "quantization_report": _quantization_report,
+        "fit_when_projection": _fit_when_projection,
+        "build_candidate_index": _build_candidate_index,
         "print_user_pool": _print_user_pool,
         "print_user": _print_user,
         "print_item": _print_item,
@@ -1,6 +1,12 @@
 import sqlite3
 import json
 import functools
+import contextlib
+import hashlib
+import time
+import pathlib
+import re
+import threading
 
 import utils
 
@@ -30,6 +36,12 @@ class InsertionError(Exception):
         self.message = message
         super().__init__(self.message)
 
+"""
+    The number of ids bound per query in bulk selections, kept under sqlite's
+    default limit of 999 host parameters for older builds.
+"""
+SQLITE_MAX_VARIABLES = 900
+
 class MalformedSqliteDBError(Exception):
     def __init__(self, message):
         self.message = message
@@ -47,113 +59,961 @@ def check_column(index, column, att_model, table_name):
             name {col_name} and type {col_type}does not match designated type {att_model.sqlite_type}.")
 
 
+"""
+    Pragmas applied to every connection opened by a SqliteDB,
+    unless overridden with the pragmas argument.
+"""
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000
+}
+
+"""
+    Get the column list for a select query over the given attribute models,
+    always including the id attribute if one is given.
+    If no models are given, select every column.
+"""
+def get_columns_str(att_model_list, id_att=None):
+    if att_model_list == None:
+        return "*"
+
+    att_names = [att.name for att in att_model_list]
+    if id_att != None and not (id_att in att_names):
+        att_names = [id_att, *att_names]
+
+    return ", ".join(att_names)
+
+"""
+    Pragmas applied to connections of a SqliteDB opened in read only mode.
+    The whole file can be memory mapped, so that many processes reading the same
+    dataset share the OS page cache rather than each keeping their own copy.
+"""
+READ_ONLY_PRAGMAS = {
+    "query_only": "ON",
+    "cache_size": -64000,
+    "mmap_size": 17179869184,
+    "temp_store": "MEMORY"
+}
+
+"""
+    The version of the submission history triggers, part of the schema fingerprint,
+    so that databases with triggers from an older version have them recreated on open.
+"""
+USER_SUBMISSIONS_TRIGGERS_VERSION = 2
+
+"""
+    Get a hash of everything about the forum's entity models that determines the database schema:
+    tables, column names, types and order, and indexes.
+"""
+def get_schema_fingerprint(forum):
+    schema = []
+    for entity_model in forum.get_entity_models():
+        schema.append({
+            "table_name": entity_model.table_name,
+            "id_att": entity_model.id_att,
+            "columns": [[att.name, att.sqlite_type] for att in entity_model.base.att_list + entity_model.generated.att_list],
+            "indexes": [[index.name, index.att_names, index.where, index.unique] for index in entity_model.indexes],
+            "full_text": [att.name for att in entity_model.full_text_atts]
+        })
+    schema.append({
+        "triggers_version": USER_SUBMISSIONS_TRIGGERS_VERSION,
+        "submission_histories": [[history.kind, history.submission_model.table_name, history.author_att, history.id_list_att, history.time_att] for history in forum.get_submission_histories()]
+    })
+    return hashlib.sha256(json.dumps(schema).encode("utf-8")).hexdigest()
+
+def get_fts_table_name(table_name):
+    return f"{table_name}_fts"
+
+"""
+    Get the shape of a statement, for grouping its stats: whitespace is collapsed,
+    and parenthesized lists of placeholders are collapsed so every chunk size of an IN query counts as one shape.
+"""
+def get_statement_shape(query):
+    shape = " ".join(query.split())
+    return re.sub(r"\(\s*\?(\s*,\s*\?)*\s*\)", "(?, ...)", shape)
+
+"""
+    Counters for the statements run by a SqliteDB, keyed by statement shape:
+    how many times each was run, the total time spent in it, and the rows it returned and wrote.
+"""
+class QueryStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.shapes = {}
+
+    def get_shape_stats(self, shape):
+        if not (shape in self.shapes):
+            self.shapes[shape] = {
+                "count": 0,
+                "time": 0.0,
+                "rows_returned": 0,
+                "rows_written": 0
+            }
+        return self.shapes[shape]
+
+    def record(self, shape, elapsed, rows_returned=0, rows_written=0, count=1):
+        with self.lock:
+            shape_stats = self.get_shape_stats(shape)
+            shape_stats["count"] += count
+            shape_stats["time"] += elapsed
+            shape_stats["rows_returned"] += rows_returned
+            shape_stats["rows_written"] += rows_written
+
+    """
+        Get a copy of the counters, with the shapes ordered by total time spent, most first,
+        along with the totals over all shapes.
+    """
+    def snapshot(self):
+        with self.lock:
+            shapes = {shape: dict(shape_stats) for shape, shape_stats in sorted(self.shapes.items(), key=lambda item: item[1]["time"], reverse=True)}
+        totals = {key: sum([shape_stats[key] for shape_stats in shapes.values()]) for key in ["count", "time", "rows_returned", "rows_written"]}
+        return {
+            "totals": totals,
+            "shapes": shapes
+        }
+
+"""
+    A schema migration, to be applied once to any database whose recorded version is older.
+    apply is called with the SqliteDB, inside the migration's transaction.
+"""
+class SqliteMigration:
+    def __init__(self, version, description, apply):
+        self.version = version
+        self.description = description
+        self.apply = apply
+
 """
     A class to hold all methods used to access the database.
+
+    A single connection is opened on first use and kept alive until close() is called,
+    rather than connecting once per query. It can also be used as a context manager:
+
+        with SqliteDB(path, forum) as sqlite:
+            ...
+
+    It's safe to share across threads: each thread gets its own connection and cursor,
+    opened on its first query, and writes and transactions are serialized with a lock,
+    while reads run concurrently alongside them under WAL.
+
+    Every statement is timed and counted by shape, see stats().
+    If slow_query_threshold is given in seconds, any statement taking at least that long
+    is printed along with its query plan.
+
+    If read_only is set, the database is opened as an immutable, memory mapped file,
+    any writes will fail, and it's only checked against the entity models rather than migrated.
+    This is meant for runs which never write, such as training export and simulation,
+    so that many workers can share one dataset without any locking.
+    Since sqlite trusts the file not to change, nothing may write to it while it's open this way,
+    and all writers must have closed so their WAL is checkpointed into the main file.
 """
 class SqliteDB:
-    def __init__(self, path, forum):
+    def __init__(self, path, forum, pragmas=None, read_only=False, slow_query_threshold=None):
         self.path = path
+        self.read_only = read_only
+        self.slow_query_threshold = slow_query_threshold
+        self.query_stats = QueryStats()
+        default_pragmas = READ_ONLY_PRAGMAS if self.read_only else DEFAULT_PRAGMAS
+        self.pragmas = {**default_pragmas, **(pragmas if pragmas != None else {})}
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+        self.write_lock = threading.RLock()
+        self.local = threading.local()
 
-        if utils.check_file_exists(self.path):
+        if self.read_only:
+            if not utils.check_file_exists(self.path):
+                raise MalformedSqliteDBError(f"Error: cannot open sqlite database at {self.path} in read only mode, as it does not exist.")
+            self.check_read_only_db(forum)
+        elif utils.check_file_exists(self.path):
             self.check_existing_db(forum)
         else:
             self.create(forum)
 
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    """
+        The calling thread's connection, or None if it hasn't opened one.
+    """
+    @property
+    def conn(self):
+        return self.connections.get(threading.get_ident())
+
+    """
+        The calling thread's current cursor.
+    """
+    @property
+    def cursor(self):
+        return getattr(self.local, "cursor", None)
+
+    @cursor.setter
+    def cursor(self, cursor):
+        self.local.cursor = cursor
+
+    """
+        How many transaction blocks the calling thread is inside.
+    """
+    @property
+    def transaction_depth(self):
+        return getattr(self.local, "transaction_depth", 0)
+
+    @transaction_depth.setter
+    def transaction_depth(self, transaction_depth):
+        self.local.transaction_depth = transaction_depth
+
+    """
+        Open the calling thread's connection to the database if it isn't already, and apply the pragmas.
+    """
+    def open(self):
+        conn = self.conn
+        if conn == None:
+            if self.read_only:
+                uri = pathlib.Path(self.path).absolute().as_uri() + "?mode=ro&immutable=1"
+                conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            else:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+            for pragma, value in self.pragmas.items():
+                conn.execute(f"PRAGMA {pragma} = {value}")
+            with self.connections_lock:
+                self.connections[threading.get_ident()] = conn
+        return conn
+
+    """
+        Commit anything outstanding and close every thread's connection.
+        They will be reopened on each thread's next query.
+        Should only be called once the other threads are done with the database.
+    """
+    def close(self):
+        with self.connections_lock:
+            connections = list(self.connections.values())
+            self.connections = {}
+        for conn in connections:
+            conn.commit()
+            conn.close()
+        self.cursor = None
+
+    def is_open(self):
+        return self.conn != None
+
+    """
+        Run everything inside the block as a single transaction, committing at the end
+        of the outermost block or rolling it all back if an error is raised.
+        The individual insert/update/delete methods don't commit while one is open.
+
+            with sqlite.transaction():
+                sqlite.insert(...)
+                sqlite.update(...)
+    """
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.open()
+        with self.write_lock:
+            if self.transaction_depth == 0 and not conn.in_transaction:
+                conn.execute("BEGIN")
+            self.transaction_depth += 1
+            try:
+                yield self
+            except Exception as e:
+                self.transaction_depth -= 1
+                if self.transaction_depth == 0:
+                    conn.rollback()
+                raise e
+            else:
+                self.transaction_depth -= 1
+                if self.transaction_depth == 0:
+                    conn.commit()
+
+    def in_transaction(self):
+        return self.transaction_depth > 0
+
+    def _commit(self):
+        if not self.in_transaction():
+            self.conn.commit()
+
+    """
+        Get a snapshot of the per statement shape counters since the last reset.
+    """
+    def stats(self):
+        return self.query_stats.snapshot()
+
+    def reset_stats(self):
+        self.query_stats.reset()
+
+    """
+        Run a statement on the given cursor, or the current one, timing it and
+        recording the rows it wrote. Rows returned are recorded as they're fetched, with _fetch_all.
+    """
+    def _execute(self, query, params=(), cursor=None):
+        cursor = self.cursor if cursor == None else cursor
+
+        start_time = time.perf_counter()
+        cursor.execute(query, params)
+        elapsed = time.perf_counter() - start_time
+
+        self._record_statement(query, params, elapsed, cursor.rowcount)
+        return cursor
+
+    def _executemany(self, query, params_list, cursor=None):
+        cursor = self.cursor if cursor == None else cursor
+        params_list = list(params_list)
+
+        start_time = time.perf_counter()
+        cursor.executemany(query, params_list)
+        elapsed = time.perf_counter() - start_time
+
+        self._record_statement(query, params_list[0] if len(params_list) > 0 else (), elapsed, cursor.rowcount, count=len(params_list))
+        return cursor
+
+    """
+        Fetch the rest of the rows of the last statement run on a cursor, adding the rows
+        and the time spent stepping through them to the statement's stats.
+    """
+    def _fetch_all(self, query, cursor=None):
+        cursor = self.cursor if cursor == None else cursor
+
+        start_time = time.perf_counter()
+        row_tuples = cursor.fetchall()
+        elapsed = time.perf_counter() - start_time
+
+        self.query_stats.record(get_statement_shape(query), elapsed, rows_returned=len(row_tuples), count=0)
+        return row_tuples
+
+    def _record_statement(self, query, params, elapsed, rowcount, count=1):
+        self.query_stats.record(get_statement_shape(query), elapsed, rows_written=max(rowcount, 0), count=count)
+
+        if self.slow_query_threshold != None and elapsed >= self.slow_query_threshold:
+            self.log_slow_query(query, params, elapsed)
+
+    """
+        Print a slow statement and its query plan.
+    """
+    def log_slow_query(self, query, params, elapsed):
+        print(f"Slow sqlite query ({elapsed:.4f}s): {' '.join(query.split())}")
+        if not (query.split()[0].upper() in ["SELECT", "INSERT", "UPDATE", "DELETE", "WITH"]):
+            return
+        try:
+            plan_rows = self.conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+        except sqlite3.Error as e:
+            print(f"Could not get query plan: {e}")
+            return
+        for plan_row in plan_rows:
+            print(f"    {plan_row[-1]}")
+
+    """
+        Run a method with the calling thread's connection open and a fresh cursor,
+        rolling back on an error unless inside a transaction block.
+    """
+    def _run_with_db(self, func, *args, **kwargs):
+        conn = self.open()
+        self.cursor = conn.cursor()
+        try:
+            return func(self, *args, **kwargs)
+        except Exception as e:
+            if not self.in_transaction():
+                conn.rollback()
+            raise e
+
     def _with_db(func):
         @functools.wraps(func)
         def wrapper(self, *args, **kwargs):
-            with sqlite3.connect(self.path) as conn:
-                self.conn = conn
-                self.cursor = conn.cursor()
-                return func(self, *args, **kwargs)
+            return self._run_with_db(func, *args, **kwargs)
         return wrapper
 
-    @_with_db
+    """
+        For methods which write, also holding the write lock so that only one thread writes at a time.
+    """
+    def _with_db_write(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.write_lock:
+                return self._run_with_db(func, *args, **kwargs)
+        return wrapper
+
+    @_with_db_write
     def add_cols(self, table_name, att_models):
 
         for att_model in att_models:
-            self.cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {att_model.name} {att_model.sqlite_type}")
+            self._execute(f"ALTER TABLE {table_name} ADD COLUMN {att_model.name} {att_model.sqlite_type}")
 
-        self.conn.commit()
+        self._commit()
 
-    @_with_db
+    """
+        Bring an existing database up to date with the forum's entity models.
+    """
     def check_existing_db(self, forum):
-        for entity_model in forum.get_entity_models():
-            self.cursor.execute(f"PRAGMA table_info({entity_model.table_name})")
+        self.migrate(forum)
+
+    """
+        Check that a database opened in read only mode matches the forum's entity models,
+        without altering anything. As when migrating, columns the models don't know about are allowed.
+        The FTS5 and submission history tables must be there too, which a JS pipeline database
+        only has once it's been opened, and so migrated, without read_only.
+    """
+    @_with_db
+    def check_read_only_db(self, forum):
+        self._execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        table_names = [row[0] for row in self.cursor.fetchall()]
+
+        required_table_names = [get_fts_table_name(entity_model.table_name) for entity_model in forum.get_entity_models() if len(entity_model.full_text_atts) > 0]
+        if len(forum.get_submission_histories()) > 0:
+            required_table_names.append("user_submissions")
+
+        missing_table_names = [table_name for table_name in required_table_names if not (table_name in table_names)]
+        if len(missing_table_names) > 0:
+            raise MalformedSqliteDBError(f"Error: read only sqlite database {self.path} is missing tables {missing_table_names}. Open it once without read_only to migrate it first.")
 
+        for entity_model in forum.get_entity_models():
+            self._execute(f"PRAGMA table_info({entity_model.table_name})")
             columns = self.cursor.fetchall()
-            num_cols = len(columns)
 
-            num_base_atts = len(entity_model.base.att_list)
-            num_generated_atts = len(entity_model.generated.att_list)
-            num_table_atts = num_base_atts + num_generated_atts
+            if len(columns) == 0:
+                raise MalformedSqliteDBError(f"Error: table {entity_model.table_name} is missing from read only sqlite database.")
+
+            remaining_gen_atts, extra_columns = self.check_table_columns(entity_model, columns)
+            if len(remaining_gen_atts) > 0:
+                raise MalformedSqliteDBError(f"Error: table {entity_model.table_name} in read only sqlite database is missing generated columns {[att.name for att in remaining_gen_atts]}.")
 
-            if num_cols < num_base_atts and num_cols >= num_table_atts:
-                raise MalformedSqliteDBError(f"Error: table {entity_model['table_name']} in existing sqlite database has improper number of columns.")
+    """
+        Check the columns of an existing table against an entity model, by name.
+        Every base attribute must be present with its designated type, as must any generated
+        attribute which is present at all.
+        Columns the model doesn't know about, such as those added by the JS scraping pipeline
+        (e.g. comments.parent), are allowed, and left alone.
+        Returns the generated attributes missing from the table, and the extra columns,
+        or raises a MalformedSqliteDBError if the table otherwise doesn't match.
+    """
+    def check_table_columns(self, entity_model, columns):
+        columns_by_name = {column[1]: column for column in columns}
 
-            for base_att_index in range(num_base_atts):
-                column = columns[base_att_index]
-                att_model = entity_model.base.att_list[base_att_index]
-                check_column(base_att_index, column, att_model, entity_model.table_name)
+        for att_model in entity_model.base.att_list:
+            if not (att_model.name in columns_by_name):
+                raise MalformedSqliteDBError(f"Error: table {entity_model.table_name} in existing sqlite database is missing column {att_model.name}.")
+            column = columns_by_name[att_model.name]
+            check_column(column[0], column, att_model, entity_model.table_name)
 
-            gen_att_index = 0
-            while num_base_atts + gen_att_index < num_cols:
-                column = columns[num_base_atts + gen_att_index]
-                att_model = entity_model.generated.att_list[gen_att_index]
-                check_column(num_base_atts + gen_att_index, column, att_model, entity_model.table_name)
-                gen_att_index += 1
+        remaining_gen_atts = []
+        for att_model in entity_model.generated.att_list:
+            if att_model.name in columns_by_name:
+                column = columns_by_name[att_model.name]
+                check_column(column[0], column, att_model, entity_model.table_name)
+            else:
+                remaining_gen_atts.append(att_model)
 
-            remaining_gen_atts = entity_model.generated.att_list[gen_att_index:]
+        model_att_names = [att.name for att in entity_model.base.att_list + entity_model.generated.att_list]
+        extra_columns = [column for column in columns if not (column[1] in model_att_names)]
 
-            self.add_cols(entity_model.table_name, remaining_gen_atts)
+        return remaining_gen_atts, extra_columns
 
     """
-        Create the sqlite database and the needed tables at the specified path.
+        Migrate the database to match the forum's entity models, in a single transaction.
+        First, every registered migration newer than the recorded schema version is applied in order.
+        Then, if the models have changed since the last recorded version, each table is synced:
+        missing tables are created, and missing generated columns are appended.
+        A table whose columns otherwise differ is never rebuilt automatically, as that could lose data;
+        a migration calling rebuild_table has to be registered for it instead.
+    """
+    @_with_db_write
+    def migrate(self, forum):
+        with self.transaction():
+            self.create_schema_version_table()
+            self.create_user_submissions_table()
+
+            current_version, current_fingerprint = self.get_schema_version()
+
+            applied_migration = False
+            migrations = sorted(forum.migrations, key=lambda m: m.version)
+            for migration in migrations:
+                if migration.version > current_version:
+                    print(f"Applying sqlite migration {migration.version}: {migration.description}...")
+                    migration.apply(self)
+                    current_version = migration.version
+                    self.record_schema_version(current_version, migration.description, current_fingerprint)
+                    applied_migration = True
+
+            fingerprint = get_schema_fingerprint(forum)
+            if fingerprint != current_fingerprint or applied_migration:
+                for entity_model in forum.get_entity_models():
+                    self.sync_table(entity_model)
+                self.create_indexes(forum)
+                self.create_full_text_indexes(forum, rebuild=True)
+                self.create_user_submissions_triggers(forum, rebuild=True)
+                self.record_schema_version(current_version, "sync with entity models", fingerprint)
+
+    """
+        Bring a single table in line with its entity model, by creating it or appending
+        missing generated columns. Raises a MalformedSqliteDBError if it needs anything more.
+    """
+    @_with_db_write
+    def sync_table(self, entity_model):
+        self._execute(f"PRAGMA table_info({entity_model.table_name})")
+        columns = self.cursor.fetchall()
+
+        if len(columns) == 0:
+            self.create_table(entity_model)
+            return
+
+        try:
+            remaining_gen_atts, extra_columns = self.check_table_columns(entity_model, columns)
+        except MalformedSqliteDBError as e:
+            raise MalformedSqliteDBError(f"{e.message} Register a SqliteMigration which rebuilds table {entity_model.table_name} to migrate it.")
+
+        self.add_cols(entity_model.table_name, remaining_gen_atts)
+
+    """
+        Rebuild a table to match its entity model, copying over every column the old
+        and new versions share with a single INSERT INTO ... SELECT, cast to the new types.
+        Columns the model doesn't know about are carried over as they are.
+        This is only meant to be called from a registered SqliteMigration; indexes and triggers are
+        dropped with the old table, and are recreated by migrate afterwards.
+    """
+    @_with_db_write
+    def rebuild_table(self, entity_model):
+        table_name = entity_model.table_name
+        new_table_name = f"{table_name}_migrating"
+
+        self._execute(f"PRAGMA table_info({table_name})")
+        columns = self.cursor.fetchall()
+
+        old_col_names = [column[1] for column in columns]
+        model_atts = entity_model.base.att_list + entity_model.generated.att_list
+        shared_atts = [att for att in model_atts if att.name in old_col_names]
+        extra_columns = [column for column in columns if not (column[1] in [att.name for att in model_atts])]
+
+        self.create_table(entity_model, table_name=new_table_name)
+        for column in extra_columns:
+            self._execute(f"ALTER TABLE {new_table_name} ADD COLUMN {column[1]} {column[2]}")
+
+        copy_col_names = [att.name for att in shared_atts] + [column[1] for column in extra_columns]
+        copy_query = f"""
+            INSERT INTO {new_table_name}
+            ({', '.join(copy_col_names)})
+            SELECT {', '.join([f"CAST({att.name} AS {att.sqlite_type})" for att in shared_atts] + [column[1] for column in extra_columns])}
+            FROM {table_name}
+        """
+        self._execute(copy_query)
+
+        self._execute(f"DROP TABLE {table_name}")
+        self._execute(f"ALTER TABLE {new_table_name} RENAME TO {table_name}")
+
+        self._commit()
+
+    @_with_db_write
+    def create_schema_version_table(self):
+        self._execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                id INTEGER PRIMARY KEY,
+                version INTEGER,
+                description TEXT,
+                fingerprint TEXT,
+                applied_at INTEGER
+            )
+        """)
+
+        self._commit()
+
+    """
+        Get the latest recorded migration version and entity model fingerprint.
     """
     @_with_db
-    def create(self, forum):
+    def get_schema_version(self):
+        self._execute("SELECT version, fingerprint FROM schema_version ORDER BY id DESC LIMIT 1")
+        row = self.cursor.fetchone()
+        return (0, None) if row == None else row
+
+    @_with_db_write
+    def record_schema_version(self, version, description, fingerprint):
+        self._execute("""
+            INSERT INTO schema_version (version, description, fingerprint, applied_at) VALUES (?, ?, ?, ?)
+        """, (version, description, fingerprint, int(time.time())))
+
+        self._commit()
+
+    """
+        Create any of the indexes declared on the forum's entity models that aren't present yet.
+    """
+    @_with_db_write
+    def create_indexes(self, forum):
         for entity_model in forum.get_entity_models():
-            atts = entity_model.base.att_list + entity_model.generated.att_list
+            for index in entity_model.indexes:
+                create_index_query = f"""
+                    CREATE {'UNIQUE' if index.unique else ''} INDEX IF NOT EXISTS {index.name}
+                    ON {entity_model.table_name} ({', '.join(index.att_names)})
+                    {'WHERE ' + index.where if index.where != None else ''}
+                """
+                self._execute(create_index_query)
 
-            create_table_query = f"CREATE TABLE {entity_model.table_name} (" + "\n"
+        self._commit()
 
-            att_strs = [
-                f"{att.name} {att.sqlite_type} {'PRIMARY KEY' if entity_model.id_att == att.name else ''}"
-                for att in atts
-            ]
-            create_table_query += ', \n'.join(att_strs)
-            create_table_query += "\n);"
-            self.cursor.execute(create_table_query)
-        
-        self.conn.commit()
+    """
+        Create an FTS5 table mirroring the full text attributes of each entity model,
+        along with triggers keeping it in sync with every insert, update and delete on the entity's table.
+        The FTS5 tables use the entity tables as external content, so the text isn't stored twice.
+        If rebuild is set, any existing ones are dropped and rebuilt from the current contents,
+        e.g. after the entity tables have been migrated.
+    """
+    @_with_db_write
+    def create_full_text_indexes(self, forum, rebuild=False):
+        for entity_model in forum.get_entity_models():
+            table_name = entity_model.table_name
+            fts_table_name = get_fts_table_name(table_name)
+
+            if rebuild:
+                for trigger in ["insert", "delete", "update"]:
+                    self._execute(f"DROP TRIGGER IF EXISTS {fts_table_name}_{trigger}")
+                self._execute(f"DROP TABLE IF EXISTS {fts_table_name}")
+
+            if len(entity_model.full_text_atts) == 0:
+                continue
+
+            att_names = [att.name for att in entity_model.full_text_atts]
+            cols_str = ", ".join(att_names)
+            new_vals_str = ", ".join([f"new.{att_name}" for att_name in att_names])
+            old_vals_str = ", ".join([f"old.{att_name}" for att_name in att_names])
+
+            self._execute(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table_name}
+                USING fts5({cols_str}, content='{table_name}', content_rowid='rowid')
+            """)
+
+            self._execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {fts_table_name}_insert AFTER INSERT ON {table_name} BEGIN
+                    INSERT INTO {fts_table_name} (rowid, {cols_str}) VALUES (new.rowid, {new_vals_str});
+                END
+            """)
+            self._execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {fts_table_name}_delete AFTER DELETE ON {table_name} BEGIN
+                    INSERT INTO {fts_table_name} ({fts_table_name}, rowid, {cols_str}) VALUES ('delete', old.rowid, {old_vals_str});
+                END
+            """)
+            self._execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {fts_table_name}_update AFTER UPDATE OF {cols_str} ON {table_name} BEGIN
+                    INSERT INTO {fts_table_name} ({fts_table_name}, rowid, {cols_str}) VALUES ('delete', old.rowid, {old_vals_str});
+                    INSERT INTO {fts_table_name} (rowid, {cols_str}) VALUES (new.rowid, {new_vals_str});
+                END
+            """)
+
+            if rebuild:
+                self._execute(f"INSERT INTO {fts_table_name} ({fts_table_name}) VALUES ('rebuild')")
+
+        self._commit()
+
+    """
+        Search a given entity's table by keyword, using its FTS5 index.
+        The query is in FTS5 syntax, e.g. 'rust AND (async OR tokio)', or 'title: rust' for one column.
+        Returns up to limit attribute dicts of the best matching rows, by bm25 rank.
+    """
+    @_with_db
+    def search(self, table_name, query, limit=10, att_model_list=None):
+        fts_table_name = get_fts_table_name(table_name)
+
+        columns_str = "t.*" if att_model_list == None else ", ".join([f"t.{att.name}" for att in att_model_list])
+
+        search_query = f"""
+            SELECT {columns_str} FROM {fts_table_name} f
+            JOIN {table_name} t ON t.rowid = f.rowid
+            WHERE {fts_table_name} MATCH ?
+            ORDER BY f.rank
+            LIMIT ?
+        """
+
+        self._execute(search_query, (query, limit))
+
+        return self._fetch_att_dicts(search_query)
+
+    """
+        Create the table holding each user's submission history, one row per submission,
+        indexed so that a user's latest submissions of a kind before some time are a single range scan.
+    """
+    @_with_db_write
+    def create_user_submissions_table(self):
+        self._execute("""
+            CREATE TABLE IF NOT EXISTS user_submissions (
+                username TEXT,
+                submission_id INTEGER,
+                kind TEXT,
+                time INTEGER,
+                PRIMARY KEY (username, kind, submission_id)
+            )
+        """)
+        self._execute("""
+            CREATE INDEX IF NOT EXISTS idx_user_submissions_username_kind_time
+            ON user_submissions (username, kind, time)
+        """)
+        self._execute("""
+            CREATE INDEX IF NOT EXISTS idx_user_submissions_kind_submission_id
+            ON user_submissions (kind, submission_id)
+        """)
+
+        self._commit()
+
+    """
+        Create triggers keeping the submission history table in sync with the forum's submission histories,
+        the same way the FTS5 tables are kept in sync, so that rows written by anything,
+        including the JS scraping pipeline, are picked up.
+        Authored kinds follow inserts, updates and deletes on the submission's table.
+        Listed kinds follow the users table's id lists, and take their times from the submission's table
+        once the submission is there, as a user's list can name submissions which haven't been scraped yet.
+        If rebuild is set, every existing history trigger is dropped, and the table is refilled from the current contents.
+    """
+    @_with_db_write
+    def create_user_submissions_triggers(self, forum, rebuild=False):
+        user_model = forum.user.model
+
+        if rebuild:
+            self._execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'user_submissions\\_%' ESCAPE '\\'")
+            for row in self.cursor.fetchall():
+                self._execute(f"DROP TRIGGER IF EXISTS {row[0]}")
+            self._execute("DELETE FROM user_submissions")
+
+        for history in forum.get_submission_histories():
+            kind = history.kind
+            table_name = history.submission_model.table_name
+            id_att = history.submission_model.id_att
+            time_att = history.time_att
+            trigger_prefix = f"user_submissions_{kind}"
+
+            if history.author_att != None:
+                author_att = history.author_att
+
+                self._execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {trigger_prefix}_insert AFTER INSERT ON {table_name}
+                    WHEN new.{author_att} IS NOT NULL BEGIN
+                        INSERT OR REPLACE INTO user_submissions (username, submission_id, kind, time)
+                        VALUES (new.{author_att}, new.{id_att}, '{kind}', new.{time_att});
+                    END
+                """)
+                self._execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {trigger_prefix}_update AFTER UPDATE OF {author_att}, {time_att} ON {table_name} BEGIN
+                        DELETE FROM user_submissions WHERE kind = '{kind}' AND submission_id = old.{id_att};
+                        INSERT OR REPLACE INTO user_submissions (username, submission_id, kind, time)
+                        SELECT new.{author_att}, new.{id_att}, '{kind}', new.{time_att} WHERE new.{author_att} IS NOT NULL;
+                    END
+                """)
+                self._execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {trigger_prefix}_delete AFTER DELETE ON {table_name} BEGIN
+                        DELETE FROM user_submissions WHERE kind = '{kind}' AND submission_id = old.{id_att};
+                    END
+                """)
+
+                if rebuild:
+                    self._execute(f"""
+                        INSERT OR REPLACE INTO user_submissions (username, submission_id, kind, time)
+                        SELECT {author_att}, {id_att}, '{kind}', {time_att} FROM {table_name} WHERE {author_att} IS NOT NULL
+                    """)
+            else:
+                user_table_name = user_model.table_name
+                user_id_att = user_model.id_att
+                id_list_att = history.id_list_att
+
+                insert_listed_query = f"""
+                    INSERT OR REPLACE INTO user_submissions (username, submission_id, kind, time)
+                    SELECT new.{user_id_att}, j.value, '{kind}', (SELECT s.{time_att} FROM {table_name} s WHERE s.{id_att} = j.value)
+                    FROM json_each(CASE WHEN json_valid(new.{id_list_att}) THEN new.{id_list_att} ELSE '[]' END) j;
+                """
+
+                self._execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {trigger_prefix}_user_insert AFTER INSERT ON {user_table_name} BEGIN
+                        {insert_listed_query}
+                    END
+                """)
+                self._execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {trigger_prefix}_user_update AFTER UPDATE OF {user_id_att}, {id_list_att} ON {user_table_name}
+                    WHEN old.{user_id_att} IS NOT new.{user_id_att} OR old.{id_list_att} IS NOT new.{id_list_att} BEGIN
+                        DELETE FROM user_submissions WHERE kind = '{kind}' AND username = old.{user_id_att};
+                        {insert_listed_query}
+                    END
+                """)
+                self._execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {trigger_prefix}_user_delete AFTER DELETE ON {user_table_name} BEGIN
+                        DELETE FROM user_submissions WHERE kind = '{kind}' AND username = old.{user_id_att};
+                    END
+                """)
+                self._execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {trigger_prefix}_submission_insert AFTER INSERT ON {table_name} BEGIN
+                        UPDATE user_submissions SET time = new.{time_att} WHERE kind = '{kind}' AND submission_id = new.{id_att};
+                    END
+                """)
+                self._execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {trigger_prefix}_submission_update AFTER UPDATE OF {time_att} ON {table_name} BEGIN
+                        UPDATE user_submissions SET time = new.{time_att} WHERE kind = '{kind}' AND submission_id = new.{id_att};
+                    END
+                """)
+
+                if rebuild:
+                    self._execute(f"""
+                        INSERT OR REPLACE INTO user_submissions (username, submission_id, kind, time)
+                        SELECT u.{user_id_att}, j.value, '{kind}', s.{time_att}
+                        FROM {user_table_name} u, json_each(u.{id_list_att}) j
+                        LEFT JOIN {table_name} s ON s.{id_att} = j.value
+                        WHERE json_valid(u.{id_list_att})
+                    """)
+
+        self._commit()
+
+    """
+        Get the rows of a user's submissions of a given kind from the submission's table, with one join,
+        latest first. Optionally only those from before a given time, and at most limit of them.
+    """
+    @_with_db
+    def get_user_submissions(self, username, kind, table_name, id_att, before=None, limit=None, att_model_list=None):
+        columns_str = "s.*" if att_model_list == None else ", ".join([f"s.{att.name}" for att in att_model_list])
+
+        select_query = f"""
+            SELECT {columns_str} FROM user_submissions us
+            JOIN {table_name} s ON s.{id_att} = us.submission_id
+            WHERE us.username = ? AND us.kind = ?
+        """
+        params = [username, kind]
+
+        if before != None:
+            select_query += " AND us.time < ?"
+            params.append(before)
+
+        select_query += " ORDER BY us.time DESC"
+
+        if limit != None:
+            select_query += " LIMIT ?"
+            params.append(limit)
+
+        self._execute(select_query, tuple(params))
+
+        return self._fetch_att_dicts(select_query)
+
+    """
+        Create the sqlite database and the needed tables at the specified path.
+    """
+    @_with_db_write
+    def create(self, forum):
+        with self.transaction():
+            for entity_model in forum.get_entity_models():
+                self.create_table(entity_model)
+
+            self.create_indexes(forum)
+            self.create_full_text_indexes(forum)
+            self.create_user_submissions_table()
+            self.create_user_submissions_triggers(forum)
+
+            self.create_schema_version_table()
+            latest_version = max([0, *[migration.version for migration in forum.migrations]])
+            self.record_schema_version(latest_version, "create", get_schema_fingerprint(forum))
+
+    """
+        Create the table for a given entity model, optionally under a different name.
+    """
+    @_with_db_write
+    def create_table(self, entity_model, table_name=None):
+        atts = entity_model.base.att_list + entity_model.generated.att_list
+
+        create_table_query = f"CREATE TABLE {entity_model.table_name if table_name == None else table_name} (" + "\n"
+
+        att_strs = [
+            f"{att.name} {att.sqlite_type} {'PRIMARY KEY' if entity_model.id_att == att.name else ''}"
+            for att in atts
+        ]
+        create_table_query += ', \n'.join(att_strs)
+        create_table_query += "\n);"
+        self._execute(create_table_query)
+
+        self._commit()
 
     """
         Run a given selection query on a given entity's table, given a where dict.
+        Only the columns of the given attribute models are read, or every column if it's None.
     """
     @_with_db
     def select(self, table_name, att_model_list, where_dict):
-        where_str = ", ".join([f"{att} = ?" for att in list(where_dict.keys())])
+        where_str = " AND ".join([f"{att} = ?" for att in list(where_dict.keys())])
 
         select_query = f"""
-            SELECT * FROM {table_name} WHERE {where_str}
+            SELECT {get_columns_str(att_model_list)} FROM {table_name} WHERE {where_str}
         """
 
-        self.cursor.execute(select_query, tuple(where_dict.values()))
+        self._execute(select_query, tuple(where_dict.values()))
 
-        row_tuples = self.cursor.fetchall()
+        return self._fetch_att_dicts(select_query)
 
-        att_dict_list = []
-        for row_tuple in row_tuples:
-            att_dict = {}
-            for att, val in list(zip(att_model_list, list(row_tuple))):
-                att_dict[att.name] = val
-        
-        return att_dict_list
-    
     """
-        Insert some items to a given entity's table, given a list of attribute dicts
+        Convert the rows of the last query run into attribute dicts, keyed by column name.
+    """
+    def _fetch_att_dicts(self, query):
+        col_names = [description[0] for description in self.cursor.description]
+        return [dict(zip(col_names, row_tuple)) for row_tuple in self._fetch_all(query)]
+
+    """
+        Select the rows of a given entity's table with a list of ids, using IN queries chunked
+        to stay under sqlite's variable limit.
+        If an attribute model list is given, only those columns are read, along with the id.
+        Returns a dict of rows keyed by id, and a list of the ids that could not be found.
     """
     @_with_db
+    def get_by_ids(self, id_att, table_name, ids, att_model_list=None, chunk_size=SQLITE_MAX_VARIABLES):
+        unique_ids = list(dict.fromkeys(ids))
+        columns_str = get_columns_str(att_model_list, id_att=id_att)
+
+        rows = {}
+        for i in range(0, len(unique_ids), chunk_size):
+            chunk = unique_ids[i:i + chunk_size]
+
+            select_query = f"""
+                SELECT {columns_str} FROM {table_name} WHERE {id_att} IN ({', '.join(['?' for id_val in chunk])})
+            """
+
+            self._execute(select_query, tuple(chunk))
+
+            for att_dict in self._fetch_att_dicts(select_query):
+                rows[att_dict[id_att]] = att_dict
+
+        missing_ids = [id_val for id_val in unique_ids if not (id_val in rows)]
+
+        return rows, missing_ids
+
+    """
+        Iterate through the rows of a given entity's table matching an optional where dict,
+        fetching batch_size rows at a time so the full result is never held in memory.
+        Only the columns of the given attribute models are read, or every column if it's None.
+        Rows are yielded as attribute dicts, or as plain tuples if as_tuples is set.
+    """
+    def iter_rows(self, table_name, att_model_list, where_dict=None, order_by=None, batch_size=1000, as_tuples=False):
+        where_dict = {} if where_dict == None else where_dict
+
+        select_query = f"SELECT {get_columns_str(att_model_list)} FROM {table_name}"
+        if len(where_dict) > 0:
+            select_query += " WHERE " + " AND ".join([f"{att} = ?" for att in list(where_dict.keys())])
+        if order_by != None:
+            select_query += f" ORDER BY {order_by}"
+
+        cursor = self.open().cursor()
+        try:
+            self._execute(select_query, tuple(where_dict.values()), cursor=cursor)
+            col_names = [description[0] for description in cursor.description]
+
+            shape = get_statement_shape(select_query)
+            while True:
+                start_time = time.perf_counter()
+                row_tuples = cursor.fetchmany(batch_size)
+                self.query_stats.record(shape, time.perf_counter() - start_time, rows_returned=len(row_tuples), count=0)
+                if len(row_tuples) == 0:
+                    break
+                for row_tuple in row_tuples:
+                    yield row_tuple if as_tuples else dict(zip(col_names, row_tuple))
+        finally:
+            cursor.close()
+
+    """
+        Insert some items to a given entity's table, given a list of attribute dicts
+    """
+    @_with_db_write
     def insert(self, table_name, att_dict_list, att_model_list, ignore_dups=False):
 
         tuples_to_insert = [tuple([att_dict[att_model.name] for att_model in att_model_list]) for att_dict in att_dict_list]
@@ -165,20 +1025,50 @@ class SqliteDB:
             VALUES ({', '.join(['?' for att in att_model_list])})
         """
 
-        self.cursor.executemany(insertion_query, tuples_to_insert)
+        self._executemany(insertion_query, tuples_to_insert)
 
-        self.conn.commit()
+        self._commit()
+
+    """
+        Insert some items to a given entity's table, given a list of attribute dicts,
+        updating the existing row instead wherever one with the same conflict_att is present.
+        If only_if_changed is set, existing rows are only rewritten if at least one value differs.
+    """
+    @_with_db_write
+    def upsert(self, table_name, att_dict_list, att_model_list, conflict_att, only_if_changed=False):
+
+        tuples_to_upsert = [tuple([att_dict[att_model.name] for att_model in att_model_list]) for att_dict in att_dict_list]
+
+        update_atts = [att.name for att in att_model_list if att.name != conflict_att]
+
+        if len(update_atts) == 0:
+            conflict_str = "DO NOTHING"
+        else:
+            conflict_str = "DO UPDATE SET " + ", ".join([f"{att} = excluded.{att}" for att in update_atts])
+            if only_if_changed:
+                conflict_str += " WHERE " + " OR ".join([f"{table_name}.{att} IS NOT excluded.{att}" for att in update_atts])
+
+        upsert_query = f"""
+            INSERT INTO {table_name}
+            ({', '.join([att.name for att in att_model_list])})
+            VALUES ({', '.join(['?' for att in att_model_list])})
+            ON CONFLICT ({conflict_att}) {conflict_str}
+        """
+
+        self._executemany(upsert_query, tuples_to_upsert)
+
+        self._commit()
 
     """
         Run an update query on an item in a given entity's table, given an update dict and a where dict 
     """
-    @_with_db
+    @_with_db_write
     def update(self, table_name, where_dict, update_dict):
         if len(update_dict.keys()) == 0:
             return
 
         update_str = ", ".join([f"{att} = ?" for att in list(update_dict.keys())])
-        where_str = ", ".join([f"{att} = ?" for att in list(where_dict.keys())])
+        where_str = " AND ".join([f"{att} = ?" for att in list(where_dict.keys())])
         
         update_query = f"""
             UPDATE {table_name}
@@ -186,32 +1076,32 @@ class SqliteDB:
             WHERE {where_str}
         """
 
-        self.cursor.execute(update_query, (list(update_dict.values()) + list(where_dict.values())))
+        self._execute(update_query, (list(update_dict.values()) + list(where_dict.values())))
 
-        self.conn.commit()
+        self._commit()
 
     """
         Run a delete query on a given entity's table
     """
-    @_with_db
+    @_with_db_write
     def delete(self, table_name, where_dict):
-        where_str = ", ".join([f"{att} = ?" for att in list(where_dict.keys())])
+        where_str = " AND ".join([f"{att} = ?" for att in list(where_dict.keys())])
 
         delete_query = f"""
             DELETE FROM {table_name} WHERE {where_str}
         """
 
-        self.cursor.execute(delete_query, tuple(where_dict.values()))
+        self._execute(delete_query, tuple(where_dict.values()))
 
-        self.conn.commit()
+        self._commit()
 
     """
-        Get a row for a given entity with a given id.
+        Get a row for a given entity with a given id, optionally with only some columns.
     """
-    def get_by_id(self, id_att, table_name, id_val):
+    def get_by_id(self, id_att, table_name, id_val, att_model_list=None):
         where_dict = {id_att: id_val}
 
-        result = self.select(entity_model, where_dict)
+        result = self.select(table_name, att_model_list, where_dict)
 
         if len(result) == 0:
             raise UniqueDBItemNotFound(f"Entity with id {id_val} could not be found in the sqlite database.")
@@ -224,11 +1114,22 @@ class SqliteDB:
         Remove a list of entities from a given entity's table, given a list of ids
     """
     def delete_by_id(self, id_att, table_name, id_val):
-        id_att = entity_model['id_att']
-
         where_dict = {id_att: id_val}
         self.delete(table_name, where_dict)
 
+    """
+        Remove a list of entities from a given entity's table with one batched statement.
+    """
+    @_with_db_write
+    def delete_by_ids(self, id_att, table_name, id_list):
+        delete_query = f"""
+            DELETE FROM {table_name} WHERE {id_att} = ?
+        """
+
+        self._executemany(delete_query, [(id_val,) for id_val in id_list])
+
+        self._commit()
+
     """
         Update a list of entities given an update dict and an id
     """
@@ -0,0 +1,379 @@
+"""
+    Unit tests for opening and migrating sqlite databases,
+    including those created by the JS scraping pipeline in data/.
+"""
+
+import unittest
+import tempfile
+import sqlite3
+import shutil
+import os
+
+import entities
+import sqlite_db
+
+"""
+    The tables as the JS pipeline creates them in data/dbUtils.js.
+"""
+JS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        about TEXT,
+        karma INTEGER,
+        created INTEGER,
+        user_class TEXT,
+        post_ids TEXT,
+        comment_ids TEXT,
+        favorite_post_ids TEXT
+    );
+    CREATE TABLE IF NOT EXISTS posts (
+        by TEXT,
+        id INTEGER PRIMARY KEY,
+        score INTEGER,
+        time INTEGER,
+        title TEXT,
+        text TEXT,
+        url TEXT,
+        url_content TEXT
+    );
+    CREATE TABLE IF NOT EXISTS comments (
+        by TEXT,
+        id INTEGER PRIMARY KEY,
+        time INTEGER,
+        text TEXT,
+        parent INTEGER
+    );
+"""
+
+class User(entities.User):
+    model = entities.EntityModel(
+        "username",
+        "users",
+        entities.AttClassModel([
+            entities.SqliteAttModel("username", False, False, "str", "TEXT"),
+            entities.SqliteAttModel("about", True, True, "str", "TEXT", full_text=True),
+            entities.SqliteAttModel("karma", False, True, "int", "INTEGER"),
+            entities.SqliteAttModel("created", False, True, "int", "INTEGER"),
+            entities.SqliteAttModel("user_class", False, False, "str", "TEXT"),
+            entities.SqliteAttModel("post_ids", False, False, "list(int)", "TEXT"),
+            entities.SqliteAttModel("comment_ids", False, False, "list(int)", "TEXT"),
+            entities.SqliteAttModel("favorite_post_ids", False, False, "list(int)", "TEXT"),
+        ]),
+        entities.AttClassModel([]),
+        entities.AttClassModel([])
+    )
+
+    @classmethod
+    def get_submission_histories(cls):
+        return [
+            entities.SubmissionHistoryModel("posts", Post.model, author_att="by"),
+            entities.SubmissionHistoryModel("comments", Comment.model, author_att="by"),
+            entities.SubmissionHistoryModel("favorite_posts", Post.model, id_list_att="favorite_post_ids")
+        ]
+
+class Post(entities.Root):
+    model = entities.EntityModel(
+        "id",
+        "posts",
+        entities.AttClassModel([
+            entities.SqliteAttModel("by", False, False, "str", "TEXT"),
+            entities.SqliteAttModel("id", False, False, "int", "INTEGER"),
+            entities.SqliteAttModel("score", False, True, "int", "INTEGER"),
+            entities.SqliteAttModel("time", False, True, "int", "INTEGER"),
+            entities.SqliteAttModel("title", True, True, "str", "TEXT", full_text=True),
+            entities.SqliteAttModel("text", True, True, "str", "TEXT", full_text=True),
+            entities.SqliteAttModel("url", False, False, "str", "TEXT"),
+            entities.SqliteAttModel("url_content", False, False, "str", "TEXT"),
+        ]),
+        entities.AttClassModel([]),
+        entities.AttClassModel([
+            entities.SqliteAttModel("url_content_summary", True, True, "str", "TEXT"),
+        ]),
+        indexes=[entities.IndexModel(["time"])]
+    )
+
+class Comment(entities.Stem):
+    model = entities.EntityModel(
+        "id",
+        "comments",
+        entities.AttClassModel([
+            entities.SqliteAttModel("by", False, False, "str", "TEXT"),
+            entities.SqliteAttModel("id", False, False, "int", "INTEGER"),
+            entities.SqliteAttModel("time", False, True, "int", "INTEGER"),
+            entities.SqliteAttModel("text", True, True, "str", "TEXT", full_text=True),
+        ]),
+        entities.AttClassModel([]),
+        entities.AttClassModel([]),
+        indexes=[entities.IndexModel(["by", "time"], where="by IS NOT NULL")]
+    )
+
+def get_column_names(path, table_name):
+    conn = sqlite3.connect(path)
+    columns = [column[1] for column in conn.execute(f"PRAGMA table_info({table_name})").fetchall()]
+    conn.close()
+    return columns
+
+"""
+    Tests for opening databases created by the JS pipeline, and for the migration engine.
+"""
+class JSDatabaseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir_path, "data.db")
+
+        conn = sqlite3.connect(self.path)
+        conn.executescript(JS_SCHEMA)
+        conn.execute("INSERT INTO users VALUES ('pg', 'lisp', 100, 1, 'real', '[1]', '[2, 3]', '[]')")
+        conn.execute("INSERT INTO posts VALUES ('pg', 1, 10, 100, 'Arc', 'a lisp', '', '')")
+        conn.executemany("INSERT INTO comments VALUES (?, ?, ?, ?, ?)", [("pg", 2, 200, "first", 1), ("pg", 3, 300, "second", 2)])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def get_forum(self, migrations=None):
+        return entities.Forum(User, Post, Comment, migrations=migrations)
+
+    """
+        Opening a JS database must keep the columns the models don't know about, along with their data.
+    """
+    def test_open_keeps_extra_columns(self):
+        with sqlite_db.SqliteDB(self.path, self.get_forum()) as sqlite:
+            rows = sqlite.get_by_ids("id", "comments", [2, 3])[0]
+
+        self.assertIn("parent", get_column_names(self.path, "comments"))
+        self.assertEqual({id_val: row["parent"] for id_val, row in rows.items()}, {2: 1, 3: 2})
+
+    """
+        Missing generated columns are still appended, after any extra columns.
+    """
+    def test_open_appends_generated_columns(self):
+        sqlite_db.SqliteDB(self.path, self.get_forum()).close()
+
+        self.assertEqual(get_column_names(self.path, "posts")[-1], "url_content_summary")
+
+    """
+        Reopening a migrated JS database must not change it any further.
+    """
+    def test_reopen(self):
+        sqlite_db.SqliteDB(self.path, self.get_forum()).close()
+        sqlite_db.SqliteDB(self.path, self.get_forum()).close()
+
+        self.assertEqual(get_column_names(self.path, "comments"), ["by", "id", "time", "text", "parent"])
+
+    """
+        A table which differs from its model by more than missing generated columns
+        must raise, rather than being rebuilt.
+    """
+    def test_mismatch_raises(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("ALTER TABLE comments RENAME COLUMN time TO created_at")
+        conn.commit()
+        conn.close()
+
+        with self.assertRaises(sqlite_db.MalformedSqliteDBError):
+            sqlite_db.SqliteDB(self.path, self.get_forum())
+
+        self.assertEqual(get_column_names(self.path, "comments"), ["by", "id", "created_at", "text", "parent"])
+
+    """
+        A registered migration can rebuild a table, and extra columns are carried through it.
+    """
+    def test_rebuild_migration(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("ALTER TABLE comments RENAME COLUMN time TO created_at")
+        conn.commit()
+        conn.close()
+
+        def rename_time(sqlite):
+            sqlite._execute("ALTER TABLE comments RENAME COLUMN created_at TO time")
+            sqlite.rebuild_table(Comment.model)
+
+        forum = self.get_forum(migrations=[sqlite_db.SqliteMigration(1, "rename comments.created_at", rename_time)])
+        with sqlite_db.SqliteDB(self.path, forum) as sqlite:
+            rows = sqlite.get_by_ids("id", "comments", [2])[0]
+            self.assertEqual(sqlite.get_schema_version()[0], 1)
+            self.assertEqual(len(sqlite.search("comments", "first")), 1)
+
+        self.assertEqual(get_column_names(self.path, "comments"), ["by", "id", "time", "text", "parent"])
+        self.assertEqual((rows[2]["time"], rows[2]["parent"]), (200, 1))
+
+    """
+        Migrations are applied once, in order of version.
+    """
+    def test_migrations_applied_once(self):
+        applied = []
+        forum = self.get_forum(migrations=[
+            sqlite_db.SqliteMigration(2, "second", lambda sqlite: applied.append(2)),
+            sqlite_db.SqliteMigration(1, "first", lambda sqlite: applied.append(1))
+        ])
+
+        sqlite_db.SqliteDB(self.path, forum).close()
+        sqlite_db.SqliteDB(self.path, forum).close()
+
+        self.assertEqual(applied, [1, 2])
+
+"""
+    Tests for opening databases created by the JS pipeline in read only mode.
+"""
+class ReadOnlyJSDatabaseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir_path, "data.db")
+        self.forum = entities.Forum(User, Post, Comment)
+
+        conn = sqlite3.connect(self.path)
+        conn.executescript(JS_SCHEMA)
+        conn.executemany("INSERT INTO comments VALUES (?, ?, ?, ?, ?)", [("pg", 2, 200, "first", 1), ("pg", 3, 300, "second", 2)])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    """
+        A JS database which has never been opened by python has no FTS5 or submission history tables,
+        so opening it read only asks for it to be migrated first, even with every generated column.
+    """
+    def test_open_unmigrated(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("ALTER TABLE posts ADD COLUMN url_content_summary TEXT")
+        conn.commit()
+        conn.close()
+
+        with self.assertRaisesRegex(sqlite_db.MalformedSqliteDBError, "migrate"):
+            sqlite_db.SqliteDB(self.path, self.forum, read_only=True)
+
+    """
+        Missing generated columns can't be added in read only mode, so they still raise.
+    """
+    def test_open_missing_generated_columns(self):
+        with self.assertRaises(sqlite_db.MalformedSqliteDBError):
+            sqlite_db.SqliteDB(self.path, self.forum, read_only=True)
+
+    """
+        Once migrated, a JS database can be opened read only with its extra columns intact,
+        and searched, and its submission histories read.
+    """
+    def test_open_migrated(self):
+        sqlite_db.SqliteDB(self.path, self.forum).close()
+
+        with sqlite_db.SqliteDB(self.path, self.forum, read_only=True) as sqlite:
+            rows = sqlite.get_by_ids("id", "comments", [2])[0]
+            history = sqlite.get_user_submissions("pg", "comments", "comments", "id")
+            matches = sqlite.search("comments", "second")
+
+        self.assertEqual(rows[2]["parent"], 1)
+        self.assertEqual([row["id"] for row in history], [3, 2])
+        self.assertEqual(len(matches), 1)
+
+"""
+    Tests for keeping the user_submissions table in sync with writes from outside python.
+"""
+class UserSubmissionsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir_path, "data.db")
+        self.forum = entities.Forum(User, Post, Comment)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    """
+        Write to the database directly, as the JS pipeline does.
+    """
+    def js_write(self, queries):
+        conn = sqlite3.connect(self.path)
+        for query, params in queries:
+            conn.execute(query, params)
+        conn.commit()
+        conn.close()
+
+    def get_history(self, sqlite, username, kind, table_name):
+        return [row["id"] for row in sqlite.get_user_submissions(username, kind, table_name, "id")]
+
+    """
+        Rows the JS pipeline inserts into a python created database show up in the histories,
+        favorites included, even when the favorite post arrives after the user.
+    """
+    def test_python_created(self):
+        sqlite_db.SqliteDB(self.path, self.forum).close()
+
+        self.js_write([
+            ("INSERT OR IGNORE INTO users (username, favorite_post_ids) VALUES (?, ?)", ("pg", "[1, 4]")),
+            ("INSERT OR IGNORE INTO posts (by, id, time, title) VALUES (?, ?, ?, ?)", ("pg", 1, 100, "Arc")),
+            ("INSERT OR IGNORE INTO comments (by, id, time, text) VALUES (?, ?, ?, ?)", ("pg", 2, 200, "first")),
+            ("INSERT OR IGNORE INTO comments (by, id, time, text) VALUES (?, ?, ?, ?)", ("pg", 3, 300, "second")),
+            ("INSERT OR IGNORE INTO posts (by, id, time, title) VALUES (?, ?, ?, ?)", ("rtm", 4, 400, "Viaweb"))
+        ])
+
+        with sqlite_db.SqliteDB(self.path, self.forum) as sqlite:
+            self.assertEqual(self.get_history(sqlite, "pg", "posts", "posts"), [1])
+            self.assertEqual(self.get_history(sqlite, "pg", "comments", "comments"), [3, 2])
+            self.assertEqual(self.get_history(sqlite, "pg", "favorite_posts", "posts"), [4, 1])
+            self.assertEqual(self.get_history(sqlite, "rtm", "posts", "posts"), [4])
+            self.assertEqual([row["id"] for row in sqlite.get_user_submissions("pg", "favorite_posts", "posts", "id", before=400)], [1])
+
+    """
+        A JS database is filled in when first opened, and kept in sync with JS writes after that.
+    """
+    def test_js_created(self):
+        conn = sqlite3.connect(self.path)
+        conn.executescript(JS_SCHEMA)
+        conn.execute("INSERT INTO users VALUES ('pg', 'lisp', 100, 1, 'real', '[1]', '[2]', '[1]')")
+        conn.execute("INSERT INTO posts VALUES ('pg', 1, 10, 100, 'Arc', 'a lisp', '', '')")
+        conn.execute("INSERT INTO comments VALUES ('pg', 2, 200, 'first', 1)")
+        conn.commit()
+        conn.close()
+
+        with sqlite_db.SqliteDB(self.path, self.forum) as sqlite:
+            self.assertEqual(self.get_history(sqlite, "pg", "comments", "comments"), [2])
+            self.assertEqual(self.get_history(sqlite, "pg", "favorite_posts", "posts"), [1])
+
+        self.js_write([
+            ("INSERT OR IGNORE INTO comments (by, id, time, text, parent) VALUES (?, ?, ?, ?, ?)", ("pg", 3, 300, "second", 2)),
+            ("UPDATE users SET favorite_post_ids = ? WHERE username = ?", ("[]", "pg")),
+            ("DELETE FROM comments WHERE id = ?", (2,))
+        ])
+
+        with sqlite_db.SqliteDB(self.path, self.forum) as sqlite:
+            self.assertEqual(self.get_history(sqlite, "pg", "comments", "comments"), [3])
+            self.assertEqual(self.get_history(sqlite, "pg", "favorite_posts", "posts"), [])
+
+    """
+        Entities stored through python are picked up by the same triggers.
+    """
+    def test_python_upsert(self):
+        with sqlite_db.SqliteDB(self.path, self.forum) as sqlite:
+            att_models = Comment.model.base.att_list
+            sqlite.upsert("comments", [{"by": "pg", "id": 2, "time": 200, "text": "first"}], att_models, "id")
+            sqlite.upsert("comments", [{"by": "rtm", "id": 2, "time": 250, "text": "first"}], att_models, "id")
+
+            self.assertEqual(self.get_history(sqlite, "pg", "comments", "comments"), [])
+            self.assertEqual(self.get_history(sqlite, "rtm", "comments", "comments"), [2])
+
+    """
+        Updating a user without touching their favorites leaves their favorite rows alone.
+    """
+    def test_unchanged_favorites_kept(self):
+        sqlite_db.SqliteDB(self.path, self.forum).close()
+        self.js_write([("INSERT INTO users (username, about, favorite_post_ids) VALUES (?, ?, ?)", ("pg", "lisp", "[1, 4]"))])
+
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TEMP TABLE deleted_submissions (submission_id INTEGER)")
+        conn.execute("CREATE TEMP TRIGGER log_deletes AFTER DELETE ON main.user_submissions BEGIN INSERT INTO deleted_submissions VALUES (old.submission_id); END")
+
+        conn.execute("UPDATE users SET username = username, about = ?, favorite_post_ids = favorite_post_ids WHERE username = ?", ("arc", "pg"))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM deleted_submissions").fetchone()[0], 0)
+
+        conn.execute("UPDATE users SET favorite_post_ids = ? WHERE username = ?", ("[1]", "pg"))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM deleted_submissions").fetchone()[0], 2)
+        self.assertEqual(conn.execute("SELECT submission_id FROM user_submissions WHERE kind = 'favorite_posts'").fetchall(), [(1,)])
+        conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -33,7 +33,7 @@ class SubmissionTreeNode:
         self.parent = parent
         self.active = False
 
-        self.kids = [SubmissionTreeNode(kid_st_dict, parent=self) for kid_st_dict in st_dict["kids"]]
+        self.kids = [SubmissionTreeNode(kid_st_dict, root_factory, stem_factory, verbose=verbose, parent=self) for kid_st_dict in st_dict["kids"]]
 
     def _print(self, s):
         if self.verbose:
@@ -91,7 +91,7 @@ class SubmissionTreeNode:
         Add a kid to this node, given an id.
     """
     def add_kid(self, kid_id):
-        kid = SubmissionTreeNode({"id": kid_id, "kids": []}, parent=self)
+        kid = SubmissionTreeNode({"id": kid_id, "kids": []}, self.root_factory, self.stem_factory, verbose=self.verbose, parent=self)
         new_kids = [*self.kids, kid]
         self.kids = new_kids
 
@@ -162,6 +162,28 @@ class SubmissionTreeNode:
         else:
             return self.stem_factory(self.id)
         
+    """
+        Iterate through this node and all of its descendants.
+    """
+    def iter_nodes(self):
+        yield self
+        for kid in self.kids:
+            yield from kid.iter_nodes()
+
+    """
+        Fetch the submission objects of this node and all of its descendants, keyed by id.
+        If load_sqlite is set, their sqlite attributes are loaded with batched queries.
+    """
+    def fetch_tree_objects(self, load_sqlite=False):
+        sub_objs = {node.get_id(): node.fetch_submission_object() for node in self.iter_nodes()}
+
+        if load_sqlite:
+            missing = entities.load_list_from_sqlite(list(sub_objs.values()))
+            for sub_obj in missing:
+                self._print(f"Could not load {sub_obj} from sqlite.")
+
+        return sub_objs
+
     """
         Check all items in this tree
         to see whether all of the data necessary to 
@@ -182,9 +204,14 @@ class SubmissionTreeNode:
 
 
     """
-        Iterate through the descendants of this tree via a DFS, with provided data sources
+        Iterate through the descendants of this tree via a DFS, with provided data sources.
+        If load_sqlite is set, the submission objects of the whole tree are
+        loaded from sqlite in batches up front.
     """
-    def dfs(self, f,  filter_f=None, reduce_kids_f=None, reduce_kids_acc=None):
+    def dfs(self, f,  filter_f=None, reduce_kids_f=None, reduce_kids_acc=None, load_sqlite=False, sub_objs=None):
+
+        if load_sqlite and sub_objs == None:
+            sub_objs = self.fetch_tree_objects(load_sqlite=True)
 
         f_inp = {
             "st_node": self,
@@ -192,14 +219,14 @@ class SubmissionTreeNode:
             "desc_result": None
         }
         
-        f_inp["sub_obj"] = self.fetch_submission_object()
+        f_inp["sub_obj"] = self.fetch_submission_object() if sub_objs == None else sub_objs[self.id]
 
         if filter_f != None:
             filter_res = filter_f(f_inp)
             if filter_res == False:
                 return None
 
-        kid_results = [kid.dfs(f, filter_f=filter_f, reduce_kids_f=reduce_kids_f,reduce_kids_acc=reduce_kids_acc) for kid in self.kids] 
+        kid_results = [kid.dfs(f, filter_f=filter_f, reduce_kids_f=reduce_kids_f,reduce_kids_acc=reduce_kids_acc, sub_objs=sub_objs) for kid in self.kids] 
 
         if reduce_kids_f != None:
             reduced = functools.reduce(reduce_kids_f, kid_results, reduce_kids_acc)
@@ -212,12 +239,16 @@ class SubmissionTreeNode:
         for kid in self.kids:
             yield from kid.iter_dfs()
 
-    def iter_dfs_branches(self, branch=None):
+    """
+        Iterate through the branches from this node down via a DFS,
+        taking submission objects from sub_objs, keyed by id, if given.
+    """
+    def iter_dfs_branches(self, branch=None, sub_objs=None):
         yield branch
         
         for kid in self.kids:
-            branch.push_stem(kid.fetch_submission_object())
-            yield from kid.iter_dfs_branches(branch=branch)
+            branch.push_stem(kid.fetch_submission_object() if sub_objs == None else sub_objs[kid.get_id()])
+            yield from kid.iter_dfs_branches(branch=branch, sub_objs=sub_objs)
             branch.pop_stem()
 
 
@@ -374,13 +405,21 @@ class SubmissionForest:
     """
         Run a DFS on all roots, with given parameters.
     """
-    def dfs_roots(self, f, filter_f=None, reduce_kids_f=None, reduce_kids_acc=None):
+    def dfs_roots(self, f, filter_f=None, reduce_kids_f=None, reduce_kids_acc=None, load_sqlite=False):
         return [root.dfs(f, filter_f=filter_f,
-            reduce_kids_f=reduce_kids_f, reduce_kids_acc=reduce_kids_acc) for root in self.roots]
+            reduce_kids_f=reduce_kids_f, reduce_kids_acc=reduce_kids_acc, load_sqlite=load_sqlite) for root in self.roots]
 
-    def iter_dfs(self):
-        for root in self.roots:
-            yield from root.iter_dfs()
+    """
+        Iterate through the submission objects of all trees in DFS order.
+        If load_sqlite is set, they're loaded from sqlite batch_size at a time,
+        optionally only for a list of attribute names.
+    """
+    def iter_dfs(self, load_sqlite=False, batch_size=1000, att_names=None):
+        sub_objs = (node.fetch_submission_object() for root in self.roots for node in root.iter_nodes())
+        if load_sqlite:
+            yield from entities.iter_load_from_sqlite(sub_objs, batch_size=batch_size, att_names=att_names)
+        else:
+            yield from sub_objs
 
     def iter_bfs(self):
         queue = deque(self.roots)
@@ -390,13 +429,38 @@ class SubmissionForest:
             for kid in node.kids:
                 queue.append(kid)
 
-    def iter_roots(self):
-        for root in self.roots:
-            yield root.fetch_submission_object()
+    def iter_roots(self, load_sqlite=False, batch_size=1000, att_names=None):
+        root_objs = (root.fetch_submission_object() for root in self.roots)
+        if load_sqlite:
+            yield from entities.iter_load_from_sqlite(root_objs, batch_size=batch_size, att_names=att_names)
+        else:
+            yield from root_objs
 
-    def iter_dfs_branches(self):
+    """
+        Get the earliest and latest times of all submissions in the forest,
+        reading only the time column of each from sqlite.
+    """
+    def get_time_range(self, time_att, batch_size=1000):
+        times = [sub_obj.base.get_value(time_att) for sub_obj in self.iter_dfs(load_sqlite=True, batch_size=batch_size, att_names=[time_att])]
+        return min(times), max(times)
+
+    """
+        Iterate through every branch of every tree.
+        If load_sqlite or load_chroma are set, each tree's submission objects are loaded
+        in batches before its branches are walked, the embeddings held in quantization_mode if it's given.
+        If root_ids is given, only the trees of those roots are fetched and walked.
+    """
+    def iter_dfs_branches(self, load_sqlite=False, load_chroma=False, quantization_mode=None, root_ids=None):
         for root in self.roots:
-            yield from root.iter_dfs_branches(branch=Branch(root.fetch_submission_object()))
+            if root_ids != None and not (root.get_id() in root_ids):
+                continue
+            sub_objs = None
+            if load_sqlite or load_chroma:
+                sub_objs = root.fetch_tree_objects(load_sqlite=load_sqlite)
+                if load_chroma:
+                    for sub_obj in entities.load_list_from_chroma(list(sub_objs.values()), quantization_mode=quantization_mode):
+                        self._print(f"Could not load embeddings for {sub_obj}.")
+            yield from root.iter_dfs_branches(branch=Branch(root.fetch_submission_object() if sub_objs == None else sub_objs[root.get_id()]), sub_objs=sub_objs)
 
     """
         Clean all roots.
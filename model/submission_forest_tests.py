@@ -0,0 +1,79 @@
+"""
+    Unit tests for walking the trees of a submission forest.
+"""
+
+import unittest
+import tempfile
+import sqlite3
+import shutil
+import os
+
+import entities
+import sqlite_db
+import submission_forest
+from sqlite_db_tests import User, Post, Comment
+
+"""
+    Two trees, post 1 with comments 2 and 3 under it, and 4 under 2, and post 5 with comment 6.
+"""
+ST_DICT_LIST = [
+    {"id": 1, "kids": [{"id": 2, "kids": [{"id": 4, "kids": []}]}, {"id": 3, "kids": []}]},
+    {"id": 5, "kids": [{"id": 6, "kids": []}]}
+]
+
+class IterDFSBranchesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir_path, "data.db")
+
+        self.sqlite = sqlite_db.SqliteDB(self.path, entities.Forum(User, Post, Comment))
+        conn = sqlite3.connect(self.path)
+        conn.executemany("INSERT INTO posts (by, id, time, title) VALUES (?, ?, ?, ?)", [("pg", 1, 100, "Arc"), ("dang", 5, 500, "Ask HN")])
+        conn.executemany("INSERT INTO comments (by, id, time, text) VALUES (?, ?, ?, ?)", [("pg", 2, 200, "a"), ("pg", 3, 300, "b"), ("dang", 4, 400, "c"), ("dang", 6, 600, "d")])
+        conn.commit()
+        conn.close()
+
+        self.fetched_ids = []
+        def root_factory(id_val):
+            self.fetched_ids.append(id_val)
+            return Post(id_val, self.sqlite, None)
+        def stem_factory(id_val):
+            self.fetched_ids.append(id_val)
+            return Comment(id_val, self.sqlite, None)
+
+        self.sf = submission_forest.SubmissionForest("test", ST_DICT_LIST, root_factory, stem_factory)
+
+    def tearDown(self):
+        self.sqlite.close()
+        shutil.rmtree(self.dir_path)
+
+    def get_branch_ids(self, branches):
+        return [[branch.root.get_id()] + [stem.get_id() for stem in branch.stems] for branch in branches]
+
+    def test_all_branches(self):
+        branch_ids = self.get_branch_ids(self.sf.iter_dfs_branches(load_sqlite=True))
+
+        self.assertEqual(branch_ids, [[1], [1, 2], [1, 2, 4], [1, 3], [5], [5, 6]])
+        self.assertEqual(sorted(self.fetched_ids), [1, 2, 3, 4, 5, 6])
+
+    """
+        Only the trees of the roots given are walked, and the submissions of the others are never fetched or loaded.
+    """
+    def test_root_ids(self):
+        texts = []
+        branch_ids = []
+        for branch in self.sf.iter_dfs_branches(load_sqlite=True, root_ids={5}):
+            branch_ids.append([branch.root.get_id()] + [stem.get_id() for stem in branch.stems])
+            texts += [stem.base.get_value("text") for stem in branch.stems]
+
+        self.assertEqual(branch_ids, [[5], [5, 6]])
+        self.assertEqual(texts, ["d"])
+        self.assertEqual(sorted(self.fetched_ids), [5, 6])
+
+    def test_no_root_ids(self):
+        self.assertEqual(list(self.sf.iter_dfs_branches(load_sqlite=True, root_ids=set())), [])
+        self.assertEqual(self.fetched_ids, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""
+    A tokenizer service shared by the embedding models and LLMs, for counting tokens quickly
+    across whole datasets.
+"""
+
+from tiktoken import encoding_for_model
+
+import collections
+import hashlib
+import threading
+
+"""
+    How many token counts are kept in memory before the least recently used are evicted.
+"""
+MAX_CACHED_COUNTS = 200000
+
+"""
+    Caches each model's encoding after the first lookup, and memoizes token counts by
+    model and content hash, evicting the least recently used.
+    Counts for lists of documents are done with tiktoken's encode_batch over several threads,
+    for only the documents not already counted, and single documents are encoded directly.
+"""
+class TokenizerService:
+    def __init__(self, max_cached_counts=MAX_CACHED_COUNTS, num_threads=8):
+        self.max_cached_counts = max_cached_counts
+        self.num_threads = num_threads
+
+        self.encodings = {}
+        self.counts = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_encoding(self, model_name):
+        with self.lock:
+            if not (model_name in self.encodings):
+                self.encodings[model_name] = encoding_for_model(model_name)
+            return self.encodings[model_name]
+
+    def get_count_key(self, model_name, document):
+        return (model_name, hashlib.sha256(document.encode("utf-8")).digest())
+
+    """
+        Count the tokens of one document, encoding it directly on this thread,
+        as handing a single document to encode_batch's thread pool only adds overhead.
+    """
+    def count(self, model_name, document):
+        key = self.get_count_key(model_name, document)
+        with self.lock:
+            if key in self.counts:
+                self.counts.move_to_end(key)
+                self.hits += 1
+                return self.counts[key]
+            self.misses += 1
+
+        num_tokens = len(self.get_encoding(model_name).encode(document, disallowed_special=()))
+
+        with self.lock:
+            self.counts[key] = num_tokens
+            self.counts.move_to_end(key)
+            while len(self.counts) > self.max_cached_counts:
+                self.counts.popitem(last=False)
+
+        return num_tokens
+
+    """
+        Count the tokens of each of a list of documents.
+    """
+    def count_batch(self, model_name, documents):
+        keys = [self.get_count_key(model_name, document) for document in documents]
+
+        counts = [None for document in documents]
+        missing = {}
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.counts:
+                    self.counts.move_to_end(key)
+                    counts[i] = self.counts[key]
+                else:
+                    missing.setdefault(key, []).append(i)
+            self.hits += len(documents) - sum([len(indices) for indices in missing.values()])
+            self.misses += len(missing)
+
+        if len(missing) == 0:
+            return counts
+
+        missing_keys = list(missing.keys())
+        encoded = self.get_encoding(model_name).encode_batch([documents[missing[key][0]] for key in missing_keys], num_threads=self.num_threads, disallowed_special=())
+
+        with self.lock:
+            for key, tokens in zip(missing_keys, encoded):
+                for i in missing[key]:
+                    counts[i] = len(tokens)
+                self.counts[key] = len(tokens)
+                self.counts.move_to_end(key)
+            while len(self.counts) > self.max_cached_counts:
+                self.counts.popitem(last=False)
+
+        return counts
+
+    """
+        Split a document into chunks of at most chunk_tokens tokens, each overlapping
+        the one before it by overlap tokens.
+    """
+    def split(self, model_name, document, chunk_tokens, overlap):
+        encoding = self.get_encoding(model_name)
+        tokens = encoding.encode(document, disallowed_special=())
+        return [encoding.decode(tokens[start:start + chunk_tokens]) for start in get_chunk_starts(len(tokens), chunk_tokens, overlap)]
+
+    def clear(self):
+        with self.lock:
+            self.counts = collections.OrderedDict()
+
+"""
+    Get the token index each chunk starts at, when splitting num_tokens tokens into chunks
+    of chunk_tokens overlapping by overlap.
+"""
+def get_chunk_starts(num_tokens, chunk_tokens, overlap):
+    step = chunk_tokens - overlap
+    return list(range(0, max(num_tokens - overlap, 1), step))
+
+"""
+    The service shared by everything in the process.
+"""
+tokenizer_service = TokenizerService()
+
+def get_tokenizer_service():
+    return tokenizer_service
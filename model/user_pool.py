@@ -3,6 +3,8 @@
     its users.
 """
 
+import entities
+
 """
     An exception class for all user pool related errors.
 """
@@ -61,9 +63,17 @@ class UserPool:
 
     """
         Fetch the profiles of all users in the user pool.
+        If load_sqlite is set, their sqlite attributes are loaded with batched queries.
     """
-    def fetch_all_user_objects(self):
-        return [self.user_factory(uid) for uid in self.uids]
+    def fetch_all_user_objects(self, load_sqlite=False):
+        users = [self.user_factory(uid) for uid in self.uids]
+
+        if load_sqlite:
+            missing = entities.load_list_from_sqlite(users)
+            if len(missing) > 0:
+                raise UserNotFoundError(f"Error: users {[user.get_id() for user in missing]} in user pool {self.name} could not be found in the sqlite database.")
+
+        return users
 
     """
         Check if this user pool contains a user with a given uid.
@@ -101,7 +111,19 @@ class UserPool:
         clean_uids = [user.get_id() for user in all_users if user.check(checker=checker)]
         self.set_uids(clean_uids)
 
-    def iterate(self, loader):
-        for uid in self.uids:
-            yield self.fetch_user_object(uid, loader)
+    """
+        Iterate through the user objects in the pool.
+        If load_sqlite is set, they're loaded from sqlite batch_size at a time,
+        and if load_chroma is set, so are their embeddings,
+        so memory stays flat regardless of the size of the pool,
+        held in quantization_mode if it's given.
+        The options are keyword only, as this used to take a loader.
+    """
+    def iterate(self, *, load_sqlite=False, load_chroma=False, batch_size=1000, quantization_mode=None):
+        users = (self.user_factory(uid) for uid in self.uids)
+        if load_sqlite:
+            users = entities.iter_load_from_sqlite(users, batch_size=batch_size)
+        if load_chroma:
+            users = entities.iter_load_from_chroma(users, batch_size=batch_size, quantization_mode=quantization_mode)
+        yield from users
     
@@ -5,7 +5,7 @@ import os
 import json
 import pathlib
 import shutil
-import tiktoken
+import tokenizer_service
 import functools
 import chromadb
 
@@ -125,14 +125,7 @@ def get_embedding_tokenizer(model_name):
     Get the number of input tokens for a given openai prompt, with a given model.
 """
 def get_openai_token_estimate(prompt, model):
-    encoding = tiktoken.encoding_for_model(model)
-    try:
-        tokens = encoding.encode(prompt)
-    except Exception as e:
-        print(e)
-        print(prompt)
-        exit()
-    return len(tokens)
+    return tokenizer_service.get_tokenizer_service().count(model, prompt)
 
 """
     Get a structured response from gpt4o, given a list of messages, and a response format class.
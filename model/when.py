@@ -1,5 +1,6 @@
 import utils
 import entities
+import projection
 
 import numpy as np
 import pandas as pd
@@ -19,7 +20,17 @@ class When:
         self.dir_path = self.model_dir_path + self.name + "/"
         if not utils.check_directory_exists(self.dir_path):
             utils.create_directory(self.dir_path)
-        
+
+        self.projection_path = projection.get_projection_path(self.name)
+        self.projection = projection.EmbeddingProjection.load(self.projection_path) if utils.check_file_exists(self.projection_path) else None
+
+    """
+        Set the projection the model's embedding features are reduced with, and save it next to the model.
+    """
+    def set_projection(self, embedding_projection):
+        self.projection = embedding_projection
+        self.projection.save(self.projection_path)
+
     def __str__(self):
         return f"When Model: {self.name}"
 